@@ -1,65 +1,1067 @@
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+import itertools
 import json
 import logging
+import sys
+import threading
+import time
+import types
 
 from microdrop.app_context import get_app, get_hub_uri
 from microdrop.plugin_helpers import get_plugin_info
 from microdrop.plugin_manager import (PluginGlobals, Plugin, IPlugin,
                                       implements, emit_signal)
-from microdrop.protocol import protocol_from_dict
-
-from zmq_plugin.schema import pandas_object_hook, PandasJsonEncoder
 import paho_mqtt_helpers as pmh
 import path_helpers as ph
 
 from ._version import get_versions
-
-__version__ = get_versions()['version']
-del get_versions
+from .batch_edit import apply_edits
+from .chunking import (Reassembler, chunk_filter, chunk_topic, parent_topic,
+                       split)
+from .compression import MAX_DECOMPRESSED_SIZE, Compressor, decompress
+from .connection import Backoff, Connector
+from .dispatch import Dispatcher, MessageQueue
+from .envelope import from_properties, unwrap, wrap
+from .hub import default_hub
+from .json_patch import DeltaStream
+from .metrics import (MetricsRegistry, PeriodicTask, TopicMetrics,
+                      serve_prometheus)
+from .outbound import Outbox
+from .payload_codecs import CodecRegistry, JsonCodec
+from .profiling import HandlerProfiler, dump_stats, summarize
+from .protocol_cache import (LoadedProtocolCache, ProtocolJsonCache,
+                             StepFragmentCache)
+from .reactor import default_reactor
+from .recording import INBOUND, OUTBOUND, ReplayMessage, TrafficRecorder
+from .snapshot_store import SnapshotStore, json_digest
+from .topics import TopicTrie
+from .transaction import Transaction
 
 logger = logging.getLogger(__name__)
 
+#: Plugin metadata from `properties.yml` (generated when the plugin is
+#: packaged).
+_plugin_info = get_plugin_info(ph.path(__file__).parent)
+_version = getattr(_plugin_info, 'version', None)
+
+
+def get_version():
+    '''
+    Returns
+    -------
+    str
+        Plugin version, from ``properties.yml`` if the plugin is packaged.
+
+        .. note::
+            Otherwise, the version is resolved (once) by versioneer, which runs
+            up to five ``git`` subprocesses in a source checkout.  This is
+            deferred until the version is first needed, so importing the
+            plugin spawns no processes.
+    '''
+    global _version
+
+    if _version is None:
+        _version = get_versions()['version']
+    return '%s' % _version
+
+
+def __getattr__(name):
+    # Resolve `__version__` on first access (Python 3.7+, see PEP 562).
+    if name == '__version__':
+        return get_version()
+    raise AttributeError("module '%s' has no attribute '%s'" % (__name__,
+                                                                 name))
+
+
+class _LazyVersionModule(types.ModuleType):
+    '''
+    Stand-in for this module in :data:`sys.modules` resolving
+    ``__version__`` on first access, for Python versions without PEP 562
+    (i.e., before 3.7).
+
+    Other attributes are read from (and set on) the module itself, so its
+    functions see attributes patched through the stand-in.
+    '''
+    def __init__(self, module):
+        super(_LazyVersionModule, self).__init__(module.__name__,
+                                                 module.__doc__)
+        self.__dict__['_module'] = module
+
+    def __getattr__(self, name):
+        if name == '__version__':
+            return get_version()
+        return getattr(self._module, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._module, name, value)
+
+    def __delattr__(self, name):
+        delattr(self._module, name)
+
+    def __dir__(self):
+        return dir(self._module) + ['__version__']
+
+
+if _version is not None:
+    __version__ = get_version()
+
+
+class _PandasJsonEncoder(json.JSONEncoder):
+    '''
+    Equivalent to :class:`zmq_plugin.schema.PandasJsonEncoder`, importing it
+    (and pandas) only once an object that is not natively JSON serializable
+    is first encoded.
+    '''
+    _encoder = None
+
+    def default(self, obj):
+        if _PandasJsonEncoder._encoder is None:
+            from zmq_plugin.schema import PandasJsonEncoder
+
+            _PandasJsonEncoder._encoder = PandasJsonEncoder()
+        return _PandasJsonEncoder._encoder.default(obj)
+
+
+class _Version(object):
+    '''
+    Class attribute resolving to :func:`get_version` on first access.
+    '''
+    def __get__(self, instance, owner):
+        return get_version()
+
 PluginGlobals.push_env('microdrop.managed')
 
+#: Handler method and payload decoder method names for a subscribed topic.
+Route = namedtuple('Route', 'handler decoder')
+
+
 class MqttPlugin(pmh.BaseMqttReactor, Plugin):
     """
     This class is automatically registered with the PluginManager.
     """
     implements(IPlugin)
-    version = __version__
-    plugin_name = get_plugin_info(ph.path(__file__).parent).plugin_name
+    version = _Version()
+    plugin_name = _plugin_info.plugin_name
+
+    #: Subscribed topic filters, mapped to the :class:`Route` used to handle
+    #: received messages.
+    routes = TopicTrie([
+        ('microdrop/dmf-device-ui/change-step',
+         Route('change_step', 'decode_json')),
+        ('microdrop/dmf-device-ui/delete-step',
+         Route('delete_step', 'decode_json')),
+        ('microdrop/dmf-device-ui/insert-step',
+         Route('insert_step', 'decode_json')),
+        ('microdrop/dmf-device-ui/batch-edit',
+         Route('batch_edit', 'decode_json')),
+        ('microdrop/dmf-device-ui/change-protocol-state',
+         Route('change_protocol_state', 'decode_json')),
+        ('microdrop/dmf-device-ui/change-repeat',
+         Route('change_protocol_repeat', 'decode_json')),
+        ('microdrop/data-controller/load-protocol',
+         Route('load_protocol', 'decode_protocol')),
+        # Chunked transfers (see `chunking`) are reassembled, then handled as
+        # messages on the parent topic.
+        (chunk_filter('microdrop/data-controller/load-protocol'),
+         Route('load_protocol', 'decode_protocol')),
+        ('microdrop/data-controller/load-protocol-by-hash',
+         Route('load_protocol_by_hash', 'decode_json')),
+        ('microdrop/mqtt-plugin/profile/start',
+         Route('start_profile', 'decode_optional_json')),
+        ('microdrop/mqtt-plugin/profile/stop',
+         Route('stop_profile', 'decode_optional_json')),
+        ('microdrop/mqtt-plugin/+/sha1',
+         Route('update_retained_digest', 'decode_json'))])
+
+    #: Maximum number of received messages waiting to be handled.
+    queue_size = 1000
+    #: Policy applied when a message is received while the queue is full (see
+    #: :class:`MessageQueue`).  By default, a message on one of the
+    #: :attr:`coalesced_topics` replaces the queued message on the same topic;
+    #: otherwise, the oldest queued message not on one of the
+    #: :attr:`lossless_topics` is dropped, so the MQTT network loop never
+    #: waits on slow handlers (e.g., of keepalives).
+    #: :attr:`MessageQueue.BLOCK` applies backpressure instead, at the risk
+    #: of the broker dropping the connection.
+    queue_overflow = MessageQueue.COALESCE
+    #: Idempotent topics for which only the latest of a burst of pending
+    #: messages is handled (see :meth:`MessageQueue.put`).
+    coalesced_topics = frozenset(['microdrop/dmf-device-ui/change-step',
+                                  'microdrop/dmf-device-ui/change-repeat'])
+    #: Seconds a message on a coalesced topic is held before it is handled,
+    #: giving later messages on the same topic a chance to replace it.
+    coalesce_window = .05
+    #: Topics of commands that edit the protocol, which are never dropped
+    #: when the queue is full (including chunks of these topics).
+    lossless_topics = frozenset(['microdrop/dmf-device-ui/delete-step',
+                                 'microdrop/dmf-device-ui/insert-step',
+                                 'microdrop/dmf-device-ui/batch-edit',
+                                 'microdrop/dmf-device-ui/'
+                                 'change-protocol-state',
+                                 'microdrop/data-controller/load-protocol',
+                                 'microdrop/data-controller/'
+                                 'load-protocol-by-hash'])
+    #: Number of protocol changes published as deltas (see
+    #: :class:`DeltaStream`) on ``microdrop/mqtt-plugin/protocol-delta``
+    #: between full retained snapshots on
+    #: ``microdrop/mqtt-plugin/protocol-changed``.  If 0, every change is
+    #: published as a full snapshot.
+    protocol_snapshot_interval = 0
+    #: Payload codec name (see :data:`payload_codecs.CODECS`) by topic
+    #: filter, for topics (received or published) not encoded as JSON.
+    #: Received messages with an MQTT v5 ``Content Type`` property are
+    #: decoded with the matching codec regardless of topic.
+    topic_codecs = {}
+    #: Published payloads of at least this many bytes are compressed (see
+    #: :mod:`compression`); ``None`` disables compression.  Received
+    #: compressed payloads are always decompressed.
+    compress_threshold = None
+    #: Compression encoding (see :data:`compression.ENCODINGS`).
+    compress_encoding = 'zlib'
+    #: Maximum size (in bytes) of a received payload once decompressed;
+    #: larger payloads are rejected.
+    max_decompressed_size = MAX_DECOMPRESSED_SIZE
+    #: Maximum number of messages published while not connected to the
+    #: broker, held until the connection is established (the oldest are
+    #: dropped first).  Held retained messages are coalesced per topic.
+    publish_buffer_size = 100
+    #: Initial and maximum delay (in seconds) between connection attempts
+    #: (see :class:`connection.Backoff`).
+    reconnect_delay = .5
+    reconnect_delay_max = 30.
+    #: Seconds between flushes of published messages (see
+    #: :class:`outbound.Outbox`); ``None`` (the default) publishes each
+    #: message immediately.  Batching adds up to this delay to every
+    #: message, in exchange for coalescing pending retained messages per
+    #: topic and applying :attr:`publish_rate`, e.g., for clients that
+    #: cannot keep up with bursts of protocol updates.
+    publish_interval = None
+    #: Number of pending published messages triggering an immediate flush.
+    publish_batch_size = 100
+    #: Maximum number of messages published per second, and at once after an
+    #: idle period (see :class:`outbound.TokenBucket`), if
+    #: :attr:`publish_interval` is set; ``None`` for no limit.
+    publish_rate = 100.
+    publish_burst = 200
+    #: If ``True``, the MQTT network loop runs (and published messages are
+    #: flushed) on the process-wide :func:`reactor.default_reactor` thread,
+    #: shared with other plugins, rather than on threads of this plugin.
+    use_shared_reactor = False
+    #: If ``True``, share one broker connection with other plugins through
+    #: the process-wide :func:`hub.default_hub` instead of opening a
+    #: connection for this plugin.
+    use_connection_hub = False
+    #: Events published in response to each command topic, used to measure
+    #: the latency from a command to its effect (see :attr:`latency_stats`).
+    correlated_events = {
+        'microdrop/dmf-device-ui/change-step':
+        ('microdrop/mqtt-plugin/step-swapped', ),
+        'microdrop/dmf-device-ui/delete-step':
+        ('microdrop/mqtt-plugin/protocol-changed',
+         'microdrop/mqtt-plugin/protocol-delta'),
+        'microdrop/dmf-device-ui/insert-step':
+        ('microdrop/mqtt-plugin/step-inserted', ),
+        'microdrop/dmf-device-ui/batch-edit':
+        ('microdrop/mqtt-plugin/protocol-changed',
+         'microdrop/mqtt-plugin/protocol-delta'),
+        'microdrop/dmf-device-ui/change-protocol-state':
+        ('microdrop/mqtt-plugin/protocol-state', ),
+        'microdrop/dmf-device-ui/change-repeat':
+        ('microdrop/mqtt-plugin/protocol-repeats-changed', ),
+        'microdrop/data-controller/load-protocol':
+        ('microdrop/mqtt-plugin/protocol-swapped', ),
+        'microdrop/data-controller/load-protocol-by-hash':
+        ('microdrop/mqtt-plugin/protocol-swapped', )}
+    #: Maximum seconds between a command and an event attributed to it.
+    correlation_timeout = 5.
+    #: If ``True``, published JSON payloads are wrapped in an envelope (see
+    #: :mod:`envelope`) with a sequence number, timestamp and the command
+    #: that caused the event, if any.  Enveloped commands are accepted
+    #: regardless.
+    use_envelopes = False
+    #: Seconds between publishes of :attr:`metrics` (see
+    #: :meth:`metrics.MetricsRegistry.collect`) on
+    #: ``microdrop/mqtt-plugin/metrics``; ``None`` disables publishing.
+    metrics_interval = 10.
+    #: Latencies (see :attr:`latency_stats`) are observed for one in this
+    #: many received messages on each topic, since observing every stage of
+    #: every message costs several microseconds; message and byte counters
+    #: are exact regardless.
+    latency_sample_interval = 8
+    #: Local port to serve :attr:`metrics` on in the Prometheus text format
+    #: (e.g., ``9464``); ``None`` disables the HTTP endpoint.
+    metrics_http_port = None
+    #: Directory profiles captured on request (see :meth:`start_profile`) are
+    #: written to (the system temporary directory if ``None``).
+    profile_directory = None
+    #: Default and maximum duration (in seconds) of a profile capture.
+    profile_duration = 30.
+    profile_max_duration = 600.
+    #: Traffic log (see :mod:`recording`) every received and published
+    #: message is appended to, for replay with
+    #: ``benchmarks/bench_plugin.py --traffic``; ``None`` disables recording.
+    record_path = None
+    #: Directory of an on-disk cache of serialized protocols (see
+    #: :class:`snapshot_store.SnapshotStore`), so protocols serialized before
+    #: a restart are not serialized again; ``None`` disables the cache.
+    snapshot_directory = None
+    #: Maximum number of protocols in the on-disk cache.
+    snapshot_max_entries = 32
+    #: Published payloads larger than this many bytes (after compression) on
+    #: :attr:`chunked_topics` are split into chunks (see :mod:`chunking`)
+    #: published on ``<topic>/chunks/<index>``, e.g., to stay under the
+    #: broker ``message_size_limit``; ``None`` disables chunking.  If
+    #: :attr:`publish_interval` is set, chunks are sent in the low priority
+    #: lane of :attr:`outbox`, so other messages are not held up by large
+    #: transfers.
+    chunk_size = None
+    chunked_topics = frozenset(['microdrop/mqtt-plugin/protocol-changed',
+                                'microdrop/mqtt-plugin/protocol-swapped'])
+    #: Seconds before an incomplete received chunked transfer is discarded.
+    chunk_timeout = 30.
+    #: Number of recently loaded protocols kept in memory, to be reactivated
+    #: by payload digest (see :meth:`load_protocol_by_hash`).
+    loaded_protocols_size = 8
 
     def __init__(self):
         super(MqttPlugin, self).__init__()
         self.name = self.plugin_name
+        self.codecs = CodecRegistry(JsonCodec(_PandasJsonEncoder),
+                                    self.topic_codecs)
+        self.compressor = (None if self.compress_threshold is None
+                           else Compressor(self.compress_threshold,
+                                           self.compress_encoding))
+        self.protocol_deltas = DeltaStream(self.protocol_snapshot_interval)
+        self.step_fragments = StepFragmentCache(_PandasJsonEncoder)
+        self.snapshot_store = (None if self.snapshot_directory is None else
+                               SnapshotStore(self.snapshot_directory,
+                                             self.snapshot_max_entries))
+        self.protocol_cache = ProtocolJsonCache(fragments=self.step_fragments,
+                                                store=self.snapshot_store)
+        self.loaded_protocols = LoadedProtocolCache(
+            self.loaded_protocols_size, fragments=self.step_fragments)
+        self._skipped_loads = 0
+        # Digest of the protocol snapshot retained by the broker on each
+        # protocol topic (see `update_retained_digest`).
+        self._retained_digests = {}
+        # Revision of the protocol last published on each protocol topic.
+        self._published_revisions = {}
+        self._skipped_publishes = 0
+        # `(revision, payload)` of the protocol last transcoded with each
+        # non-JSON codec (see `transcode_json`).
+        self._transcoded = {}
+        # Received messages are handled on a dedicated worker thread, so slow
+        # handlers do not stall the MQTT network loop (e.g., keepalives).
+        self.message_queue = MessageQueue(self.queue_size, self.queue_overflow)
+        self.dispatcher = Dispatcher(self.message_queue, self._dispatch)
+        self.dispatcher.start()
+        self.metrics = MetricsRegistry()
+        self._topic_metrics = {}
+        # Wildcard routes, so metrics of topics matching them are labelled
+        # with the filter (bounding the number of label values).
+        self._metric_filters = TopicTrie(
+            (topic_filter, topic_filter) for topic_filter in self.routes
+            if TopicTrie.is_wildcard(topic_filter))
+        # Command pending for each correlated event topic, as
+        # `(command_topic, seq, origin_time, received_time, sampled)`.
+        self._causes = {}
+        self._received_time = None
+        # Whether latencies of the message being handled are observed.
+        self._sampled = True
+        self._publish_sequence = itertools.count(1)
+        # Messages published before the connection is established.
+        self._connected = False
+        # Maps `topic` (retained messages) or a sequence number (other
+        # messages) to `(topic, payload, qos, retain)`, as in `Outbox`.
+        self._pending_publishes = OrderedDict()
+        self._pending_sequence = itertools.count()
+        self._pending_lock = threading.Lock()
+        self.dropped_publishes = 0
+        self.reactor = default_reactor() if self.use_shared_reactor else None
+        self._outbox_timer = None
+        if self.publish_interval is None:
+            self.outbox = None
+        else:
+            self.outbox = Outbox(self._send, self.publish_interval,
+                                 self.publish_batch_size, self.publish_rate,
+                                 self.publish_burst)
+            if self.reactor is None:
+                self.outbox.start()
+            else:
+                self._outbox_timer = \
+                    self.reactor.call_later(self.publish_interval,
+                                            self._flush_outbox)
+        self.reassembler = Reassembler(self.chunk_timeout)
+        # Transaction in progress on each thread (see `transaction`).
+        self._transactions = threading.local()
+        # Number of chunks of the latest retained chunked payload, by topic.
+        self._chunk_counts = {}
+        self._backoff = Backoff(self.reconnect_delay, self.reconnect_delay_max)
+        self.connector = None
+        self.hub = None
+        self._hub_registration = None
+        self._register_metrics()
+        self.metrics_task = None
+        if self.metrics_interval:
+            self.metrics_task = PeriodicTask(self.metrics_interval,
+                                             self.publish_metrics,
+                                             'mqtt-plugin-metrics')
+            self.metrics_task.start()
+        self.metrics_server = None
+        if self.metrics_http_port is not None:
+            self.metrics_server = serve_prometheus(self.metrics,
+                                                   self.metrics_http_port)
+        self.profiler = HandlerProfiler()
+        self.recorder = (None if self.record_path is None
+                         else TrafficRecorder(self.record_path))
         self.start()
 
+    def start(self):
+        '''
+        Connect to the broker in the background, retrying with exponential
+        backoff (see :class:`connection.Connector` and
+        :class:`reactor.Reactor`).
+
+        Returns immediately, so MicroDrop startup does not wait for the
+        broker.
+        '''
+        keepalive = getattr(self, 'keepalive', 60)
+        if self.use_connection_hub:
+            self.hub = default_hub(self.host, self.port, keepalive,
+                                   reactor=self.reactor)
+            # Publish through the shared client.  Received messages are
+            # queued by `on_message` on the hub network thread, then handled
+            # on the dispatcher thread of this plugin.
+            self.mqtt_client = self.hub.client
+            self._hub_registration = \
+                self.hub.register(self.name, list(self.routes),
+                                  lambda msg: self.on_message(self.hub.client,
+                                                              None, msg),
+                                  on_connect=self.on_connect,
+                                  on_disconnect=self.on_disconnect,
+                                  dispatch=False)
+        elif self.reactor is not None:
+            self.reactor.add_client(self.mqtt_client, self.host, self.port,
+                                    keepalive, self._backoff)
+        else:
+            self.connector = Connector(self.mqtt_client, self.host,
+                                       self.port, keepalive, self._backoff)
+            self.connector.start()
+
+    def stop(self):
+        if self.hub is None:
+            # Leave the shared client of the hub running.
+            super(MqttPlugin, self).stop()
+        if self._outbox_timer is not None:
+            self.reactor.cancel(self._outbox_timer)
+        if self.outbox is not None:
+            self.outbox.stop()
+        if self.hub is not None:
+            self.hub.unregister(self._hub_registration)
+        elif self.reactor is not None:
+            self.reactor.remove_client(self.mqtt_client)
+        if self.connector is not None:
+            self.connector.stop()
+        self.dispatcher.stop()
+        if self.metrics_task is not None:
+            self.metrics_task.stop()
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
+        if self.recorder is not None:
+            self.recorder.close()
+
+    def _flush_outbox(self):
+        # Called on the reactor thread.  Messages stay in the outbox while
+        # the client socket has unsent data, so a slow broker connection
+        # pushes back on publishers rather than growing paho's buffers.
+        if not self.mqtt_client.want_write():
+            self.outbox.flush()
+        self._outbox_timer = self.reactor.call_later(self.publish_interval,
+                                                     self._flush_outbox)
+
     ###########################################################################
     # MicroDrop pyutilib plugin handlers
     # ==================================
     def on_connect(self, client, userdata, flags, rc):
-        self.mqtt_client.subscribe("microdrop/dmf-device-ui/change-step")
-        self.mqtt_client.subscribe("microdrop/dmf-device-ui/delete-step")
-        self.mqtt_client.subscribe("microdrop/dmf-device-ui/insert-step")
-        self.mqtt_client.subscribe("microdrop/dmf-device-ui/change-protocol-state")
-        self.mqtt_client.subscribe("microdrop/dmf-device-ui/change-repeat")
-        self.mqtt_client.subscribe("microdrop/data-controller/load-protocol")
+        if rc != 0:
+            logger.warning('Connection refused by broker (code %s).', rc)
+            return
+        self._backoff.reset()
+        self.metrics.increment('mqtt_plugin_connects_total')
+        if self.hub is None:
+            # The hub subscribes to the topics of all registered plugins.
+            self.mqtt_client.subscribe([(topic_filter, 0)
+                                        for topic_filter in self.routes])
+        with self._pending_lock:
+            while self._pending_publishes:
+                self.mqtt_client.publish(
+                    *self._pending_publishes.popitem(last=False)[1])
+            self._connected = True
+
+    def on_disconnect(self, client, userdata, rc):
+        # Reconnection is handled by `self.connector`.
+        self._connected = False
+        self.metrics.increment('mqtt_plugin_disconnects_total')
 
     def on_message(self, client, userdata, msg):
         '''
         Callback for when a ``PUBLISH`` message is received from the broker.
+
+        Messages on topics with a route in :attr:`routes` are queued for
+        :meth:`handle_message`; other messages are ignored.
+
+        Messages on :attr:`coalesced_topics` replace a pending message on the
+        same topic; the number of skipped messages per topic is available in
+        :attr:`coalesced_counts`.  Messages on :attr:`lossless_topics` are
+        never dropped due to overflow.
+        '''
+        if self.recorder is not None:
+            self.recorder.record(INBOUND, msg.topic, msg.payload, msg.qos,
+                                 msg.retain)
+        if self.routes.match(msg.topic):
+            metrics = self.topic_metrics(msg.topic)
+            metrics.received_messages.increment()
+            metrics.received_bytes.increment(len(msg.payload))
+            item = (msg, time.time())
+            if msg.topic in self.coalesced_topics:
+                self.message_queue.put(msg.topic, item, coalesce=True,
+                                       delay=self.coalesce_window)
+            else:
+                topic = parent_topic(msg.topic) or msg.topic
+                self.message_queue.put(msg.topic, item, droppable=topic not in
+                                       self.lossless_topics)
+
+    @property
+    def coalesced_counts(self):
+        '''
+        collections.Counter
+            Number of received messages skipped in favour of a more recent
+            message on the same topic, by topic.
+        '''
+        return self.message_queue.coalesced_by_key
+
+    @property
+    def protocol_cache_stats(self):
+        '''
+        dict
+            Protocol serialization cache ``hits`` and ``misses``, and number
+            of protocol publishes ``skipped`` since the same revision was
+            already published on the topic.
+        '''
+        return dict(self.protocol_cache.stats,
+                    skipped=self._skipped_publishes)
+
+    def _dispatch(self, item):
+        msg, received_time = item
+        metrics = self.topic_metrics(msg.topic)
+        self._sampled = metrics.sample()
+        if self._sampled:
+            metrics.latency('queue').observe(time.time() - received_time)
+        self._received_time = received_time
+        try:
+            self.profiler.call(self.handle_message, msg)
+        finally:
+            self._received_time = None
+            self._sampled = True
+
+    def handle_message(self, msg):
+        '''
+        Decode and handle a received message (called on the dispatcher
+        thread, in the order messages were received).
+
+        Chunks of a chunked transfer are reassembled; the payload is handled
+        as a message on the parent topic once all chunks are received.
         '''
-        if msg.topic == 'microdrop/dmf-device-ui/change-step':
-            self.change_step(json.loads(msg.payload))
-        if msg.topic == "microdrop/dmf-device-ui/delete-step":
-            self.delete_step(json.loads(msg.payload))
-        if msg.topic == "microdrop/dmf-device-ui/insert-step":
-            self.insert_step(json.loads(msg.payload))
-        if msg.topic == "microdrop/dmf-device-ui/change-protocol-state":
-            self.change_protocol_state(json.loads(msg.payload))
-        if msg.topic == "microdrop/dmf-device-ui/change-repeat":
-            self.change_protocol_repeat(json.loads(msg.payload))
-        if msg.topic == "microdrop/data-controller/load-protocol":
-            self.load_protocol(json.loads(msg.payload, object_hook=pandas_object_hook))
+        topic = parent_topic(msg.topic)
+        if topic is not None:
+            try:
+                payload = self.reassembler.add(topic, msg.payload)
+            except ValueError:
+                self.topic_metrics(topic).decode_errors.increment()
+                raise
+            if payload is None:
+                return
+            properties = getattr(msg, 'properties', None)
+            msg = ReplayMessage(topic, payload, msg.qos, msg.retain)
+            msg.properties = properties
+        codec = self.codecs.for_message(msg)
+        try:
+            raw_payload = decompress(msg.payload, self.max_decompressed_size)
+        except ValueError:
+            self.topic_metrics(msg.topic).decode_errors.increment()
+            raise
+        envelope = from_properties(msg)
+        if isinstance(codec, JsonCodec):
+            envelope_i, raw_payload = unwrap(raw_payload)
+            envelope = envelope or envelope_i
+        if msg.topic in self.correlated_events:
+            envelope = envelope or {}
+            cause = (msg.topic, envelope.get('seq'), envelope.get('ts'),
+                     self._received_time or time.time(), self._sampled)
+            for topic in self.correlated_events[msg.topic]:
+                self._causes[topic] = cause
+        for route in self.routes.match(msg.topic):
+            start = time.time()
+            try:
+                payload = getattr(self, route.decoder)(raw_payload, codec)
+            except Exception:
+                self.topic_metrics(msg.topic).decode_errors.increment()
+                raise
+            getattr(self, route.handler)(payload)
+            if self._sampled:
+                self.observe_latency(msg.topic, 'handler',
+                                     time.time() - start)
+
+    def decode_json(self, payload, codec=None):
+        return (codec or self.codecs.default).decode(payload)
+
+    def decode_optional_json(self, payload, codec=None):
+        # Empty payloads (e.g., control commands without options) are
+        # decoded as `None`.
+        if not payload or not payload.strip():
+            return None
+        return self.decode_json(payload, codec)
+
+    def decode_protocol(self, payload, codec=None):
+        '''
+        Returns
+        -------
+        microdrop.protocol.Protocol
+            Protocol decoded from :data:`payload`, or the protocol previously
+            decoded from an identical payload if it has not been modified
+            since (see :attr:`loaded_protocols`).
+        '''
+        digest = json_digest(payload)
+        protocol = self.loaded_protocols.get(digest)
+        if protocol is not None:
+            return protocol
+
+        # Deferred imports: pandas is only needed once a protocol is loaded.
+        from microdrop.protocol import protocol_from_dict
+
+        if codec is None or isinstance(codec, JsonCodec):
+            from zmq_plugin.schema import pandas_object_hook
+
+            from .protocol_stream import protocol_from_json
+
+            protocol = protocol_from_json(payload,
+                                          object_hook=pandas_object_hook)
+        else:
+            # Binary codecs decode pandas objects natively.
+            protocol = protocol_from_dict(codec.decode(payload))
+        # Serialized protocols carry no name; name the protocol as
+        # `on_protocol_swapped` would, so its revision (see
+        # `loaded_protocols`) does not change once it is activated.
+        if protocol.name is None:
+            protocol.name = "unnamed"
+        self.loaded_protocols.put(digest, protocol)
+        return protocol
+
+    def encode_payload(self, topic, obj):
+        '''
+        Encode :data:`obj` with the codec configured for :data:`topic`.
+        '''
+        return self.codecs.for_topic(topic).encode(obj)
+
+    def transcode_json(self, topic, payload, revision=None):
+        '''
+        Re-encode JSON :data:`payload` (e.g., a serialized protocol) if a
+        codec other than JSON is configured for :data:`topic`.
+
+        Pandas objects are decoded (see
+        :func:`zmq_plugin.schema.pandas_object_hook`), so binary codecs
+        encode them natively.  If protocol :data:`revision` is specified,
+        the payload is only re-encoded if another revision was transcoded
+        with the codec since (e.g., the same protocol published on several
+        topics).
+        '''
+        codec = self.codecs.for_topic(topic)
+        if isinstance(codec, JsonCodec):
+            return payload
+        if revision is not None:
+            cached_revision, encoded = self._transcoded.get(codec.name,
+                                                            (None, None))
+            if cached_revision == revision:
+                return encoded
+        from zmq_plugin.schema import pandas_object_hook
+
+        encoded = codec.encode(json.loads(payload,
+                                          object_hook=pandas_object_hook))
+        if revision is not None:
+            self._transcoded[codec.name] = (revision, encoded)
+        return encoded
+
+    def publish(self, topic, payload=None, qos=0, retain=False,
+                envelope=True):
+        '''
+        Publish message, compressing the payload if it is larger than
+        :attr:`compress_threshold`.
+
+        Unless :attr:`publish_interval` is ``None``, the message is queued
+        and published on the next flush of :attr:`outbox`.
+
+        If :data:`envelope` is ``False``, the payload is never wrapped in an
+        envelope (e.g., binary payloads, see :attr:`use_envelopes`).
+
+        Within a :meth:`transaction`, the message is published when the
+        transaction is committed.
+        '''
+        transaction = getattr(self._transactions, 'current', None)
+        if transaction is not None:
+            transaction.publish(topic, payload, qos, retain, envelope)
+            return
+        cause = self._pop_cause(topic) if self._causes else None
+        if envelope and self.use_envelopes and \
+                isinstance(self.codecs.for_topic(topic), JsonCodec):
+            header = {'seq': next(self._publish_sequence), 'ts': time.time()}
+            if cause is not None:
+                header['cause'] = {'topic': cause[0], 'seq': cause[1]}
+            payload = wrap('null' if payload is None else payload, header)
+        if self.compressor is not None:
+            payload = self.compressor.compress(payload)
+        if self.chunk_size is not None and topic in self.chunked_topics:
+            if payload is not None and len(payload) > self.chunk_size:
+                return self._publish_chunks(topic, payload, qos, retain)
+            elif retain and topic in self._chunk_counts:
+                # Clear retained chunks of the previous payload.
+                self._clear_chunks(topic, 0)
+        if self.outbox is not None:
+            self.outbox.put(topic, payload, qos, retain)
+        else:
+            return self._send(topic, payload, qos, retain)
+
+    @contextmanager
+    def transaction(self):
+        '''
+        Defer signals emitted through :meth:`_emit_signal` and messages
+        published by this plugin on the current thread (including in
+        response to signals emitted by MicroDrop) until the end of the
+        ``with`` block, e.g.::
+
+            with plugin.transaction():
+                plugin.batch_edit(operations)
+                plugin.change_protocol_repeat(3)
+
+        Each distinct deferred signal is then dispatched once, in order,
+        with the transaction still active, so the signals and messages
+        emitted by this plugin's handlers are deferred in turn.  Deferred
+        messages are published last (retained messages coalesced per topic).
+        Each signal is dispatched to every MicroDrop plugin, so several edits
+        cost a single round of signals.
+
+        Nested transactions are part of the outermost transaction.  If the
+        block raises an exception, deferred signals and messages are
+        discarded (with a warning).
+
+        Yields
+        ------
+        transaction.Transaction
+        '''
+        transaction = getattr(self._transactions, 'current', None)
+        if transaction is not None:
+            yield transaction
+            return
+        transaction = self._transactions.current = Transaction()
+        try:
+            yield transaction
+        except BaseException:
+            self._transactions.current = None
+            logger.warning('Transaction failed, discarded %d signal(s) and %d '
+                           'message(s).', len(transaction.signals),
+                           len(transaction.publishes))
+            raise
+        self._commit(transaction)
+
+    def _commit(self, transaction):
+        try:
+            signal = transaction.pop_signal()
+            while signal is not None:
+                emit_signal(*signal)
+                signal = transaction.pop_signal()
+        finally:
+            self._transactions.current = None
+            self.metrics.increment('mqtt_plugin_deduplicated_signals_total',
+                                   transaction.deduplicated_signals)
+            self.metrics.increment('mqtt_plugin_coalesced_publishes_total',
+                                   transaction.coalesced_publishes)
+            for message in transaction.publishes.values():
+                self.publish(*message)
+
+    def _emit_signal(self, function, args=None):
+        '''
+        Emit MicroDrop signal, or defer it to the end of the current
+        :meth:`transaction`, if any.
+        '''
+        transaction = getattr(self._transactions, 'current', None)
+        if transaction is not None:
+            transaction.emit_signal(function, args)
+        else:
+            emit_signal(function, args)
+
+    def _publish_chunks(self, topic, payload, qos, retain):
+        '''
+        Publish :data:`payload` in chunks of :attr:`chunk_size` bytes (see
+        :func:`chunking.split`).
+
+        Retained chunks of a previous (longer) payload are cleared, as is the
+        retained message on :data:`topic` itself the first time it is
+        published in chunks, so new subscribers only receive the chunks of
+        the latest payload.
+        '''
+        chunks = split(payload, self.chunk_size)
+        if retain and topic not in self._chunk_counts:
+            # Not in the bulk lane, so a later (small) retained payload on
+            # the topic replaces it rather than being cleared by it.
+            if self.outbox is not None:
+                self.outbox.put(topic, None, qos, retain)
+            else:
+                self._send(topic, None, qos, retain)
+        for index, chunk in enumerate(chunks):
+            self._publish_bulk(chunk_topic(topic, index), chunk, qos, retain)
+        if retain:
+            self._clear_chunks(topic, len(chunks))
+            self._chunk_counts[topic] = len(chunks)
+
+    def _clear_chunks(self, topic, count):
+        # Publish empty retained messages on chunk topics from `count` on.
+        for index in range(count, self._chunk_counts.pop(topic, 0)):
+            self._publish_bulk(chunk_topic(topic, index), None, 0, True)
+
+    def _publish_bulk(self, topic, payload, qos, retain):
+        if self.outbox is not None:
+            self.outbox.put(topic, payload, qos, retain, bulk=True)
+        else:
+            self._send(topic, payload, qos, retain)
+
+    def _send(self, topic, payload, qos, retain):
+        '''
+        Publish message to the broker.
+
+        Returns
+        -------
+        paho.mqtt.client.MQTTMessageInfo or None
+            Publish status (e.g., to wait for delivery using
+            :meth:`~paho.mqtt.client.MQTTMessageInfo.wait_for_publish`), or
+            ``None`` while not connected to the broker: the message is then
+            held (up to :attr:`publish_buffer_size` messages, a retained
+            message replacing the held retained message on the same topic)
+            and published once connected.
+        '''
+        if not self._connected:
+            with self._pending_lock:
+                if not self._connected:
+                    # Hold message until connected (see `on_connect`).
+                    key = (('retain', topic) if retain
+                           else next(self._pending_sequence))
+                    if (key not in self._pending_publishes and
+                            len(self._pending_publishes) >=
+                            self.publish_buffer_size):
+                        self._pending_publishes.popitem(last=False)
+                        self.dropped_publishes += 1
+                    self._pending_publishes[key] = (topic, payload, qos,
+                                                    retain)
+                    return None
+        info = self.mqtt_client.publish(topic, payload, qos=qos,
+                                        retain=retain)
+        if self.recorder is not None:
+            self.recorder.record(OUTBOUND, topic, payload, qos, retain)
+        metrics = self.topic_metrics(topic)
+        metrics.published_messages.increment()
+        if payload is not None and not isinstance(payload, (int, float)):
+            metrics.published_bytes.increment(len(payload))
+        if self.reactor is not None:
+            # Write without waiting for the reactor `select()` timeout.
+            self.reactor.wake()
+        return info
+
+    def _pop_cause(self, topic):
+        '''
+        Returns
+        -------
+        tuple or None
+            Command causing an event published on :data:`topic`, if any (see
+            :attr:`correlated_events`), recording the command-to-event
+            latency.
+        '''
+        cause = self._causes.pop(topic, None)
+        if cause is None:
+            return None
+        # Attribute each command to a single event.
+        for topic_i, cause_i in list(self._causes.items()):
+            if cause_i is cause:
+                self._causes.pop(topic_i, None)
+        command_topic, seq, origin_time, received_time, sampled = cause
+        now = time.time()
+        if now - received_time > self.correlation_timeout:
+            return None
+        if not sampled:
+            return cause
+        self.observe_latency(command_topic, 'event', now - received_time)
+        if origin_time is not None:
+            self.observe_latency(command_topic, 'end_to_end',
+                                 now - origin_time)
+        return cause
+
+    def topic_metrics(self, topic):
+        '''
+        Returns
+        -------
+        metrics.TopicMetrics
+            Counters and latency histograms of :data:`topic` in
+            :attr:`metrics`.  Chunks are accounted for under the topic of the
+            payload, and topics matching a wildcard route (e.g.,
+            ``microdrop/mqtt-plugin/+/sha1``) under the route filter, so any
+            number of topics maps to a bounded set of ``topic`` labels.
+        '''
+        metrics = self._topic_metrics.get(topic)
+        if metrics is None:
+            label = parent_topic(topic) or topic
+            filters = self._metric_filters.match(label)
+            if filters:
+                label = filters[0]
+            if len(self._topic_metrics) >= TopicTrie.cache_size:
+                self._topic_metrics.clear()
+            metrics = self._topic_metrics.setdefault(topic, TopicMetrics(
+                self.metrics, label,
+                sample_interval=self.latency_sample_interval))
+        return metrics
+
+    def observe_latency(self, topic, stage, seconds):
+        self.topic_metrics(topic).latency(stage).observe(seconds)
+
+    @property
+    def latency_stats(self):
+        '''
+        dict
+            Latency summary (see :meth:`metrics.Histogram.summary`) by
+            command topic and stage:
+
+             - ``queue``: from receipt to the start of handling;
+             - ``handler``: payload decoding and handler call;
+             - ``event``: from receipt to the publish of the resulting event
+               (see :attr:`correlated_events`);
+             - ``end_to_end``: from the origin timestamp of the command (see
+               :mod:`envelope`) to the publish of the resulting event.
+        '''
+        stats = {}
+        for labels, histogram in \
+                self.metrics.histograms('mqtt_plugin_latency_seconds'):
+            stats.setdefault(labels['topic'], {})[labels['stage']] = \
+                histogram.summary()
+        return stats
+
+    def _register_metrics(self):
+        metrics = self.metrics
+        metrics.describe('mqtt_plugin_latency_seconds',
+                         'Command handling latency, by stage.')
+        metrics.describe('mqtt_plugin_connects_total',
+                         'Connections established to the broker.')
+        metrics.gauge('mqtt_plugin_queue_depth', lambda: [
+            ({'queue': 'received'}, len(self.message_queue)),
+            ({'queue': 'outbox'},
+             None if self.outbox is None else len(self.outbox)),
+            ({'queue': 'unconnected'}, len(self._pending_publishes))])
+        metrics.gauge('mqtt_plugin_skipped_messages', lambda: [
+            ({'reason': 'coalesced'}, self.message_queue.coalesced),
+            ({'reason': 'dropped'}, self.message_queue.dropped),
+            ({'reason': 'unchanged_protocol'}, self._skipped_loads)])
+        metrics.gauge('mqtt_plugin_skipped_publishes', lambda: [
+            ({'reason': 'unconnected_dropped'}, self.dropped_publishes),
+            ({'reason': 'unchanged_protocol'}, self._skipped_publishes)] +
+            ([({'reason': 'outbox_' + key}, self.outbox.stats[key])
+              for key in ('coalesced', 'dropped')]
+             if self.outbox is not None else []))
+        metrics.gauge('mqtt_plugin_protocol_cache', lambda: [
+            ({'result': key}, value) for key, value in
+            self.protocol_cache.stats.items() if key in ('hits', 'misses')])
+        metrics.gauge('mqtt_plugin_compression_bytes', lambda: [] if
+                      self.compressor is None else [
+                          ({'direction': 'in'}, self.compressor.bytes_in),
+                          ({'direction': 'out'}, self.compressor.bytes_out)])
+
+    def publish_metrics(self):
+        if not self._connected:
+            # Metrics are periodic; do not let them crowd out messages held
+            # until the connection is established (see `_send`).
+            return
+        topic = 'microdrop/mqtt-plugin/metrics'
+        self.publish(topic, self.encode_payload(topic,
+                                                self.metrics.collect()))
+
+    def start_profile(self, options=None):
+        '''
+        Start profiling the handling of received messages (see
+        :class:`profiling.HandlerProfiler`).
+
+        Parameters
+        ----------
+        options : float or dict, optional
+            Capture duration in seconds (default:
+            :attr:`profile_duration`), or dictionary with ``duration``
+            and/or ``sample_rate`` (fraction of messages profiled) keys.
+
+        Once the capture is stopped (see :meth:`stop_profile`), the profile
+        is published (see :meth:`publish_profile`).
+        '''
+        if not isinstance(options, dict):
+            options = {} if options is None else {'duration': options}
+        duration = min(float(options.get('duration', self.profile_duration)),
+                       self.profile_max_duration)
+        sample_rate = float(options.get('sample_rate', 1.))
+        logger.info('Profiling message handling for %s s (sample rate: %s).',
+                    duration, sample_rate)
+        self.profiler.start(duration, sample_rate,
+                            on_stop=self.publish_profile)
+
+    def stop_profile(self, options=None):
+        stats = self.profiler.stop()
+        if stats is not None:
+            self.publish_profile(stats)
+
+    def publish_profile(self, stats):
+        '''
+        Write captured profile :data:`stats` as a :mod:`pstats` file to
+        :attr:`profile_directory`, then publish the file contents on
+        ``microdrop/mqtt-plugin/profile/stats`` and a summary (file path,
+        number of profiled messages and top functions by cumulative time) on
+        ``microdrop/mqtt-plugin/profile/summary``.
+        '''
+        import tempfile
+
+        data = dump_stats(stats)
+        directory = ph.path(self.profile_directory or tempfile.gettempdir())
+        path = directory.joinpath(time.strftime('mqtt_plugin-%Y%m%d-%H%M%S'
+                                                '.pstats'))
+        try:
+            path.write_bytes(data)
+        except (IOError, OSError):
+            logger.warning('Could not write profile to `%s`.', path,
+                           exc_info=True)
+            path = None
+        self.publish('microdrop/mqtt-plugin/profile/stats', data,
+                     envelope=False)
+        topic = 'microdrop/mqtt-plugin/profile/summary'
+        self.publish(topic, self.encode_payload(topic, {
+            'path': path, 'started': self.profiler.started,
+            'sampled': self.profiler.sampled,
+            'skipped': self.profiler.skipped, 'top': summarize(stats)}))
+
+    @property
+    def compression_stats(self):
+        '''
+        dict or None
+            See :attr:`compression.Compressor.stats`.
+        '''
+        return None if self.compressor is None else self.compressor.stats
+
+    @property
+    def outbox_stats(self):
+        '''
+        dict or None
+            See :attr:`outbound.Outbox.stats`.
+        '''
+        return None if self.outbox is None else self.outbox.stats
 
     def on_plugin_disable(self):
         """
@@ -76,23 +1078,52 @@ class MqttPlugin(pmh.BaseMqttReactor, Plugin):
         """
         # TODO: When converting Protocol Controller to plugin, switch to
         #       having on_protocol_pause execute on pluign enabled
-        self.mqtt_client.publish("microdrop/mqtt-plugin/protocol-state",
-                                 json.dumps("paused"), retain=True)
+        self.publish_state("paused")
 
     def on_protocol_run(self):
-        self.mqtt_client.publish("microdrop/mqtt-plugin/protocol-state",
-                                 json.dumps("running"), retain=True)
+        self.publish_state("running")
 
     def on_protocol_pause(self):
-        self.mqtt_client.publish("microdrop/mqtt-plugin/protocol-state",
-                                 json.dumps("paused"), retain=True)
+        self.publish_state("paused")
+
+    def publish_state(self, state):
+        topic = "microdrop/mqtt-plugin/protocol-state"
+        self.publish(topic, self.encode_payload(topic, state), retain=True)
 
     def on_step_swapped(self, old_step_number, step_number):
         """
         Called when protocol controller swaps steps
         """
-        self.mqtt_client.publish("microdrop/mqtt-plugin/step-swapped",
-                     json.dumps(step_number), retain=True)
+        # Plugins save the options of the step being left (and may update
+        # the new step) on a step swap.
+        self.invalidate_steps([old_step_number, step_number])
+        topic = "microdrop/mqtt-plugin/step-swapped"
+        self.publish(topic, self.encode_payload(topic, step_number),
+                     retain=True)
+
+    def on_step_options_changed(self, plugin, step_number):
+        self.invalidate_steps([step_number])
+
+    def on_step_removed(self, step_number, step):
+        self.step_fragments.invalidate(step)
+
+    def invalidate_steps(self, step_numbers):
+        '''
+        Drop cached serialized fragments of the specified protocol steps.
+
+        .. note::
+            Steps added by :meth:`insert_step` are new objects, and steps
+            removed by :meth:`delete_step` are dropped through
+            :meth:`on_step_removed`, so only steps modified in place need to
+            be invalidated.
+        '''
+        app = get_app()
+        for step_number in step_numbers:
+            try:
+                self.step_fragments.invalidate(app.protocol.steps[step_number])
+            except (AttributeError, IndexError, TypeError):
+                # No protocol loaded or step no longer exists.
+                pass
 
     def change_step(self,step_number):
         app = get_app()
@@ -106,8 +1137,73 @@ class MqttPlugin(pmh.BaseMqttReactor, Plugin):
         app = get_app()
         app.protocol.insert_step(step_number)
         app.protocol.next_step()
-        self.mqtt_client.publish("microdrop/mqtt-plugin/step-inserted",
-                                 json.dumps(app.protocol.current_step_number))
+        topic = "microdrop/mqtt-plugin/step-inserted"
+        self.publish(topic, self.encode_payload(
+            topic, app.protocol.current_step_number))
+
+    def batch_edit(self, operations):
+        '''
+        Insert, delete and move protocol steps in one go.
+
+        All operations are applied to the protocol at once, followed by a
+        single ``on_protocol_changed`` signal (i.e., a single protocol
+        publish), rather than one round trip per step.
+
+        As for single step edits, ``on_step_removed`` is emitted for each
+        removed step (by original index, last first).  New steps are
+        announced by a single ``on_steps_inserted`` signal with the list of
+        their final indices (so plugins may fill in their defaults), rather
+        than one ``on_step_created`` signal per step, each of which would
+        have MicroDrop refresh the whole protocol grid.  ``on_step_swapped``
+        is emitted once for the current step, which follows its step object
+        if the step was kept (otherwise, the current step number is kept,
+        within range).
+
+        Parameters
+        ----------
+        operations : list
+            Ordered list of operations (see :mod:`batch_edit`).
+
+        Raises
+        ------
+        ValueError
+            If any operation is invalid; the protocol is left unchanged.
+        '''
+        from microdrop.protocol import Step
+
+        app = get_app()
+        protocol = app.protocol
+        steps, removed = apply_edits(protocol.steps, operations, Step)
+        if not steps:
+            # A protocol always has at least one step.
+            steps.append(Step())
+        original_steps = list(protocol.steps)
+        original_step_number = protocol.current_step_number
+        current_step = original_steps[original_step_number]
+        original_ids = set(id(step) for step in original_steps)
+        step_ids = set(id(step) for step in steps)
+        with self.transaction():
+            protocol.steps[:] = steps
+            for step in removed:
+                self.step_fragments.invalidate(step)
+            for step_number in reversed(range(len(original_steps))):
+                step = original_steps[step_number]
+                if id(step) not in step_ids:
+                    self._emit_signal("on_step_removed", [step_number, step])
+            inserted = [step_number for step_number, step in enumerate(steps)
+                        if id(step) not in original_ids]
+            if inserted:
+                self._emit_signal("on_steps_inserted", [inserted])
+            if id(current_step) in step_ids:
+                step_number = [id(step) for step in steps].index(
+                    id(current_step))
+            else:
+                step_number = min(original_step_number, len(steps) - 1)
+            protocol.current_step_number = step_number
+            self._emit_signal("on_step_swapped",
+                              [original_step_number, step_number])
+            app.protocol_controller.modified = True
+            self._emit_signal("on_protocol_changed")
 
     def change_protocol_state(self, step):
         # TODO: Think about turning protocol controller into its own plugin
@@ -116,23 +1212,74 @@ class MqttPlugin(pmh.BaseMqttReactor, Plugin):
         if app.running:
             app.protocol.current_step_attempt = 0
             app.running = False
-            emit_signal("on_run_protocol", [None, None])
+            self._emit_signal("on_run_protocol", [None, None])
         else:
-            emit_signal("on_run_protocol", [None, None])
+            self._emit_signal("on_run_protocol", [None, None])
 
     def change_protocol_repeat(self, val):
         # XXX: Manually updating gtk text entry:
         app = get_app()
         text_entry = app.protocol_controller.textentry_protocol_repeats
         text_entry.set_text(str(val))
-        emit_signal("on_protocol_repeats_changed")
+        self._emit_signal("on_protocol_repeats_changed")
 
-    def load_protocol(self, protocol_dict):
+    def load_protocol(self, protocol):
+        '''
+        Parameters
+        ----------
+        protocol : microdrop.protocol.Protocol or dict
+            Protocol to activate, or protocol dictionary as accepted by
+            :func:`microdrop.protocol.protocol_from_dict`.
+        '''
         app = get_app()
-        protocol = protocol_from_dict(protocol_dict)
-        app.protocol_controller.modified = True
-        emit_signal("on_protocol_changed")
-        app.protocol_controller.activate_protocol(protocol)
+        if isinstance(protocol, dict):
+            from microdrop.protocol import protocol_from_dict
+
+            protocol = protocol_from_dict(protocol)
+        elif protocol is app.protocol:
+            # Same payload as the active (unmodified) protocol, e.g., re-sent
+            # after a UI reconnect (see `decode_protocol`).
+            self._skipped_loads += 1
+            return
+        # `on_protocol_changed` is emitted once the protocol is activated, so
+        # the new protocol is published once, rather than the old protocol
+        # and then the new one.
+        with self.transaction():
+            app.protocol_controller.modified = True
+            self._emit_signal("on_protocol_changed")
+            app.protocol_controller.activate_protocol(protocol)
+
+    def load_protocol_by_hash(self, digest):
+        '''
+        Activate a protocol by digest, without transferring it again.
+
+        Parameters
+        ----------
+        digest : str or dict
+            SHA1 digest of a protocol payload previously received on
+            ``microdrop/data-controller/load-protocol``, or of a snapshot
+            published on ``microdrop/mqtt-plugin/protocol-changed`` or
+            ``protocol-swapped`` (see ``<topic>/sha1``); or a ``{"sha1":
+            ...}`` dictionary.
+
+        Returns
+        -------
+        bool
+            ``True`` if a protocol with :data:`digest` was found, either among
+            recently loaded protocols or in :attr:`snapshot_store`.
+        '''
+        if isinstance(digest, dict):
+            digest = digest.get('sha1')
+        protocol = self.loaded_protocols.get(digest)
+        if protocol is None and self.snapshot_store is not None:
+            protocol_json = self.snapshot_store.get_by_digest(digest)
+            if protocol_json is not None:
+                protocol = self.decode_protocol(protocol_json)
+        if protocol is None:
+            logger.warning('No protocol with digest `%s` to load.', digest)
+            return False
+        self.load_protocol(protocol)
+        return True
 
     def on_protocol_repeats_changed(self):
         # TODO: Make this event triggered by microdrop (or implement)
@@ -140,7 +1287,7 @@ class MqttPlugin(pmh.BaseMqttReactor, Plugin):
         app = get_app()
         text_entry = app.protocol_controller.textentry_protocol_repeats
         val = text_entry.get_text()
-        self.mqtt_client.publish("microdrop/mqtt-plugin/protocol-repeats-changed",val)
+        self.publish("microdrop/mqtt-plugin/protocol-repeats-changed",val)
 
     def on_protocol_changed(self):
         app = get_app()
@@ -149,14 +1296,103 @@ class MqttPlugin(pmh.BaseMqttReactor, Plugin):
         if app.protocol.name is None:
             app.protocol.name = "unnamed"
 
-        self.mqtt_client.publish("microdrop/mqtt-plugin/protocol-changed",
-                                 app.protocol.to_json(), retain=True)
+        topic = "microdrop/mqtt-plugin/protocol-changed"
+        # `on_protocol_changed` may follow step edits made without a step
+        # signal, so steps are hashed again rather than trusting cached
+        # digests (hashing is much cheaper than encoding the steps).
+        self.step_fragments.refresh(app.protocol)
+        revision, protocol_json = self.protocol_cache.to_json(app.protocol)
+        if not self._update_revision(topic, revision):
+            return
+        delta = self.protocol_deltas.delta(protocol_json)
+        if delta is not None:
+            self.publish_protocol_delta(delta)
+        else:
+            self.publish_protocol_snapshot(topic, protocol_json, revision)
 
     def on_protocol_swapped(self, old_protocol, protocol):
         if protocol.name is None:
             protocol.name = "unnamed"
 
-        self.mqtt_client.publish("microdrop/mqtt-plugin/protocol-swapped",
-                                 protocol.to_json(), retain=True)
+        topic = "microdrop/mqtt-plugin/protocol-swapped"
+        revision, protocol_json = self.protocol_cache.to_json(protocol)
+        if self._update_revision(topic, revision):
+            self.publish_protocol_snapshot(topic, protocol_json, revision)
+
+    def _update_revision(self, topic, revision):
+        '''
+        Returns
+        -------
+        bool
+            ``False`` if protocol :data:`revision` was already the last
+            revision published on :data:`topic`, i.e., publishing may be
+            skipped.
+        '''
+        if revision is not None and \
+                self._published_revisions.get(topic) == revision:
+            self._skipped_publishes += 1
+            return False
+        self._published_revisions[topic] = revision
+        return True
+
+    def update_retained_digest(self, digest_info):
+        '''
+        Record the digest of the protocol snapshot retained by the broker on
+        a topic (received on ``<topic>/sha1``, see
+        :meth:`publish_protocol_snapshot`).
+        '''
+        if isinstance(digest_info, dict) and 'topic' in digest_info:
+            self._retained_digests[digest_info['topic']] = \
+                digest_info.get('sha1')
+
+    def publish_protocol_snapshot(self, topic, protocol_json, revision=None):
+        '''
+        Publish full protocol as retained message, along with its digest: a
+        retained ``{"topic", "sha1", "revision"}`` message on
+        ``<topic>/sha1``, where ``sha1`` is the digest of the JSON-encoded
+        protocol.  Clients may check the digest against their own cache
+        before fetching the (retained) protocol.
+
+        Since the plugin subscribes to the digest topics, it learns which
+        snapshot the broker retains (e.g., from before MicroDrop was
+        restarted), and the protocol is not transmitted again if it is
+        unchanged.
+
+        If :attr:`protocol_snapshot_interval` is set, subsequent protocol
+        changes are published as patches against the latest snapshot on
+        ``microdrop/mqtt-plugin/protocol-changed``, starting with an empty
+        patch (which replaces the retained delta of the previous snapshot).
+        Snapshots on other topics (e.g., ``protocol-swapped``) leave the base
+        of the patches unchanged, since subscribers apply patches to the
+        retained ``protocol-changed`` snapshot.
+        '''
+        digest = None
+        if self.snapshot_store is not None and revision is not None:
+            digest = self.snapshot_store.digest(revision)
+        if digest is None:
+            digest = json_digest(protocol_json)
+        if self._retained_digests.get(topic) == digest:
+            self._skipped_publishes += 1
+        else:
+            self.publish(topic, self.transcode_json(topic, protocol_json,
+                                                    revision), retain=True)
+            digest_topic = topic + '/sha1'
+            self.publish(digest_topic, self.encode_payload(
+                digest_topic, {'topic': topic, 'sha1': digest,
+                               'revision': revision}), retain=True)
+            self._retained_digests[topic] = digest
+        if topic != "microdrop/mqtt-plugin/protocol-changed":
+            return
+        delta = self.protocol_deltas.snapshot(protocol_json)
+        if self.protocol_snapshot_interval:
+            self.publish_protocol_delta(delta)
+
+    def publish_protocol_delta(self, delta):
+        topic = "microdrop/mqtt-plugin/protocol-delta"
+        self.publish(topic, self.transcode_json(topic, delta), retain=True)
 
 PluginGlobals.pop_env()
+
+if _version is None and sys.version_info < (3, 7):
+    # Python 2 re-fetches the module from `sys.modules` once it is executed.
+    sys.modules[__name__] = _LazyVersionModule(sys.modules[__name__])
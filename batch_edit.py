@@ -0,0 +1,87 @@
+'''
+Batch edits of the steps of a protocol.
+
+A batch is an ordered list of operations, each a dictionary with an ``op``
+key:
+
+ - ``{"op": "insert", "index": i, "count": n, "copy": j}``: insert ``n``
+   steps (default: 1) before step ``i``; new steps are copies of step ``j``
+   if ``copy`` is set (as of before the insertion), and empty steps
+   otherwise;
+ - ``{"op": "delete", "index": i, "count": n}``: delete ``n`` steps
+   (default: 1) starting at step ``i``;
+ - ``{"op": "move", "index": i, "to": j}``: move step ``i`` so it ends up at
+   index ``j``.
+
+Indices refer to the step list as left by the previous operations.
+'''
+import copy
+
+
+def _index(operation, key, size, default=None):
+    value = operation.get(key, default)
+    if isinstance(value, bool) or not isinstance(value, int) or \
+            not 0 <= value < size:
+        raise ValueError('Invalid `%s` in %s (%d steps).' %
+                         (key, operation, size))
+    return value
+
+
+def apply_edits(steps, operations, new_step):
+    '''
+    Parameters
+    ----------
+    steps : list
+        Protocol steps (left unchanged).
+    operations : list
+        Operations, in order (see module documentation).
+    new_step : function
+        Returns a new, empty step.
+
+    Returns
+    -------
+    tuple
+        ``(steps, removed)``: edited list of steps and list of removed steps.
+
+    Raises
+    ------
+    ValueError
+        If any operation is invalid; no operation is applied.
+    '''
+    if not isinstance(operations, list):
+        raise ValueError('Expected a list of operations, got `%s`.' %
+                         type(operations).__name__)
+    steps = list(steps)
+    removed = []
+    for operation in operations:
+        if not isinstance(operation, dict):
+            raise ValueError('Invalid operation: `%s`.' % (operation, ))
+        op = operation.get('op')
+        count = operation.get('count', 1)
+        if op in ('insert', 'delete') and \
+                (isinstance(count, bool) or not isinstance(count, int) or
+                 count < 1):
+            raise ValueError('Invalid `count` in %s.' % operation)
+        if op == 'insert':
+            # Steps may be appended after the last step.
+            index = _index(operation, 'index', len(steps) + 1)
+            if operation.get('copy') is None:
+                inserted = [new_step() for i in range(count)]
+            else:
+                source = steps[_index(operation, 'copy', len(steps))]
+                inserted = [copy.deepcopy(source) for i in range(count)]
+            steps[index:index] = inserted
+        elif op == 'delete':
+            index = _index(operation, 'index', len(steps))
+            if index + count > len(steps):
+                raise ValueError('Invalid `count` in %s (%d steps).' %
+                                 (operation, len(steps)))
+            removed.extend(steps[index:index + count])
+            del steps[index:index + count]
+        elif op == 'move':
+            index = _index(operation, 'index', len(steps))
+            to = _index(operation, 'to', len(steps))
+            steps.insert(to, steps.pop(index))
+        else:
+            raise ValueError('Unknown operation: `%s`.' % (op, ))
+    return steps, removed
@@ -0,0 +1,42 @@
+'''
+Helpers shared by the benchmark scripts.
+'''
+import imp
+import importlib
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+#: Name of the namespace the plugin modules are loaded in (see
+#: :func:`load_module`).
+PACKAGE = '_mqtt_plugin_modules'
+
+
+def load_module(name):
+    '''
+    Load a module of the plugin (e.g., ``topics``) without executing the
+    plugin package ``__init__`` (which requires a running MicroDrop).
+    '''
+    if PACKAGE not in sys.modules:
+        package = imp.new_module(PACKAGE)
+        package.__path__ = [ROOT]
+        sys.modules[PACKAGE] = package
+    return importlib.import_module('%s.%s' % (PACKAGE, name))
+
+
+def peak_rss_mb():
+    '''
+    Returns
+    -------
+    float
+        Peak resident set size of the current process, in MiB.
+    '''
+    try:
+        import resource
+    except ImportError:
+        import psutil
+
+        return psutil.Process().memory_info().peak_wset / float(1 << 20)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # `ru_maxrss` is in bytes on macOS and in KiB elsewhere.
+    return peak / float(1 << 20 if sys.platform == 'darwin' else 1 << 10)
@@ -0,0 +1,78 @@
+'''
+Encode/decode time and payload size of the payload codecs.
+
+Protocols are read from MicroDrop protocol files if given, otherwise a
+synthetic protocol is used (see :mod:`bench_load_protocol`).  Codecs whose
+package is not installed are skipped.
+
+Usage::
+
+    python benchmarks/bench_codecs.py [PROTOCOL_FILE ...]
+'''
+from __future__ import print_function
+import argparse
+import os
+import timeit
+
+from _common import load_module
+
+
+def load_protocols(paths):
+    '''
+    Returns
+    -------
+    list
+        ``(label, protocol_object)`` pairs, where ``protocol_object`` is the
+        decoded ``load-protocol`` message content (with pandas objects).
+    '''
+    import json
+
+    from zmq_plugin.schema import pandas_object_hook
+
+    if paths:
+        from microdrop.protocol import Protocol
+
+        protocols_json = [(os.path.basename(path_i),
+                           Protocol.load(path_i).to_json())
+                          for path_i in paths]
+    else:
+        from bench_load_protocol import synthetic_protocol
+
+        protocols_json = [('synthetic-1k', synthetic_protocol(1000))]
+    return [(label_i, json.loads(protocol_json_i,
+                                 object_hook=pandas_object_hook))
+            for label_i, protocol_json_i in protocols_json]
+
+
+def main(paths, repeat):
+    from zmq_plugin.schema import PandasJsonEncoder, pandas_object_hook
+
+    payload_codecs = load_module('payload_codecs')
+    codecs = [payload_codecs.JsonCodec(PandasJsonEncoder, pandas_object_hook)]
+    for codec_cls in (payload_codecs.MsgpackCodec, payload_codecs.CborCodec):
+        try:
+            codecs.append(codec_cls())
+        except ImportError as exception:
+            print('Skipping %s codec: %s' % (codec_cls.name, exception))
+
+    print('%-24s %-8s %12s %12s %12s' % ('protocol', 'codec', 'bytes',
+                                         'encode ms', 'decode ms'))
+    for label, protocol in load_protocols(paths):
+        for codec in codecs:
+            payload = codec.encode(protocol)
+            encode_time = min(timeit.repeat(lambda: codec.encode(protocol),
+                                            number=1, repeat=repeat))
+            decode_time = min(timeit.repeat(lambda: codec.decode(payload),
+                                            number=1, repeat=repeat))
+            print('%-24s %-8s %12d %12.1f %12.1f' %
+                  (label, codec.name, len(payload), 1e3 * encode_time,
+                   1e3 * decode_time))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip()
+                                     .splitlines()[0])
+    parser.add_argument('protocol_file', nargs='*')
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    args = parser.parse_args()
+    main(args.protocol_file, args.repeat)
@@ -0,0 +1,140 @@
+'''
+Micro-benchmark of ``MqttPlugin.on_message`` topic dispatch.
+
+Compares the original chain of independent ``if`` statements against the
+:class:`TopicTrie` lookup used by :attr:`MqttPlugin.routes`, for handled
+topics and for unhandled traffic, with the original six routes and with the
+current routes of the plugin (including wildcard filters).
+
+With only six literal routes, the ``if`` chain is slightly faster than the
+trie (a Python call per message); the trie lookup costs the same whatever
+the number of routes, while the chain grows with each route.
+
+Usage::
+
+    python benchmarks/bench_dispatch.py [-n COUNT]
+'''
+from __future__ import print_function
+import argparse
+import timeit
+
+from _common import load_module
+
+topics = load_module('topics')
+
+TOPICS = ['microdrop/dmf-device-ui/change-step',
+          'microdrop/dmf-device-ui/delete-step',
+          'microdrop/dmf-device-ui/insert-step',
+          'microdrop/dmf-device-ui/change-protocol-state',
+          'microdrop/dmf-device-ui/change-repeat',
+          'microdrop/data-controller/load-protocol']
+UNHANDLED = ['microdrop/dmf-device-ui/device-swapped',
+             'microdrop/electrode-controller-plugin/set-electrode-states',
+             'microdrop/droplet-planning-plugin/routes-set']
+
+
+class Message(object):
+    def __init__(self, topic):
+        self.topic = topic
+        self.payload = '0'
+
+
+def handler(payload):
+    pass
+
+
+def if_chain(msg):
+    if msg.topic == 'microdrop/dmf-device-ui/change-step':
+        handler(msg.payload)
+    if msg.topic == "microdrop/dmf-device-ui/delete-step":
+        handler(msg.payload)
+    if msg.topic == "microdrop/dmf-device-ui/insert-step":
+        handler(msg.payload)
+    if msg.topic == "microdrop/dmf-device-ui/change-protocol-state":
+        handler(msg.payload)
+    if msg.topic == "microdrop/dmf-device-ui/change-repeat":
+        handler(msg.payload)
+    if msg.topic == "microdrop/data-controller/load-protocol":
+        handler(msg.payload)
+
+
+#: Routes of the current plugin (see `MqttPlugin.routes`).
+CURRENT_TOPICS = TOPICS + [
+    'microdrop/dmf-device-ui/batch-edit',
+    'microdrop/data-controller/load-protocol/chunks/+',
+    'microdrop/data-controller/load-protocol-by-hash',
+    'microdrop/mqtt-plugin/profile/start',
+    'microdrop/mqtt-plugin/profile/stop',
+    'microdrop/mqtt-plugin/+/sha1']
+
+
+def if_chain_current(msg):
+    topic = msg.topic
+    if topic == 'microdrop/dmf-device-ui/change-step':
+        handler(msg.payload)
+    if topic == "microdrop/dmf-device-ui/delete-step":
+        handler(msg.payload)
+    if topic == "microdrop/dmf-device-ui/insert-step":
+        handler(msg.payload)
+    if topic == "microdrop/dmf-device-ui/batch-edit":
+        handler(msg.payload)
+    if topic == "microdrop/dmf-device-ui/change-protocol-state":
+        handler(msg.payload)
+    if topic == "microdrop/dmf-device-ui/change-repeat":
+        handler(msg.payload)
+    if topic == "microdrop/data-controller/load-protocol":
+        handler(msg.payload)
+    if topic.startswith("microdrop/data-controller/load-protocol/chunks/"):
+        handler(msg.payload)
+    if topic == "microdrop/data-controller/load-protocol-by-hash":
+        handler(msg.payload)
+    if topic == "microdrop/mqtt-plugin/profile/start":
+        handler(msg.payload)
+    if topic == "microdrop/mqtt-plugin/profile/stop":
+        handler(msg.payload)
+    if (topic.startswith("microdrop/mqtt-plugin/") and
+            topic.endswith("/sha1") and topic.count('/') == 3):
+        handler(msg.payload)
+
+
+routes = topics.TopicTrie([(topic, handler) for topic in TOPICS])
+current_routes = topics.TopicTrie([(topic, handler)
+                                   for topic in CURRENT_TOPICS])
+
+
+def trie(msg):
+    for handler_i in routes.match(msg.topic):
+        handler_i(msg.payload)
+
+
+def trie_current(msg):
+    for handler_i in current_routes.match(msg.topic):
+        handler_i(msg.payload)
+
+
+def rate(function, messages, count):
+    def run():
+        for msg in messages:
+            function(msg)
+    seconds = min(timeit.repeat(run, number=count, repeat=5))
+    return count * len(messages) / seconds
+
+
+def main(count):
+    handled = [Message(topic) for topic in TOPICS]
+    unhandled = [Message(topic) for topic in UNHANDLED]
+    print('%-12s %-14s %15s' % ('traffic', 'dispatch', 'messages/s'))
+    for label, messages in (('handled', handled), ('unhandled', unhandled)):
+        for name, function in (('if-chain', if_chain), ('trie', trie),
+                               ('if-chain (12)', if_chain_current),
+                               ('trie (12)', trie_current)):
+            print('%-12s %-14s %15.0f' % (label, name,
+                                           rate(function, messages, count)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip()
+                                     .splitlines()[0])
+    parser.add_argument('-n', '--count', type=int, default=20000)
+    args = parser.parse_args()
+    main(args.count)
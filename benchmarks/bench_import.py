@@ -0,0 +1,146 @@
+'''
+Time to import the plugin package, and number of subprocesses spawned.
+
+Each case imports the plugin in a fresh process, as MicroDrop does on
+startup, then reads ``MqttPlugin.version``:
+
+ - ``source``: plugin in a git checkout (version resolved by versioneer,
+   which runs ``git``);
+ - ``packaged``: plugin with a ``properties.yml`` providing the version.
+
+Modules listed in :data:`DEFERRED` must not be loaded by the import.  On
+Python 3.7+, the modules with the highest import cost (as reported by
+``python -X importtime``) are also listed.
+
+With ``--budget``, exits with a non-zero status if the ``packaged`` import
+takes longer than the budget or loads a deferred module.
+
+Usage::
+
+    python benchmarks/bench_import.py [--repeat 5] [--budget 50]
+'''
+from __future__ import print_function
+import argparse
+import json
+import re
+import subprocess
+import sys
+import time
+
+#: Modules only needed once a handler runs (e.g., ``load-protocol``).
+DEFERRED = ['microdrop.protocol', 'numpy', 'pandas', 'zmq_plugin.schema']
+#: Written to stderr before the plugin is imported, to delimit the
+#: ``-X importtime`` report.
+MARKER = '--- import mqtt_plugin ---'
+CAN_IMPORTTIME = sys.version_info >= (3, 7)
+
+
+def run_case(case):
+    spawned = []
+    popen_init = subprocess.Popen.__init__
+
+    def counting_init(self, args, *args_, **kwargs):
+        spawned.append(args)
+        popen_init(self, args, *args_, **kwargs)
+
+    subprocess.Popen.__init__ = counting_init
+
+    # Import dependencies loaded by MicroDrop before any plugin.
+    import microdrop.plugin_manager
+
+    from harness import load_plugin
+
+    loaded = set(sys.modules)
+    print(MARKER, file=sys.stderr)
+    start = time.time()
+    mqtt_plugin = load_plugin(version='0.0.0' if case == 'packaged'
+                              else None)
+    import_seconds = time.time() - start
+    import_spawned = len(spawned)
+    deferred = sorted(name for name in set(sys.modules) - loaded
+                      if any(name == module or name.startswith(module + '.')
+                             for module in DEFERRED))
+    print(MARKER, file=sys.stderr)
+    start = time.time()
+    mqtt_plugin.MqttPlugin.version
+    version_seconds = time.time() - start
+    print(json.dumps({'import_seconds': import_seconds,
+                      'import_spawned': import_spawned,
+                      'deferred_loaded': deferred,
+                      'version_seconds': version_seconds,
+                      'version_spawned': len(spawned) - import_spawned}))
+
+
+def import_costs(stderr):
+    '''
+    Returns
+    -------
+    list
+        ``(self_us, module)`` for each module imported along with the plugin,
+        parsed from ``-X importtime`` output.
+    '''
+    lines = stderr.splitlines()
+    start = lines.index(MARKER) + 1
+    end = lines.index(MARKER, start)
+    costs = []
+    for line in lines[start:end]:
+        match = re.match(r'import time:\s+(\d+) \|\s+\d+ \|(\s*)(\S+)', line)
+        if match:
+            costs.append((int(match.group(1)), match.group(3)))
+    return costs
+
+
+def main(repeat, budget_ms=None, top=10):
+    print('%10s %12s %8s %12s %8s' % ('case', 'import ms', 'spawned',
+                                      'version ms', 'spawned'))
+    failures = []
+    for case in ('source', 'packaged'):
+        results = []
+        for i in range(repeat):
+            output = subprocess.check_output([sys.executable, __file__,
+                                              '--case', case])
+            results.append(json.loads(output.decode('utf8')
+                                      .splitlines()[-1]))
+        # Best of `repeat` runs, to limit the effect of a cold disk cache.
+        best = min(results, key=lambda result: result['import_seconds'])
+        print('%10s %12.1f %8d %12.1f %8d' %
+              (case, 1e3 * best['import_seconds'], best['import_spawned'],
+               1e3 * best['version_seconds'], best['version_spawned']))
+        if best['deferred_loaded']:
+            failures.append('%s: imported %s' %
+                            (case, ', '.join(best['deferred_loaded'])))
+        if (case == 'packaged' and budget_ms is not None and
+                1e3 * best['import_seconds'] > budget_ms):
+            failures.append('%s: import took %.1f ms (budget: %.1f ms)' %
+                            (case, 1e3 * best['import_seconds'], budget_ms))
+
+    if CAN_IMPORTTIME:
+        process = subprocess.Popen([sys.executable, '-X', 'importtime',
+                                    __file__, '--case', 'packaged'],
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        stdout, stderr = process.communicate()
+        costs = import_costs(stderr.decode('utf8'))
+        print('\nModules imported with the plugin: %d (%.1f ms total)' %
+              (len(costs), 1e-3 * sum(cost for cost, module in costs)))
+        for cost, module in sorted(costs, reverse=True)[:top]:
+            print('%10.1f ms  %s' % (1e-3 * cost, module))
+
+    for failure in failures:
+        print('FAIL %s' % failure)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip()
+                                     .splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--budget', type=float, metavar='MS',
+                        help='Maximum import time of the packaged plugin.')
+    parser.add_argument('--case', choices=['source', 'packaged'],
+                        help='Run a single case (used internally).')
+    args = parser.parse_args()
+    if args.case:
+        run_case(args.case)
+    else:
+        sys.exit(main(args.repeat, args.budget))
@@ -0,0 +1,98 @@
+'''
+Latency and peak memory of decoding a ``load-protocol`` payload.
+
+Compares ``json.loads`` followed by ``protocol_from_dict`` (``full``) against
+the incremental :func:`protocol_from_json` decoder (``stream``) on synthetic
+protocols.  Each case runs in a separate process so peak RSS is measured in
+isolation.
+
+Usage::
+
+    python benchmarks/bench_load_protocol.py [--steps 1000 10000 50000]
+'''
+from __future__ import print_function
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+from _common import load_module, peak_rss_mb
+
+N_ELECTRODES = 120
+KEYS = [['dmf_control_board_plugin', 'duration'],
+        ['dmf_control_board_plugin', 'frequency'],
+        ['dmf_control_board_plugin', 'voltage'],
+        ['droplet_planning_plugin', 'transition_duration_ms'],
+        ['electrode_controller_plugin', 'electrode_states']]
+
+
+def synthetic_protocol(step_count):
+    '''
+    Returns
+    -------
+    str
+        JSON-encoded protocol with :data:`step_count` steps, each with a
+        per-electrode data frame of actuation states.
+    '''
+    import pandas as pd
+    from zmq_plugin.schema import PandasJsonEncoder
+
+    electrode_states = pd.DataFrame({'state': [i % 2 for i in
+                                               range(N_ELECTRODES)]},
+                                    index=pd.Index(['electrode%03d' % i
+                                                    for i in
+                                                    range(N_ELECTRODES)],
+                                                   name='electrode_id'))
+    step = json.dumps([100, 10e3, 100, 500, electrode_states],
+                      cls=PandasJsonEncoder)
+    return '{"keys": %s, "values": [%s]}' % (json.dumps(KEYS),
+                                              ', '.join([step] * step_count))
+
+
+def run_case(step_count, method):
+    from microdrop.protocol import protocol_from_dict
+    from zmq_plugin.schema import pandas_object_hook
+
+    protocol_stream = load_module('protocol_stream')
+    payload = synthetic_protocol(step_count)
+    baseline = peak_rss_mb()
+    start = time.time()
+    if method == 'full':
+        protocol_dict = json.loads(payload, object_hook=pandas_object_hook)
+        protocol = protocol_from_dict(protocol_dict)
+    else:
+        protocol = protocol_stream.protocol_from_json(payload,
+                                                      object_hook=
+                                                      pandas_object_hook)
+    duration = time.time() - start
+    assert len(protocol.steps) == step_count
+    print(json.dumps({'seconds': duration,
+                      'peak_mb': peak_rss_mb() - baseline}))
+
+
+def main(step_counts):
+    print('%8s %8s %10s %14s' % ('steps', 'method', 'seconds', 'peak MiB'))
+    for step_count in step_counts:
+        for method in ('full', 'stream'):
+            output = subprocess.check_output([sys.executable, __file__,
+                                              '--case', str(step_count),
+                                              method])
+            result = json.loads(output.decode('utf8').splitlines()[-1])
+            print('%8d %8s %10.3f %14.1f' % (step_count, method,
+                                             result['seconds'],
+                                             result['peak_mb']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip()
+                                     .splitlines()[0])
+    parser.add_argument('--steps', type=int, nargs='+',
+                        default=[1000, 10000, 50000])
+    parser.add_argument('--case', nargs=2, metavar=('STEPS', 'METHOD'),
+                        help='Run a single case (used internally).')
+    args = parser.parse_args()
+    if args.case:
+        run_case(int(args.case[0]), args.case[1])
+    else:
+        main(args.steps)
@@ -0,0 +1,71 @@
+'''
+Cost of the metrics recorded per handled message.
+
+For each received command, :class:`MqttPlugin` increments two counters on
+receipt and two counters on publish of the resulting event.  For one in
+``MqttPlugin.latency_sample_interval`` commands, it also observes three
+latencies (queue wait, handler time and time to the event).  Reports that
+cost relative to a given handler time, for every command sampled and for the
+plugin default.
+
+Usage::
+
+    python benchmarks/bench_metrics.py [--handler-ms 1] [--count 100000]
+        [--sample-interval 8]
+'''
+from __future__ import print_function
+import argparse
+import time
+
+from _common import load_module
+
+
+def per_message_seconds(count, sample_interval=1):
+    metrics = load_module('metrics')
+    registry = metrics.MetricsRegistry()
+    topic_metrics = {}
+
+    # As `MqttPlugin.topic_metrics()`.
+    def get_metrics(topic):
+        if topic not in topic_metrics:
+            topic_metrics[topic] = metrics.TopicMetrics(
+                registry, topic, sample_interval=sample_interval)
+        return topic_metrics[topic]
+
+    topic = 'microdrop/dmf-device-ui/change-step'
+    event = 'microdrop/mqtt-plugin/step-swapped'
+    start = time.time()
+    for i in range(count):
+        # `on_message()`
+        received = get_metrics(topic)
+        received.received_messages.increment()
+        received.received_bytes.increment(2)
+        # `_dispatch()`, `handle_message()` and `_pop_cause()`
+        dispatched = get_metrics(topic)
+        if dispatched.sample():
+            for stage in ('queue', 'handler', 'event'):
+                get_metrics(topic).latency(stage).observe(1e-3)
+        # `_send()`
+        published = get_metrics(event)
+        published.published_messages.increment()
+        published.published_bytes.increment(2)
+    return (time.time() - start) / count
+
+
+def main(handler_ms, count, sample_interval):
+    for sample_interval_i in sorted(set([1, sample_interval])):
+        seconds = per_message_seconds(count, sample_interval_i)
+        print('Instrumentation per message, 1 in %d sampled: %.2f us (%.3f%% '
+              'of a %g ms handler)' % (sample_interval_i, 1e6 * seconds,
+                                       100 * seconds / (1e-3 * handler_ms),
+                                       handler_ms))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip()
+                                     .splitlines()[0])
+    parser.add_argument('--handler-ms', type=float, default=1.)
+    parser.add_argument('--count', type=int, default=100000)
+    parser.add_argument('--sample-interval', type=int, default=8)
+    args = parser.parse_args()
+    main(args.handler_ms, args.count, args.sample_interval)
@@ -0,0 +1,84 @@
+'''
+Throughput and latency of :class:`MqttPlugin` message handling.
+
+Drives :meth:`MqttPlugin.on_message` with synthetic (or recorded) traffic on
+all command topics, against an in-process stand-in for the MicroDrop app and
+a fake MQTT client (or a real broker, see ``--broker``).  Requires the
+MicroDrop runtime packages (``microdrop``, ``paho_mqtt_helpers``, ...).
+
+Usage::
+
+    python benchmarks/bench_plugin.py [-n COUNT] [--steps STEPS]
+        [--traffic FILE [--speed SPEED]] [--rate RATE]
+        [--broker HOST:PORT] [--json]
+
+To reproduce a field session, record it by setting
+``MqttPlugin.record_path``, then replay the log with ``--traffic`` (at the
+original timing with ``--speed 1``, or faster with e.g. ``--speed 10``).
+'''
+from __future__ import print_function
+import argparse
+import json
+
+import harness
+
+
+def main(args):
+    from microdrop.protocol import Protocol, Step
+
+    protocol = Protocol()
+    protocol.steps = [Step() for i in range(args.steps)]
+    app = harness.FakeApp(protocol)
+    broker = None
+    if args.broker:
+        host, port = args.broker.split(':')
+        broker = (host, int(port))
+    plugin = harness.create_plugin(app, broker=broker)
+    try:
+        if args.traffic:
+            messages = harness.read_traffic(args.traffic)
+        else:
+            messages = harness.synthetic_traffic(args.count, args.steps)
+        result = harness.run(plugin, messages, rate=args.rate,
+                             speed=args.speed)
+    finally:
+        plugin.dispatcher.stop()
+
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return
+    print('%d messages (%d handled, %d skipped) in %.2f s: %.0f messages/s, '
+          'peak RSS %.1f MiB' % (result['messages'], result['handled'],
+                                 result['skipped'], result['seconds'],
+                                 result['messages_per_s'],
+                                 result['peak_rss_mb']))
+    print('%-46s %6s %10s %10s %10s %10s' % ('topic', 'count', 'p50 ms',
+                                            'p99 ms', 'e2e p50', 'e2e p99'))
+    for topic, stats in sorted(result['topics'].items()):
+        print('%-46s %6d %10.3f %10.3f %10.3f %10.3f' %
+              (topic, stats['count'], 1e3 * stats['p50'],
+               1e3 * stats['p99'], 1e3 * stats['end_to_end_p50'],
+               1e3 * stats['end_to_end_p99']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip()
+                                     .splitlines()[0])
+    parser.add_argument('-n', '--count', type=int, default=10000,
+                        help='Number of synthetic messages.')
+    parser.add_argument('--steps', type=int, default=100,
+                        help='Number of steps of the active protocol.')
+    parser.add_argument('--traffic', help='Recorded traffic: traffic log '
+                        'written by the plugin (see `record_path`), or file '
+                        'with one JSON object with `topic` and `payload` per '
+                        'line.')
+    parser.add_argument('--speed', type=float, help='Replay a traffic log '
+                        'at its recorded timing, sped up by this factor '
+                        '(default: as fast as possible).')
+    parser.add_argument('--rate', type=float, help='Messages per second '
+                        '(default: as fast as possible).')
+    parser.add_argument('--broker', help='Publish to MQTT broker at '
+                        'HOST:PORT instead of a fake client.')
+    parser.add_argument('--json', action='store_true',
+                        help='Print results as JSON.')
+    main(parser.parse_args())
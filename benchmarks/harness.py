@@ -0,0 +1,335 @@
+'''
+In-process stand-ins for MicroDrop and the MQTT broker, used to drive
+:class:`MqttPlugin` without a running MicroDrop GUI or broker.
+'''
+from collections import defaultdict
+import json
+import random
+import sys
+import threading
+import time
+
+from _common import ROOT, load_module, peak_rss_mb
+
+#: Topics handled by the plugin.
+COMMAND_TOPICS = ['microdrop/dmf-device-ui/change-step',
+                  'microdrop/dmf-device-ui/delete-step',
+                  'microdrop/dmf-device-ui/insert-step',
+                  'microdrop/dmf-device-ui/change-protocol-state',
+                  'microdrop/dmf-device-ui/change-repeat',
+                  'microdrop/data-controller/load-protocol']
+
+
+class FakeMessage(object):
+    '''
+    Stand-in for :class:`paho.mqtt.client.MQTTMessage`.
+    '''
+    def __init__(self, topic, payload, qos=0, retain=False):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+        self.timestamp = time.time()
+
+
+class FakeClient(object):
+    '''
+    Stand-in for :class:`paho.mqtt.client.Client` recording publishes.
+    '''
+    def __init__(self):
+        self.published = []
+        self.subscriptions = []
+
+    def subscribe(self, topic, qos=0):
+        self.subscriptions.append(topic)
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published.append((topic, payload, qos, retain))
+
+    def loop_stop(self, *args):
+        pass
+
+    def disconnect(self):
+        pass
+
+
+class FakeTextEntry(object):
+    def __init__(self, text='1'):
+        self.text = text
+
+    def get_text(self):
+        return self.text
+
+    def set_text(self, text):
+        self.text = text
+
+
+class FakeProtocolController(object):
+    def __init__(self, app):
+        self.app = app
+        self.modified = False
+        self.textentry_protocol_repeats = FakeTextEntry()
+
+    def activate_protocol(self, protocol):
+        from microdrop.plugin_manager import emit_signal
+
+        old_protocol, self.app.protocol = self.app.protocol, protocol
+        emit_signal('on_protocol_swapped', [old_protocol, protocol])
+
+
+class FakeApp(object):
+    '''
+    Stand-in for the MicroDrop application returned by
+    :func:`microdrop.app_context.get_app`.
+    '''
+    def __init__(self, protocol):
+        self.protocol = protocol
+        self.protocol_controller = FakeProtocolController(self)
+        self.running = False
+
+
+def synthetic_protocol_json(step_count):
+    from bench_load_protocol import synthetic_protocol
+
+    return synthetic_protocol(step_count)
+
+
+def load_plugin(version=None):
+    '''
+    Import the plugin package as ``mqtt_plugin`` from the source tree.
+
+    Parameters
+    ----------
+    version : str, optional
+        Version reported by the stand-in for the plugin ``properties.yml``
+        (as for a packaged plugin).  By default, the version is resolved from
+        the git checkout.
+
+    Returns
+    -------
+    module
+    '''
+    import imp
+
+    import microdrop.plugin_helpers
+
+    if 'mqtt_plugin' in sys.modules:
+        return sys.modules['mqtt_plugin']
+
+    # `properties.yml` is only generated when the plugin is packaged.
+    get_plugin_info = microdrop.plugin_helpers.get_plugin_info
+
+    class PluginInfo(object):
+        plugin_name = 'mqtt_plugin'
+
+    PluginInfo.version = version
+
+    microdrop.plugin_helpers.get_plugin_info = \
+        lambda path: get_plugin_info(path) or PluginInfo()
+    try:
+        return imp.load_module('mqtt_plugin', None, ROOT,
+                               ('', '', imp.PKG_DIRECTORY))
+    finally:
+        microdrop.plugin_helpers.get_plugin_info = get_plugin_info
+
+
+def create_plugin(app, broker=None, **attributes):
+    '''
+    Parameters
+    ----------
+    app : FakeApp
+        Application returned to the plugin by ``get_app()``.
+    broker : tuple, optional
+        ``(host, port)`` of an MQTT broker to publish to.  By default,
+        publishes are recorded by a :class:`FakeClient`.
+    **attributes
+        Plugin class attributes to override (e.g., ``queue_size``).
+
+    Returns
+    -------
+    MqttPlugin
+        Plugin instance, with a ``handled`` counter and a ``latencies``
+        dictionary of handler durations (in seconds) by topic.
+    '''
+    mqtt_plugin = load_plugin()
+    mqtt_plugin.get_app = lambda: app
+
+    class BenchmarkPlugin(mqtt_plugin.MqttPlugin):
+        def start(self):
+            if broker is None:
+                self.mqtt_client = FakeClient()
+                self.on_connect(self.mqtt_client, None, {}, 0)
+            else:
+                self.host, self.port = broker
+                super(BenchmarkPlugin, self).start()
+
+        def handle_message(self, msg):
+            start = time.time()
+            try:
+                super(BenchmarkPlugin, self).handle_message(msg)
+            finally:
+                end = time.time()
+                with self.stats_lock:
+                    self.latencies[msg.topic].append(end - start)
+                    self.end_to_end[msg.topic].append(end - msg.timestamp)
+                    self.handled += 1
+
+    for name, value in attributes.items():
+        setattr(BenchmarkPlugin, name, value)
+    BenchmarkPlugin.stats_lock = threading.Lock()
+    BenchmarkPlugin.handled = 0
+    BenchmarkPlugin.latencies = defaultdict(list)
+    BenchmarkPlugin.end_to_end = defaultdict(list)
+    return BenchmarkPlugin()
+
+
+def synthetic_traffic(count, step_count, weights=None, protocol_steps=100,
+                      seed=0):
+    '''
+    Generate a random mix of messages on :data:`COMMAND_TOPICS`.
+
+    Parameters
+    ----------
+    count : int
+        Number of messages.
+    step_count : int
+        Number of steps in the protocol the commands refer to.
+    weights : dict, optional
+        Relative frequency by topic (default: mostly step changes, with an
+        occasional protocol load).
+    protocol_steps : int, optional
+        Number of steps of protocols sent on ``load-protocol``.
+    '''
+    if weights is None:
+        weights = dict(zip(COMMAND_TOPICS, [60, 5, 5, 2, 10, 1]))
+    random_ = random.Random(seed)
+    topics = [topic for topic, weight in weights.items()
+              for i in range(weight)]
+    protocol_json = None
+    messages = []
+    for i in range(count):
+        topic = random_.choice(topics)
+        if topic.endswith('load-protocol'):
+            if protocol_json is None:
+                protocol_json = synthetic_protocol_json(protocol_steps)
+            payload = protocol_json
+        elif topic.endswith('change-protocol-state'):
+            payload = json.dumps(None)
+        elif topic.endswith('change-repeat'):
+            payload = json.dumps(random_.randint(1, 10))
+        else:
+            # Stay in the first half of the protocol, so step numbers remain
+            # valid as steps are inserted and deleted.
+            payload = json.dumps(random_.randrange(max(step_count // 2, 1)))
+        messages.append((topic, payload))
+    return messages
+
+
+def read_traffic(path):
+    '''
+    Read recorded traffic from a traffic log written by the plugin (see
+    :mod:`recording` and ``MqttPlugin.record_path``), or from a file with
+    one JSON object per line, with ``topic`` and ``payload`` (string) keys.
+    Only received messages on :data:`COMMAND_TOPICS` are returned.
+
+    Returns
+    -------
+    list
+        ``(topic, payload)`` pairs, or ``(topic, payload, offset)`` triples
+        for a traffic log, ``offset`` being the time (in seconds) since the
+        first message.
+    '''
+    recording = load_module('recording')
+    if recording.is_traffic_log(path):
+        messages = []
+        start = None
+        for record in recording.read_records(path):
+            if (record.direction == recording.INBOUND and
+                    record.topic in COMMAND_TOPICS):
+                if start is None:
+                    start = record.timestamp
+                messages.append((record.topic, record.payload,
+                                 record.timestamp - start))
+        return messages
+    messages = []
+    with open(path) as input_:
+        for line in input_:
+            if line.strip():
+                record = json.loads(line)
+                if record['topic'] in COMMAND_TOPICS:
+                    messages.append((record['topic'], record['payload']))
+    return messages
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def run(plugin, messages, rate=None, timeout=60., speed=None):
+    '''
+    Feed :data:`messages` to :meth:`MqttPlugin.on_message` and wait until
+    all have been handled.
+
+    Parameters
+    ----------
+    messages : list
+        ``(topic, payload)`` pairs or ``(topic, payload, offset)`` triples
+        (see :func:`read_traffic`).
+    rate : float, optional
+        Messages per second (as fast as possible if not set).
+    speed : float, optional
+        Replay messages at their recorded ``offset``, scaled by this speed
+        factor (e.g., 1 for the original timing); takes precedence over
+        :data:`rate`.
+
+    Returns
+    -------
+    dict
+        ``messages`` sent, ``handled`` and ``skipped`` (coalesced or
+        dropped), ``seconds`` elapsed,
+        ``messages_per_s``, per topic ``count`` and ``p50``/``p99`` handler
+        latency and end-to-end (receive to handled) latency, and
+        ``peak_rss_mb``.
+    '''
+    queue = plugin.message_queue
+    handled_before = plugin.handled
+    skipped_before = queue.coalesced + queue.dropped
+    start = time.time()
+    for i, message in enumerate(messages):
+        topic, payload = message[:2]
+        if speed and len(message) > 2:
+            delay = start + message[2] / float(speed) - time.time()
+        elif rate:
+            delay = start + i / float(rate) - time.time()
+        else:
+            delay = 0
+        if delay > 0:
+            time.sleep(delay)
+        plugin.on_message(plugin.mqtt_client, None,
+                          FakeMessage(topic, payload))
+    # Every message is either handled, or coalesced/dropped by the queue.
+    end_time = start + timeout
+    while time.time() < end_time:
+        if (plugin.handled - handled_before + queue.coalesced +
+                queue.dropped - skipped_before >= len(messages)):
+            break
+        time.sleep(.001)
+    duration = time.time() - start
+    handled = plugin.handled - handled_before
+    skipped = queue.coalesced + queue.dropped - skipped_before
+    topics = {}
+    for topic, latencies in plugin.latencies.items():
+        topics[topic] = {'count': len(latencies),
+                         'p50': percentile(latencies, .5),
+                         'p99': percentile(latencies, .99),
+                         'end_to_end_p50':
+                         percentile(plugin.end_to_end[topic], .5),
+                         'end_to_end_p99':
+                         percentile(plugin.end_to_end[topic], .99)}
+    return {'messages': len(messages), 'handled': handled,
+            'skipped': skipped, 'seconds': duration,
+            'messages_per_s': len(messages) / duration,
+            'topics': topics, 'peak_rss_mb': peak_rss_mb()}
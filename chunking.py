@@ -0,0 +1,216 @@
+'''
+Chunked transfer of large message payloads.
+
+A payload too large to be published at once (e.g., over the broker
+``message_size_limit``) is published as a sequence of chunks on
+``<topic>/chunks/<index>``.  Each chunk is a :data:`HEADER` (transfer id,
+chunk index, chunk count and SHA1 digest of the whole payload) followed by a
+slice of the payload.  Chunks are published as separate messages, so other
+messages may be published (and handled) between the chunks of a transfer.
+'''
+import hashlib
+import logging
+import os
+import struct
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+#: Chunk header: transfer id, chunk index, chunk count and SHA1 digest of the
+#: whole payload.
+HEADER = struct.Struct('<16sII20s')
+SUFFIX = '/chunks/'
+
+
+def chunk_topic(topic, index):
+    '''
+    Returns
+    -------
+    str
+        Topic of chunk :data:`index` of a payload published on
+        :data:`topic`.
+    '''
+    return '%s%s%d' % (topic, SUFFIX, index)
+
+
+def chunk_filter(topic):
+    '''
+    Returns
+    -------
+    str
+        Topic filter matching the chunks of payloads published on
+        :data:`topic`.
+    '''
+    return topic + SUFFIX + '+'
+
+
+def parent_topic(topic):
+    '''
+    Returns
+    -------
+    str or None
+        Topic a chunk published on :data:`topic` belongs to, or ``None`` if
+        :data:`topic` is not a chunk topic.
+    '''
+    if SUFFIX not in topic:
+        return None
+    parent, index = topic.rsplit(SUFFIX, 1)
+    return parent if index.isdigit() else None
+
+
+def _to_bytes(payload):
+    if isinstance(payload, bytes):
+        return payload
+    return payload.encode('utf8')
+
+
+def split(payload, chunk_size, transfer_id=None):
+    '''
+    Parameters
+    ----------
+    payload : bytes or str
+    chunk_size : int
+        Maximum number of payload bytes per chunk (excluding the header).
+    transfer_id : bytes, optional
+        16 byte transfer identifier (random by default).
+
+    Returns
+    -------
+    list
+        Chunk payloads (header and payload slice), in order.
+    '''
+    data = _to_bytes(payload)
+    if transfer_id is None:
+        transfer_id = os.urandom(16)
+    digest = hashlib.sha1(data).digest()
+    count = max(1, (len(data) + chunk_size - 1) // chunk_size)
+    return [HEADER.pack(transfer_id, index, count, digest) +
+            data[index * chunk_size:(index + 1) * chunk_size]
+            for index in range(count)]
+
+
+class _Transfer(object):
+    def __init__(self, count, digest, started):
+        self.count = count
+        self.digest = digest
+        self.started = started
+        self.chunks = {}
+        self.size = 0
+
+
+class Reassembler(object):
+    '''
+    Reassemble payloads from chunks (see :func:`split`), received in any
+    order and possibly interleaved with chunks of other transfers.
+
+    Parameters
+    ----------
+    timeout : float, optional
+        Seconds after the first chunk of a transfer before an incomplete
+        transfer is discarded.
+    max_size : int, optional
+        Maximum size (in bytes) of a reassembled payload.
+
+    Attributes
+    ----------
+    completed : int
+        Number of payloads reassembled.
+    failed : int
+        Number of transfers discarded due to an invalid chunk or a digest
+        mismatch.
+    expired : int
+        Number of incomplete transfers discarded after :data:`timeout`.
+    '''
+    def __init__(self, timeout=30., max_size=1 << 28, clock=time.time):
+        self.timeout = timeout
+        self.max_size = max_size
+        self.completed = 0
+        self.failed = 0
+        self.expired = 0
+        self._clock = clock
+        # Maps `(topic, transfer_id)` to `_Transfer`.
+        self._transfers = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._transfers)
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {'pending': len(self._transfers),
+                    'completed': self.completed, 'failed': self.failed,
+                    'expired': self.expired}
+
+    def _expire(self, now):
+        for key, transfer in list(self._transfers.items()):
+            if now - transfer.started > self.timeout:
+                del self._transfers[key]
+                self.expired += 1
+                logger.warning('Incomplete transfer on `%s` expired (%d/%d '
+                               'chunks received).', key[0],
+                               len(transfer.chunks), transfer.count)
+
+    def add(self, topic, chunk):
+        '''
+        Parameters
+        ----------
+        topic : str
+            Topic the payload is published on (see :func:`parent_topic`).
+        chunk : bytes
+            Chunk payload.
+
+        Returns
+        -------
+        bytes or None
+            Reassembled payload, once all chunks of the transfer are
+            received.
+
+        Raises
+        ------
+        ValueError
+            If :data:`chunk` is invalid or inconsistent with other chunks of
+            the same transfer, or if the reassembled payload does not match
+            its digest; the transfer is discarded.
+        '''
+        chunk = _to_bytes(chunk)
+        if len(chunk) < HEADER.size:
+            with self._lock:
+                self.failed += 1
+            raise ValueError('Chunk on `%s` is too short.' % topic)
+        transfer_id, index, count, digest = HEADER.unpack_from(chunk)
+        key = (topic, transfer_id)
+        now = self._clock()
+        with self._lock:
+            self._expire(now)
+            transfer = self._transfers.get(key)
+            if transfer is None:
+                transfer = _Transfer(count, digest, now)
+                self._transfers[key] = transfer
+            error = None
+            if (count, digest) != (transfer.count, transfer.digest):
+                error = 'inconsistent chunk header'
+            elif index >= count:
+                error = 'chunk index %d out of range' % index
+            elif transfer.size + len(chunk) - HEADER.size > self.max_size:
+                error = 'payload larger than %d bytes' % self.max_size
+            if error is not None:
+                del self._transfers[key]
+                self.failed += 1
+                raise ValueError('Invalid transfer on `%s`: %s.' %
+                                 (topic, error))
+            if index not in transfer.chunks:
+                transfer.chunks[index] = chunk[HEADER.size:]
+                transfer.size += len(chunk) - HEADER.size
+            if len(transfer.chunks) < count:
+                return None
+            del self._transfers[key]
+            payload = b''.join([transfer.chunks[i] for i in range(count)])
+            if hashlib.sha1(payload).digest() != digest:
+                self.failed += 1
+                raise ValueError('Payload reassembled on `%s` does not match '
+                                 'its digest.' % topic)
+            self.completed += 1
+        return payload
@@ -0,0 +1,192 @@
+'''
+Optional compression of large message payloads.
+
+Compressed payloads start with a header made of a NUL byte, the name of the
+encoding and another NUL byte, e.g., ``b'\\x00zlib\\x00'``.  No JSON document
+starts with a NUL byte, and a MessagePack or CBOR payload starting with one
+is exactly one byte long, so consumers can detect compressed payloads
+without any out-of-band information.
+'''
+import threading
+import time
+import zlib
+
+#: Default maximum size (in bytes) of a decompressed payload (see
+#: :func:`decompress`).
+MAX_DECOMPRESSED_SIZE = 1 << 27
+
+
+def _check_size(size, max_size):
+    if max_size is not None and size > max_size:
+        raise ValueError('Decompressed payload larger than %d bytes.' %
+                         max_size)
+
+
+class _Zlib(object):
+    name = 'zlib'
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data, max_size=None):
+        decompressor = zlib.decompressobj()
+        # A maximum length of 0 means no limit.
+        output = decompressor.decompress(data, 0 if max_size is None
+                                         else max_size + 1)
+        _check_size(len(output), max_size)
+        return output + decompressor.flush()
+
+
+class _Zstd(object):
+    name = 'zstd'
+
+    def __init__(self, level=3):
+        import zstandard
+
+        self._compressor = zstandard.ZstdCompressor(level=level)
+        self._decompressor = zstandard.ZstdDecompressor()
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def decompress(self, data, max_size=None):
+        if max_size is None:
+            return self._decompressor.decompress(data)
+        # Read through a stream, since the content size in the frame header
+        # (used by `decompress()`) is set by the sender.
+        parts = []
+        size = 0
+        with self._decompressor.stream_reader(data) as reader:
+            while True:
+                part = reader.read(max_size + 1 - size)
+                if not part:
+                    break
+                parts.append(part)
+                size += len(part)
+                _check_size(size, max_size)
+        return b''.join(parts)
+
+
+#: Compression encodings by name (``zstd`` requires the ``zstandard``
+#: package).
+ENCODINGS = {'zlib': _Zlib, 'zstd': _Zstd}
+_decoders = {}
+
+
+def _header(name):
+    return b'\x00' + name.encode('ascii') + b'\x00'
+
+
+def _to_bytes(payload):
+    if isinstance(payload, bytes):
+        return payload
+    return payload.encode('utf8')
+
+
+def is_compressed(payload):
+    return isinstance(payload, bytes) and payload[:1] == b'\x00' and \
+        len(payload) > 1
+
+
+def decompress(payload, max_size=MAX_DECOMPRESSED_SIZE):
+    '''
+    Parameters
+    ----------
+    payload : bytes or str
+    max_size : int, optional
+        Maximum size (in bytes) of the decompressed payload; decompression
+        stops as soon as it is exceeded, so a small payload cannot expand to
+        an arbitrary size.  ``None`` for no limit.
+
+    Returns
+    -------
+    bytes
+        Decompressed :data:`payload`, or :data:`payload` unchanged if it has
+        no compression header.
+
+    Raises
+    ------
+    ValueError
+        If the header names an unknown encoding, or if the decompressed
+        payload is larger than :data:`max_size`.
+    '''
+    if not is_compressed(payload):
+        return payload
+    end = payload.find(b'\x00', 1)
+    name = payload[1:end].decode('ascii') if end > 0 else None
+    if name not in ENCODINGS:
+        raise ValueError('Unknown payload compression: `%s`' % name)
+    if name not in _decoders:
+        _decoders[name] = ENCODINGS[name]()
+    return _decoders[name].decompress(payload[end + 1:], max_size)
+
+
+class Compressor(object):
+    '''
+    Compress payloads larger than a threshold, keeping track of the
+    compression ratio and time spent compressing.
+
+    Parameters
+    ----------
+    threshold : int
+        Minimum payload size (in bytes) to compress.
+    encoding : str, optional
+        Name of the compression encoding (see :data:`ENCODINGS`).
+    level : int, optional
+        Compression level (encoding default if not set).
+    '''
+    def __init__(self, threshold, encoding='zlib', level=None):
+        self.threshold = threshold
+        self._codec = (ENCODINGS[encoding]() if level is None
+                       else ENCODINGS[encoding](level))
+        self._header = _header(self._codec.name)
+        self._lock = threading.Lock()
+        self.count = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.seconds = 0.
+
+    @property
+    def stats(self):
+        '''
+        dict
+            Number of compressed payloads (``count``), total ``bytes_in`` and
+            ``bytes_out``, overall compression ``ratio`` (input/output size)
+            and ``seconds`` spent compressing, total and ``seconds_mean`` per
+            payload.
+        '''
+        with self._lock:
+            return {'count': self.count, 'bytes_in': self.bytes_in,
+                    'bytes_out': self.bytes_out,
+                    'ratio': (float(self.bytes_in) / self.bytes_out
+                              if self.bytes_out else None),
+                    'seconds': self.seconds,
+                    'seconds_mean': (self.seconds / self.count
+                                     if self.count else None)}
+
+    def compress(self, payload):
+        '''
+        Returns
+        -------
+        bytes or str
+            Compressed payload with header, or :data:`payload` unchanged if
+            it is smaller than :attr:`threshold` or does not shrink.
+        '''
+        if payload is None or isinstance(payload, (int, float)) or \
+                len(payload) < self.threshold:
+            return payload
+        data = _to_bytes(payload)
+        start = time.time()
+        compressed = self._header + self._codec.compress(data)
+        duration = time.time() - start
+        with self._lock:
+            self.count += 1
+            self.bytes_in += len(data)
+            self.bytes_out += len(compressed)
+            self.seconds += duration
+        if len(compressed) >= len(data):
+            return payload
+        return compressed
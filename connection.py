@@ -0,0 +1,131 @@
+'''
+Background connection to the MQTT broker.
+'''
+import logging
+import random
+import socket
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class Backoff(object):
+    '''
+    Exponential backoff with "full jitter": the n-th consecutive delay is
+    drawn uniformly from ``[0, min(maximum, initial * factor ** n)]``, so
+    clients losing their broker at the same time (e.g., every lab station
+    on a network) do not retry in lockstep.
+
+    Parameters
+    ----------
+    initial : float, optional
+        Upper bound of the first delay (in seconds).
+    maximum : float, optional
+        Upper bound of any delay (in seconds).
+    factor : float, optional
+        Growth of the upper bound after each delay.
+    '''
+    def __init__(self, initial=.5, maximum=30., factor=2., random_=None):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.attempts = 0
+        self._random = random_ or random.Random()
+
+    def reset(self):
+        self.attempts = 0
+
+    def next(self):
+        '''
+        Returns
+        -------
+        float
+            Delay (in seconds) before the next attempt.
+        '''
+        bound = min(self.maximum, self.initial * self.factor ** self.attempts)
+        if bound < self.maximum:
+            self.attempts += 1
+        return self._random.uniform(0, bound)
+
+
+class Connector(object):
+    '''
+    Network thread connecting a :class:`paho.mqtt.client.Client` to the
+    broker and running its network loop, retrying with :class:`Backoff`
+    until stopped.
+
+    Unlike :meth:`paho.mqtt.client.Client.connect` followed by
+    :meth:`paho.mqtt.client.Client.loop_start`, :meth:`start` returns
+    immediately, whether or not the broker is reachable.
+
+    Parameters
+    ----------
+    client : paho.mqtt.client.Client
+    host : str
+    port : int
+    keepalive : int, optional
+    backoff : Backoff, optional
+        Delays between connection attempts.  Must be reset once a connection
+        is acknowledged by the broker (i.e., in the ``on_connect`` callback),
+        since a refused connection also opens a socket.
+
+    Attributes
+    ----------
+    connects : int
+        Number of connection attempts that opened a socket.
+    '''
+    def __init__(self, client, host, port, keepalive=60, backoff=None):
+        self.client = client
+        self.host = host
+        self.port = port
+        self.keepalive = keepalive
+        self.backoff = backoff or Backoff()
+        self.connects = 0
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='mqtt-plugin-network')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop_event.set()
+        if self._thread is not None:
+            try:
+                self.client.disconnect()
+            except Exception:
+                pass
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _connect(self):
+        try:
+            self.client.connect(self.host, self.port, self.keepalive)
+        except (socket.error, OSError) as exception:
+            logger.debug('Could not connect to `%s:%s`: %s', self.host,
+                         self.port, exception)
+            return False
+        self.connects += 1
+        return True
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            if self._connect():
+                # `loop()` returns a non-zero code once the connection is
+                # lost (or closed by `stop()`).
+                while not self._stop_event.is_set() and \
+                        self.client.loop(timeout=1.) == 0:
+                    pass
+            if not self._stop_event.is_set():
+                delay = self.backoff.next()
+                logger.debug('Reconnecting in %.2f s.', delay)
+                self._stop_event.wait(delay)
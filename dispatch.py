@@ -0,0 +1,254 @@
+'''
+Hand-off of received messages from the MQTT network loop to a worker thread.
+'''
+from collections import Counter, deque
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Empty(Exception):
+    pass
+
+
+class MessageQueue(object):
+    '''
+    Bounded first-in, first-out queue of ``(key, item)`` pairs.
+
+    Items put with ``coalesce=True`` follow a "latest value wins" policy: if
+    the most recently queued item has the same key, it is replaced.  Items
+    are never replaced across an item with another key, so the relative order
+    of keys is preserved.  Coalesced items may also be held for a ``delay``,
+    during which newer items with the same key replace them, so bursts of
+    updates collapse into one.  A held item is released early as soon as an
+    item that is not held is queued behind it, so holding never reorders
+    items or delays other keys.
+
+    Parameters
+    ----------
+    maxsize : int, optional
+        Maximum number of queued items.
+    overflow : str, optional
+        Policy applied when an item is put while the queue is full:
+
+         - :attr:`BLOCK`: wait until the consumer frees a slot.
+         - :attr:`DROP_OLDEST`: discard the oldest queued droppable item.
+         - :attr:`COALESCE`: if the item is put with ``coalesce=True``,
+           replace the queued item with the same key (keeping its position in
+           the queue); otherwise, discard the oldest queued droppable item.
+
+        Items put with ``droppable=False`` are never discarded: if no queued
+        item may be discarded in their favour, they are queued beyond
+        :data:`maxsize`.  Every discarded item is logged as a warning.
+
+    Attributes
+    ----------
+    dropped : int
+        Number of items discarded due to overflow.
+    coalesced : int
+        Number of items replaced by a more recent item with the same key.
+    coalesced_by_key : collections.Counter
+        Number of replaced items, by key.
+    '''
+    BLOCK = 'block'
+    DROP_OLDEST = 'drop-oldest'
+    COALESCE = 'coalesce'
+
+    def __init__(self, maxsize=1000, overflow=BLOCK):
+        if overflow not in (self.BLOCK, self.DROP_OLDEST, self.COALESCE):
+            raise ValueError('Unknown overflow policy: `%s`' % overflow)
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.dropped = 0
+        self.coalesced = 0
+        self.coalesced_by_key = Counter()
+        # Each entry is a `[key, item, ready_time, droppable]` list so
+        # coalescing can update it in place.
+        self._entries = deque()
+        # Most recently queued entry for each key.
+        self._latest = {}
+        # Number of queued entries that are not held.
+        self._ready_count = 0
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def put(self, key, item, coalesce=False, delay=0, droppable=True):
+        '''
+        Parameters
+        ----------
+        key : object
+            Key of the item, e.g., a topic name.
+        item : object
+        coalesce : bool, optional
+            If ``True``, replace the last queued item if it has the same
+            key.
+        delay : float, optional
+            Seconds to hold a coalesced item before it is handed to the
+            consumer.
+        droppable : bool, optional
+            If ``False``, the item is never discarded due to overflow (e.g.,
+            a command that edits state).
+        '''
+        with self._lock:
+            if (coalesce and self._entries and
+                    self._entries[-1] is self._latest.get(key)):
+                self._coalesce(key, item)
+                return
+            if len(self._entries) >= self.maxsize:
+                if self.overflow == self.BLOCK:
+                    logger.warning('Message queue full (%d items), blocking.',
+                                   len(self._entries))
+                    while len(self._entries) >= self.maxsize:
+                        self._not_full.wait()
+                elif (self.overflow == self.COALESCE and coalesce and
+                      key in self._latest):
+                    self._coalesce(key, item)
+                    return
+                elif not self._drop_oldest():
+                    if droppable:
+                        self.dropped += 1
+                        logger.warning('Message queue full (%d items), '
+                                       'dropped new item `%s`.',
+                                       len(self._entries), key)
+                        return
+                    logger.warning('Message queue full (%d items), queuing '
+                                   '`%s` beyond capacity.',
+                                   len(self._entries), key)
+            ready_time = time.time() + delay if coalesce and delay > 0 else 0
+            if not ready_time:
+                self._ready_count += 1
+            entry = [key, item, ready_time, droppable]
+            self._entries.append(entry)
+            self._latest[key] = entry
+            self._not_empty.notify()
+
+    def _coalesce(self, key, item):
+        self._latest[key][1] = item
+        self.coalesced += 1
+        self.coalesced_by_key[key] += 1
+
+    def get(self, timeout=None):
+        '''
+        Returns
+        -------
+        tuple
+            Oldest ``(key, item)`` pair in the queue.
+
+        Raises
+        ------
+        Empty
+            If the queue is still empty after :data:`timeout` seconds.
+        '''
+        with self._lock:
+            if timeout is not None:
+                end_time = time.time() + timeout
+            while True:
+                wait_time = None
+                if self._entries:
+                    # The head entry may only be held while no entry behind
+                    # it is ready.
+                    hold_time = self._entries[0][2] - time.time()
+                    if hold_time <= 0 or self._ready_count:
+                        break
+                    wait_time = hold_time
+                if timeout is not None:
+                    remaining = end_time - time.time()
+                    if remaining <= 0:
+                        raise Empty()
+                    wait_time = (remaining if wait_time is None
+                                 else min(wait_time, remaining))
+                self._not_empty.wait(wait_time)
+            entry = self._pop()
+            self._not_full.notify()
+            return tuple(entry[:2])
+
+    def _drop_oldest(self):
+        '''
+        Discard the oldest droppable entry.
+
+        Returns
+        -------
+        bool
+            ``False`` if no queued entry is droppable.
+        '''
+        for i, entry in enumerate(self._entries):
+            if entry[3]:
+                break
+        else:
+            return False
+        if i:
+            del self._entries[i]
+            self._forget(entry)
+        else:
+            self._pop()
+        self.dropped += 1
+        logger.warning('Message queue full (%d items), dropped oldest item '
+                       '`%s`.', len(self._entries) + 1, entry[0])
+        return True
+
+    def _pop(self):
+        entry = self._entries.popleft()
+        self._forget(entry)
+        return entry
+
+    def _forget(self, entry):
+        if not entry[2]:
+            self._ready_count -= 1
+        if self._latest.get(entry[0]) is entry:
+            del self._latest[entry[0]]
+
+
+class Dispatcher(object):
+    '''
+    Single worker thread calling :data:`handler` for each item of a
+    :class:`MessageQueue`, in queue order.
+
+    Parameters
+    ----------
+    queue : MessageQueue
+    handler : function
+        Called as ``handler(item)``.  Exceptions are logged and do not stop
+        the worker.
+    '''
+    def __init__(self, queue, handler):
+        self.queue = queue
+        self.handler = handler
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='mqtt-plugin-dispatcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                key, item = self.queue.get(timeout=.5)
+            except Empty:
+                continue
+            try:
+                self.handler(item)
+            except Exception:
+                logger.exception('Error handling message `%s`.', key)
@@ -0,0 +1,89 @@
+'''
+Optional message envelopes carrying a sequence number and origin timestamp.
+
+An enveloped JSON payload is an object with an ``_envelope`` member followed
+by the original ``payload``, e.g.::
+
+    {"_envelope": {"seq": 42, "ts": 1500000000.25}, "payload": 3}
+
+``ts`` is the time (in seconds since the epoch) the message originated, e.g.,
+when the user clicked a step in the UI.  Envelopes of published events also
+carry the ``cause``: topic and sequence number of the command that triggered
+the event, if any.
+
+MQTT v5 clients may instead send ``seq`` and ``ts`` as user properties,
+leaving the payload untouched.
+'''
+import json
+import re
+
+_decoder = json.JSONDecoder()
+_HEAD = re.compile(r'\s*\{\s*"_envelope"\s*:\s*')
+_PAYLOAD = re.compile(r'\s*,\s*"payload"\s*:\s*')
+
+
+def wrap(payload, envelope):
+    '''
+    Parameters
+    ----------
+    payload : str
+        JSON-encoded payload.
+    envelope : dict
+        Envelope members (e.g., ``seq`` and ``ts``).
+
+    Returns
+    -------
+    str
+        Enveloped payload, built without decoding :data:`payload`.
+    '''
+    return '{"_envelope": %s, "payload": %s}' % (json.dumps(envelope),
+                                                  payload)
+
+
+def unwrap(payload):
+    '''
+    Returns
+    -------
+    tuple
+        ``(envelope, payload)``: envelope dictionary (``None`` if
+        :data:`payload` is not enveloped) and the JSON-encoded inner
+        payload, sliced out without decoding it.
+
+    Raises
+    ------
+    ValueError
+        If :data:`payload` starts as an envelope but is malformed.
+    '''
+    original = payload
+    if isinstance(payload, bytes):
+        if b'"_envelope"' not in payload[:32]:
+            return None, payload
+        payload = payload.decode('utf8')
+    match = _HEAD.match(payload)
+    if match is None:
+        return None, original
+    envelope, end = _decoder.raw_decode(payload, match.end())
+    match = _PAYLOAD.match(payload, end)
+    close = payload.rfind('}')
+    if match is None or close < match.end():
+        raise ValueError('Malformed message envelope.')
+    return envelope, payload[match.end():close].rstrip()
+
+
+def from_properties(msg):
+    '''
+    Returns
+    -------
+    dict or None
+        ``seq`` and ``ts`` MQTT v5 user properties of :data:`msg`, if any.
+    '''
+    properties = getattr(msg, 'properties', None)
+    user_properties = dict(getattr(properties, 'UserProperty', None) or [])
+    envelope = {}
+    for key, type_ in (('seq', int), ('ts', float)):
+        if key in user_properties:
+            try:
+                envelope[key] = type_(user_properties[key])
+            except ValueError:
+                pass
+    return envelope or None
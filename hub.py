@@ -0,0 +1,314 @@
+'''
+Process-wide MQTT connection shared by several plugins.
+'''
+import logging
+import threading
+
+from .connection import Backoff, Connector
+from .dispatch import Dispatcher, MessageQueue
+from .topics import TopicTrie
+
+logger = logging.getLogger(__name__)
+
+
+class Registration(object):
+    '''
+    Topic filters and callbacks registered by one plugin with a
+    :class:`ConnectionHub`.
+
+    Attributes
+    ----------
+    queue : MessageQueue or None
+        Messages pending for :attr:`handler`, if dispatched on a worker
+        thread (see :meth:`ConnectionHub.register`).
+    received : int
+        Number of messages routed to this registration.
+    '''
+    def __init__(self, name, topic_filters, handler, on_connect=None,
+                 on_disconnect=None, queue=None):
+        self.name = name
+        self.topic_filters = list(topic_filters)
+        self.handler = handler
+        self.on_connect = on_connect
+        self.on_disconnect = on_disconnect
+        self.queue = queue
+        self.dispatcher = None
+        self.received = 0
+
+    def deliver(self, msg):
+        self.received += 1
+        if self.queue is not None:
+            self.queue.put(msg.topic, msg)
+        else:
+            self.handler(msg)
+
+
+class ConnectionHub(object):
+    '''
+    Single MQTT client (one broker connection and network loop) shared by
+    several plugins.
+
+    Each plugin registers the topic filters it handles (see
+    :meth:`register`); the hub subscribes to the union of all registered
+    filters and fans each received message out to every registration with a
+    matching filter, once per registration.
+
+    Parameters
+    ----------
+    host : str, optional
+    port : int, optional
+    keepalive : int, optional
+    client : paho.mqtt.client.Client, optional
+        Client to share (by default, a new client is created).
+    reactor : reactor.Reactor, optional
+        If set, the network loop runs on the reactor thread rather than on a
+        dedicated thread (see :class:`connection.Connector`).
+    backoff : connection.Backoff, optional
+        Delays between connection attempts.
+    '''
+    def __init__(self, host='localhost', port=1883, keepalive=60, client=None,
+                 reactor=None, backoff=None):
+        if client is None:
+            import paho.mqtt.client as mqtt
+
+            client = mqtt.Client()
+        self.host = host
+        self.port = port
+        self.keepalive = keepalive
+        self.client = client
+        self.reactor = reactor
+        self.backoff = backoff or Backoff()
+        self.connected = False
+        self.connector = None
+        self._registrations = []
+        # Registrations by topic filter.
+        self._routes = TopicTrie()
+        self._lock = threading.RLock()
+        client.on_connect = self._on_connect
+        client.on_disconnect = self._on_disconnect
+        client.on_message = self._on_message
+        self._started = False
+
+    @property
+    def registrations(self):
+        with self._lock:
+            return list(self._registrations)
+
+    @property
+    def stats(self):
+        '''
+        dict
+            Number of messages received by each registration (by name), and
+            number of ``subscriptions`` and ``connects``.
+        '''
+        with self._lock:
+            return {'received': dict((registration.name, registration.received)
+                                     for registration in self._registrations),
+                    'subscriptions': len(self._routes),
+                    'connects': (self.connector.connects
+                                 if self.connector is not None else None)}
+
+    def start(self):
+        '''
+        Connect to the broker in the background (called by the first
+        :meth:`register`).
+        '''
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        if self.reactor is not None:
+            self.reactor.add_client(self.client, self.host, self.port,
+                                    self.keepalive, self.backoff)
+        else:
+            self.connector = Connector(self.client, self.host, self.port,
+                                       self.keepalive, self.backoff)
+            self.connector.start()
+
+    def stop(self):
+        with self._lock:
+            registrations = list(self._registrations)
+        for registration in registrations:
+            self.unregister(registration)
+        if self.reactor is not None:
+            self.reactor.remove_client(self.client)
+        if self.connector is not None:
+            self.connector.stop()
+        self._started = False
+
+    def register(self, name, topic_filters, handler, on_connect=None,
+                 on_disconnect=None, dispatch=True, queue_size=1000,
+                 overflow=MessageQueue.DROP_OLDEST):
+        '''
+        Parameters
+        ----------
+        name : str
+            Name of the registering plugin.
+        topic_filters : list
+            Topic filters to receive messages on.
+        handler : function
+            Called as ``handler(msg)`` for each received message matching any
+            of :data:`topic_filters`.
+        on_connect, on_disconnect : function, optional
+            Called with the arguments of the respective paho callbacks once
+            the shared connection is established (immediately, if it already
+            is) or lost.
+        dispatch : bool, optional
+            If ``True``, :data:`handler` is called on a dedicated worker
+            thread fed by a per-registration :class:`dispatch.MessageQueue`
+            (of :data:`queue_size` messages with the :data:`overflow`
+            policy), so a slow plugin does not hold up others.  Otherwise,
+            :data:`handler` is called on the network thread and must return
+            quickly (e.g., queue the message itself).
+        overflow : str, optional
+            Policy applied when a message is received while the queue is
+            full (see :class:`dispatch.MessageQueue`).  By default, the
+            oldest queued message is dropped.  :attr:`MessageQueue.BLOCK`
+            holds up the network thread shared by *all* registrations (and
+            their keepalives) until the queue has room, so it should only be
+            used by plugins that must not miss messages and handle them
+            quickly.
+
+        Returns
+        -------
+        Registration
+        '''
+        queue = MessageQueue(queue_size, overflow) if dispatch else None
+        registration = Registration(name, topic_filters, handler, on_connect,
+                                    on_disconnect, queue)
+        if queue is not None:
+            registration.dispatcher = Dispatcher(queue, handler)
+            registration.dispatcher.start()
+        with self._lock:
+            self._registrations.append(registration)
+            new_filters = []
+            for topic_filter in registration.topic_filters:
+                if topic_filter not in self._routes:
+                    self._routes[topic_filter] = []
+                    new_filters.append(topic_filter)
+                self._routes[topic_filter] = (self._routes[topic_filter] +
+                                              [registration])
+            connected = self.connected
+        if connected:
+            if new_filters:
+                self.client.subscribe([(topic_filter, 0)
+                                       for topic_filter in new_filters])
+            if on_connect is not None:
+                on_connect(self.client, None, {}, 0)
+        self.start()
+        return registration
+
+    def unregister(self, registration):
+        with self._lock:
+            if registration not in self._registrations:
+                return
+            self._registrations.remove(registration)
+            unused = []
+            for topic_filter in registration.topic_filters:
+                if topic_filter not in self._routes:
+                    continue
+                registrations = [registration_i for registration_i in
+                                 self._routes[topic_filter]
+                                 if registration_i is not registration]
+                if registrations:
+                    self._routes[topic_filter] = registrations
+                else:
+                    del self._routes[topic_filter]
+                    unused.append(topic_filter)
+            connected = self.connected
+        if connected and unused:
+            self.client.unsubscribe(unused)
+        if registration.dispatcher is not None:
+            registration.dispatcher.stop()
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        return self.client.publish(topic, payload, qos=qos, retain=retain)
+
+    def _on_connect(self, client, userdata, flags, rc):
+        if rc != 0:
+            logger.warning('Connection refused by broker (code %s).', rc)
+            return
+        self.backoff.reset()
+        with self._lock:
+            self.connected = True
+            topic_filters = list(self._routes)
+            registrations = list(self._registrations)
+        if topic_filters:
+            client.subscribe([(topic_filter, 0)
+                              for topic_filter in topic_filters])
+        for registration in registrations:
+            if registration.on_connect is not None:
+                try:
+                    registration.on_connect(client, userdata, flags, rc)
+                except Exception:
+                    logger.exception('Error in `on_connect` of `%s`.',
+                                     registration.name)
+
+    def _on_disconnect(self, client, userdata, rc):
+        with self._lock:
+            self.connected = False
+            registrations = list(self._registrations)
+        for registration in registrations:
+            if registration.on_disconnect is not None:
+                try:
+                    registration.on_disconnect(client, userdata, rc)
+                except Exception:
+                    logger.exception('Error in `on_disconnect` of `%s`.',
+                                     registration.name)
+
+    def _on_message(self, client, userdata, msg):
+        delivered = set()
+        with self._lock:
+            matches = self._routes.match(msg.topic)
+        for registrations in matches:
+            for registration in registrations:
+                if id(registration) not in delivered:
+                    delivered.add(id(registration))
+                    try:
+                        registration.deliver(msg)
+                    except Exception:
+                        logger.exception('Error delivering `%s` to `%s`.',
+                                         msg.topic, registration.name)
+
+
+_hubs = {}
+_hubs_lock = threading.Lock()
+
+
+def default_hub(host='localhost', port=1883, keepalive=None, reactor=None):
+    '''
+    Parameters
+    ----------
+    host : str, optional
+    port : int, optional
+    keepalive : int, optional
+        Keepalive of the connection (60 seconds by default).
+    reactor : reactor.Reactor, optional
+        See :class:`ConnectionHub`.
+
+    Returns
+    -------
+    ConnectionHub
+        Process-wide hub for the broker at :data:`host`::data:`port`
+        (created on first use).
+
+    Raises
+    ------
+    ValueError
+        If the hub already exists with a different :data:`keepalive` or
+        :data:`reactor` than specified.
+    '''
+    with _hubs_lock:
+        hub = _hubs.get((host, port))
+        if hub is None:
+            hub = ConnectionHub(host, port, 60 if keepalive is None else
+                                keepalive, reactor=reactor)
+            _hubs[(host, port)] = hub
+        elif keepalive is not None and keepalive != hub.keepalive:
+            raise ValueError('Hub for `%s:%s` already exists with keepalive '
+                             '%s (not %s).' % (host, port, hub.keepalive,
+                                               keepalive))
+        elif reactor is not None and reactor is not hub.reactor:
+            raise ValueError('Hub for `%s:%s` already exists with a '
+                             'different reactor.' % (host, port))
+        return hub
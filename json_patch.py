@@ -0,0 +1,216 @@
+'''
+`RFC 6902`_ JSON Patch generation for incremental document updates.
+
+.. _`RFC 6902`: https://tools.ietf.org/html/rfc6902
+'''
+from copy import deepcopy
+import hashlib
+import json
+
+
+def _pointer(path, key):
+    return '%s/%s' % (path, ('%s' % key).replace('~', '~0')
+                      .replace('/', '~1'))
+
+
+def _equal(a, b):
+    '''
+    JSON equality, treating ``NaN`` (e.g., missing protocol step values) as
+    equal to itself, and booleans as distinct from numbers (unlike Python,
+    for which ``True == 1``), at any depth.
+    '''
+    if isinstance(a, bool) or isinstance(b, bool):
+        return a is b
+    elif isinstance(a, list):
+        return (isinstance(b, list) and len(a) == len(b) and
+                all(_equal(a_i, b_i) for a_i, b_i in zip(a, b)))
+    elif isinstance(a, dict):
+        return (isinstance(b, dict) and len(a) == len(b) and
+                all(key in b and _equal(value, b[key])
+                    for key, value in a.items()))
+    elif a == b:
+        return True
+    return (isinstance(a, float) and isinstance(b, float) and a != a and
+            b != b)
+
+
+def make_patch(old, new, path=''):
+    '''
+    Parameters
+    ----------
+    old, new : object
+        Decoded JSON documents.
+    path : str, optional
+        JSON pointer of the documents (used for recursion).
+
+    Returns
+    -------
+    list
+        `RFC 6902` operations (``add``, ``remove`` and ``replace`` only)
+        transforming :data:`old` into :data:`new`.
+    '''
+    if isinstance(old, dict) and isinstance(new, dict):
+        patch = []
+        for key in old:
+            if key not in new:
+                patch.append({'op': 'remove', 'path': _pointer(path, key)})
+        for key, value in new.items():
+            if key not in old:
+                patch.append({'op': 'add', 'path': _pointer(path, key),
+                              'value': value})
+            else:
+                patch.extend(make_patch(old[key], value,
+                                        _pointer(path, key)))
+        return patch
+    elif isinstance(old, list) and isinstance(new, list):
+        # Skip the common prefix and suffix, so inserting or removing items
+        # (e.g., protocol steps) only touches the items in between.
+        limit = min(len(old), len(new))
+        start = 0
+        while start < limit and _equal(old[start], new[start]):
+            start += 1
+        tail = 0
+        while (tail < limit - start and
+               _equal(old[len(old) - 1 - tail], new[len(new) - 1 - tail])):
+            tail += 1
+        old_end = len(old) - tail
+        new_end = len(new) - tail
+        common_end = min(old_end, new_end)
+
+        patch = []
+        for i in range(start, common_end):
+            patch.extend(make_patch(old[i], new[i], _pointer(path, i)))
+        for i in range(common_end, new_end):
+            patch.append({'op': 'add', 'path': _pointer(path, i),
+                          'value': new[i]})
+        for i in range(old_end - 1, common_end - 1, -1):
+            patch.append({'op': 'remove', 'path': _pointer(path, i)})
+        return patch
+    elif not _equal(old, new):
+        return [{'op': 'replace', 'path': path, 'value': new}]
+    return []
+
+
+def apply_patch(document, patch):
+    '''
+    Parameters
+    ----------
+    document : object
+        Decoded JSON document (not modified).
+    patch : list
+        `RFC 6902` ``add``, ``remove`` and ``replace`` operations, e.g., as
+        returned by :func:`make_patch`.
+
+    Returns
+    -------
+    object
+        Patched copy of :data:`document`.
+    '''
+    document = deepcopy(document)
+    for operation in patch:
+        keys = [key.replace('~1', '/').replace('~0', '~')
+                for key in operation['path'].split('/')[1:]]
+        if not keys:
+            if operation['op'] == 'remove':
+                document = None
+            else:
+                document = deepcopy(operation['value'])
+            continue
+        parent = document
+        for key in keys[:-1]:
+            parent = parent[int(key) if isinstance(parent, list) else key]
+        key = keys[-1]
+        if isinstance(parent, list):
+            key = len(parent) if key == '-' else int(key)
+        if operation['op'] == 'remove':
+            del parent[key]
+        elif operation['op'] == 'add' and isinstance(parent, list):
+            parent.insert(key, deepcopy(operation['value']))
+        elif operation['op'] in ('add', 'replace'):
+            parent[key] = deepcopy(operation['value'])
+        else:
+            raise ValueError('Unsupported operation: `%s`' %
+                             operation['op'])
+    return document
+
+
+class DeltaStream(object):
+    '''
+    Encode successive versions of a JSON document as full snapshots or as
+    patches against the most recent snapshot.
+
+    Each delta is a JSON object with the keys:
+
+     - ``seq``: sequence number, incremented for every encoded version.
+     - ``base``: SHA1 hex digest of the snapshot the patch applies to.
+     - ``patch``: `RFC 6902` patch transforming the snapshot into the current
+       version.
+
+    Since every delta is relative to the snapshot (not to the previous
+    delta), only the latest snapshot and the latest delta are needed to
+    rebuild the current version, i.e., both may be published as retained
+    messages for late joiners.
+
+    Parameters
+    ----------
+    snapshot_interval : int
+        Maximum number of deltas encoded before the next version is encoded
+        as a snapshot.  If 0, every version is encoded as a snapshot.
+    max_ratio : float, optional
+        A snapshot is encoded whenever a delta would be larger than this
+        fraction of the full document.
+    '''
+    def __init__(self, snapshot_interval, max_ratio=.5):
+        self.snapshot_interval = snapshot_interval
+        self.max_ratio = max_ratio
+        self.seq = 0
+        self.base = None
+        self._snapshot = None
+        self._delta_count = 0
+
+    def reset(self):
+        self._snapshot = None
+
+    def snapshot(self, document_json):
+        '''
+        Record :data:`document_json` as the base of subsequent deltas.
+
+        Returns
+        -------
+        str
+            JSON-encoded empty delta against the new snapshot.
+        '''
+        if isinstance(document_json, bytes):
+            digest = hashlib.sha1(document_json)
+        else:
+            digest = hashlib.sha1(document_json.encode('utf8'))
+        self.seq += 1
+        self.base = digest.hexdigest()
+        self._snapshot = (json.loads(document_json)
+                          if self.snapshot_interval else None)
+        self._delta_count = 0
+        return self._encode([])
+
+    def delta(self, document_json):
+        '''
+        Returns
+        -------
+        str or None
+            JSON-encoded delta of :data:`document_json` against the current
+            snapshot, or ``None`` if a snapshot should be published instead.
+        '''
+        if (self._snapshot is None or
+                self._delta_count >= self.snapshot_interval):
+            return None
+        patch = make_patch(self._snapshot, json.loads(document_json))
+        self.seq += 1
+        payload = self._encode(patch)
+        if len(payload) > self.max_ratio * len(document_json):
+            self.seq -= 1
+            return None
+        self._delta_count += 1
+        return payload
+
+    def _encode(self, patch):
+        return json.dumps({'seq': self.seq, 'base': self.base,
+                           'patch': patch})
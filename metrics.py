@@ -0,0 +1,454 @@
+'''
+Instrumentation of message handling.
+'''
+from bisect import bisect_left
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class Histogram(object):
+    '''
+    Histogram of durations (in seconds) with logarithmic buckets, so
+    percentiles are accurate to within a fixed ratio (:data:`factor`) across
+    many orders of magnitude.
+
+    Parameters
+    ----------
+    minimum : float, optional
+        Upper bound of the first bucket.
+    maximum : float, optional
+        Upper bound of the last finite bucket (larger values are counted in
+        an overflow bucket).
+    factor : float, optional
+        Ratio between the upper bounds of consecutive buckets.
+    '''
+    def __init__(self, minimum=1e-5, maximum=100., factor=1.25):
+        self.bounds = []
+        bound = minimum
+        while bound < maximum * factor:
+            self.bounds.append(bound)
+            bound *= factor
+        # One count per bucket, plus overflow.
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.
+        self._min = float('inf')
+        self._max = float('-inf')
+        self._lock = threading.Lock()
+
+    @property
+    def min(self):
+        return self._min if self.count else None
+
+    @property
+    def max(self):
+        return self._max if self.count else None
+
+    def observe(self, value):
+        index = bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+            if value < self._min:
+                self._min = value
+            if value > self._max:
+                self._max = value
+
+    def percentile(self, fraction):
+        '''
+        Returns
+        -------
+        float or None
+            Upper bound of the bucket holding the :data:`fraction` quantile
+            (capped to the largest observed value), or ``None`` if no value
+            was observed.
+        '''
+        with self._lock:
+            if not self.count:
+                return None
+            rank = fraction * self.count
+            total = 0
+            for index, count in enumerate(self.counts):
+                total += count
+                if total >= rank and count:
+                    break
+            if index == len(self.bounds):
+                return self.max
+            return min(self.bounds[index], self.max)
+
+    def cumulative_counts(self):
+        '''
+        Returns
+        -------
+        list
+            ``(upper_bound, count)`` for each bucket, where ``count`` is the
+            number of values less than or equal to ``upper_bound`` (the last
+            bound is ``float('inf')``).
+        '''
+        with self._lock:
+            counts = list(self.counts)
+        result = []
+        total = 0
+        for bound, count in zip(self.bounds + [float('inf')], counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def summary(self):
+        '''
+        dict
+            ``count``, ``mean``, ``min``, ``max`` and ``p50``/``p90``/``p99``
+            percentiles (see :meth:`percentile`).
+        '''
+        return {'count': self.count,
+                'mean': self.sum / self.count if self.count else None,
+                'min': self.min, 'max': self.max,
+                'p50': self.percentile(.5), 'p90': self.percentile(.9),
+                'p99': self.percentile(.99)}
+
+
+def _labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, ('%s' % value)
+                                         .replace('\\', '\\\\')
+                                         .replace('"', '\\"')
+                                         .replace('\n', '\\n'))
+                             for key, value in pairs)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Counter(object):
+    '''
+    Monotonically increasing count (e.g., of messages or bytes).
+    '''
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def increment(self, value=1):
+        with self._lock:
+            self.value += value
+
+
+class MetricsRegistry(object):
+    '''
+    Counters, histograms and gauges identified by name and labels (e.g.,
+    ``topic``).
+
+    Counters and histograms are updated by the instrumented code; gauges are
+    functions evaluated when metrics are collected (e.g., queue depths).
+
+    .. note::
+        Looking up a counter or histogram by name and labels takes longer
+        than updating it, so instrumentation on hot paths should keep the
+        objects returned by :meth:`counter` and :meth:`histogram`.
+    '''
+    def __init__(self):
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = []
+        self._help = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name, help_text):
+        self._help[name] = help_text
+
+    def counter(self, name, **labels):
+        '''
+        Returns
+        -------
+        Counter
+            Counter for :data:`name` and :data:`labels` (created on first
+            use).
+        '''
+        key = (name, _labels_key(labels))
+        counter = self._counters.get(key)
+        if counter is None:
+            with self._lock:
+                counter = self._counters.setdefault(key, Counter())
+        return counter
+
+    def increment(self, name, value=1, **labels):
+        self.counter(name, **labels).increment(value)
+
+    def histogram(self, name, **labels):
+        '''
+        Returns
+        -------
+        Histogram
+            Histogram for :data:`name` and :data:`labels` (created on first
+            use).
+        '''
+        key = (name, _labels_key(labels))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, Histogram())
+        return histogram
+
+    def observe(self, name, value, **labels):
+        self.histogram(name, **labels).observe(value)
+
+    def gauge(self, name, function):
+        '''
+        Parameters
+        ----------
+        function : function
+            Returns the current value, or a list of ``(labels, value)``
+            pairs (``labels`` being a dictionary).  Gauges with a ``None``
+            value are skipped.
+        '''
+        self._gauges.append((name, function))
+
+    def _gauge_samples(self):
+        for name, function in self._gauges:
+            try:
+                value = function()
+            except Exception:
+                logger.debug('Error evaluating gauge `%s`.', name,
+                             exc_info=True)
+                continue
+            if not isinstance(value, list):
+                value = [({}, value)]
+            for labels, value_i in value:
+                if value_i is not None:
+                    yield name, _labels_key(labels), value_i
+
+    def histograms(self, name):
+        '''
+        Returns
+        -------
+        list
+            ``(labels, histogram)`` for each histogram named :data:`name`.
+        '''
+        with self._lock:
+            return [(dict(labels), histogram) for (name_i, labels), histogram
+                    in self._histograms.items() if name_i == name]
+
+    def collect(self):
+        '''
+        Returns
+        -------
+        dict
+            Counters, gauges and histogram summaries (see
+            :meth:`Histogram.summary`), by name, each as a list of
+            ``{"labels": ..., "value": ...}`` samples.
+        '''
+        with self._lock:
+            counters = [(key, counter.value)
+                        for key, counter in self._counters.items()]
+            histograms = list(self._histograms.items())
+        result = {'counters': {}, 'gauges': {}, 'histograms': {}}
+        for (name, labels), value in counters:
+            result['counters'].setdefault(name, []).append(
+                {'labels': dict(labels), 'value': value})
+        for name, labels, value in self._gauge_samples():
+            result['gauges'].setdefault(name, []).append(
+                {'labels': dict(labels), 'value': value})
+        for (name, labels), histogram in histograms:
+            result['histograms'].setdefault(name, []).append(
+                {'labels': dict(labels), 'value': histogram.summary()})
+        return result
+
+    def to_prometheus(self):
+        '''
+        Returns
+        -------
+        str
+            Metrics in the Prometheus text exposition format.
+        '''
+        with self._lock:
+            counters = sorted((key, counter.value)
+                              for key, counter in self._counters.items())
+            histograms = sorted(self._histograms.items(),
+                                key=lambda item: item[0])
+        samples = {}
+        types = {}
+        for (name, labels), value in counters:
+            types[name] = 'counter'
+            samples.setdefault(name, []).append(
+                '%s%s %s' % (name, _format_labels(labels),
+                             _format_value(value)))
+        for name, labels, value in self._gauge_samples():
+            types[name] = 'gauge'
+            samples.setdefault(name, []).append(
+                '%s%s %s' % (name, _format_labels(labels),
+                             _format_value(value)))
+        for (name, labels), histogram in histograms:
+            types[name] = 'histogram'
+            lines = samples.setdefault(name, [])
+            for bound, count in histogram.cumulative_counts():
+                lines.append('%s_bucket%s %d' %
+                             (name, _format_labels(labels,
+                                                   [('le', _format_value(
+                                                       bound))]), count))
+            lines.append('%s_sum%s %s' % (name, _format_labels(labels),
+                                          _format_value(histogram.sum)))
+            lines.append('%s_count%s %d' % (name, _format_labels(labels),
+                                            histogram.count))
+        output = []
+        for name in sorted(samples):
+            if name in self._help:
+                output.append('# HELP %s %s' % (name, self._help[name]))
+            output.append('# TYPE %s %s' % (name, types[name]))
+            output.extend(samples[name])
+        return '\n'.join(output) + '\n'
+
+
+class TopicMetrics(object):
+    '''
+    Counters and latency histograms of a single topic, looked up once in a
+    :class:`MetricsRegistry`.
+
+    Parameters
+    ----------
+    registry : MetricsRegistry
+    topic : str
+        Value of the ``topic`` label.
+    prefix : str, optional
+        Prefix of metric names.
+    sample_interval : int, optional
+        Latencies are observed for one in this many messages (see
+        :meth:`sample`).
+
+    Attributes
+    ----------
+    received_messages, received_bytes, published_messages, published_bytes,
+    decode_errors : Counter
+        Created on first access, so only counters in use are reported.
+    '''
+    COUNTERS = ('received_messages', 'received_bytes', 'published_messages',
+                'published_bytes', 'decode_errors')
+
+    def __init__(self, registry, topic, prefix='mqtt_plugin',
+                 sample_interval=1):
+        self.registry = registry
+        self.topic = topic
+        self.prefix = prefix
+        self.sample_interval = sample_interval
+        self._latencies = {}
+        self._sample_index = 0
+
+    def __getattr__(self, name):
+        if name not in self.COUNTERS:
+            raise AttributeError(name)
+        counter = self.registry.counter('%s_%s_total' % (self.prefix, name),
+                                        topic=self.topic)
+        # Later lookups find the instance attribute.
+        setattr(self, name, counter)
+        return counter
+
+    def latency(self, stage):
+        '''
+        Returns
+        -------
+        Histogram
+            Latency histogram of :data:`stage` (e.g., ``'handler'``).
+        '''
+        histogram = self._latencies.get(stage)
+        if histogram is None:
+            histogram = self.registry.histogram('%s_latency_seconds' %
+                                                self.prefix,
+                                                topic=self.topic, stage=stage)
+            self._latencies[stage] = histogram
+        return histogram
+
+    def sample(self):
+        '''
+        Returns
+        -------
+        bool
+            ``True`` for one in :attr:`sample_interval` calls (starting with
+            the first), i.e., whether the latencies of the current message
+            are to be observed.
+        '''
+        index = self._sample_index
+        self._sample_index = (index + 1) % self.sample_interval
+        return index == 0
+
+
+class PeriodicTask(object):
+    '''
+    Daemon thread calling :data:`function` every :data:`interval` seconds.
+    '''
+    def __init__(self, interval, function, name='mqtt-plugin-periodic'):
+        self.interval = interval
+        self.function = function
+        self.name = name
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name=self.name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.function()
+            except Exception:
+                logger.exception('Error in periodic task `%s`.', self.name)
+
+
+def serve_prometheus(registry, port, host='127.0.0.1'):
+    '''
+    Serve :meth:`MetricsRegistry.to_prometheus` over HTTP (at any path) on a
+    daemon thread.
+
+    Returns
+    -------
+    BaseHTTPServer.HTTPServer
+        Server (call ``shutdown()`` to stop it).
+    '''
+    try:
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    except ImportError:
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = registry.to_prometheus().encode('utf8')
+            self.send_response(200)
+            self.send_header('Content-Type',
+                             'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(format, *args)
+
+    server = HTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever,
+                              name='mqtt-plugin-metrics-http')
+    thread.daemon = True
+    thread.start()
+    return server
@@ -0,0 +1,235 @@
+'''
+Outbound pipeline batching and rate limiting published messages.
+'''
+from collections import OrderedDict
+import itertools
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket(object):
+    '''
+    Token bucket rate limiter.
+
+    Parameters
+    ----------
+    rate : float
+        Tokens added per second.
+    burst : int, optional
+        Bucket capacity, i.e., maximum number of tokens taken at once after an
+        idle period (default: one second worth of tokens).
+    '''
+    def __init__(self, rate, burst=None, clock=time.time):
+        self.rate = float(rate)
+        self.burst = max(1, int(burst or rate))
+        self.tokens = float(self.burst)
+        self._clock = clock
+        self._last = clock()
+
+    def _refill(self):
+        now = self._clock()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def take(self, count=1):
+        '''
+        Returns
+        -------
+        int
+            Number of tokens taken (at most :data:`count`).
+        '''
+        self._refill()
+        taken = min(count, int(self.tokens))
+        self.tokens -= taken
+        return taken
+
+    def delay(self):
+        '''
+        Returns
+        -------
+        float
+            Seconds until a token is available.
+        '''
+        self._refill()
+        return max(0., (1 - self.tokens) / self.rate)
+
+
+class Outbox(object):
+    '''
+    Worker thread sending queued messages in batches, on every tick of
+    :data:`interval` seconds or as soon as :data:`batch_size` messages are
+    pending, whichever comes first.
+
+    Retained messages are coalesced per topic: a retained message replaces
+    the pending retained message on the same topic (keeping its position),
+    since subscribers only ever see the latest retained value.  Other
+    messages are sent in order.
+
+    Bulk messages (e.g., chunks of a large payload, see :mod:`chunking`) are
+    queued in a separate, low priority lane: at most :data:`bulk_batch_size`
+    of them are sent per flush, after all other pending messages, so small
+    control messages are not held up behind a large transfer.  Bulk messages
+    are never dropped.
+
+    Parameters
+    ----------
+    send : function
+        Called as ``send(topic, payload, qos, retain)`` for each message, on
+        the worker thread.
+    interval : float, optional
+        Seconds between flushes.
+    batch_size : int, optional
+        Number of pending messages triggering an immediate flush.
+    rate : float, optional
+        Maximum number of messages sent per second (see
+        :class:`TokenBucket`); unlimited if not set.
+    burst : int, optional
+        Maximum number of messages sent at once under :data:`rate`.
+    maxsize : int, optional
+        Maximum number of pending messages; the oldest pending message is
+        dropped to make room for a new one.
+    bulk_batch_size : int, optional
+        Maximum number of bulk messages sent per flush.
+
+    Attributes
+    ----------
+    sent : int
+        Number of messages sent.
+    coalesced : int
+        Number of retained messages replaced by a more recent message on the
+        same topic before being sent.
+    dropped : int
+        Number of messages dropped due to overflow.
+    throttled : int
+        Number of flushes that left messages pending due to :data:`rate`.
+    '''
+    def __init__(self, send, interval=.05, batch_size=100, rate=None,
+                 burst=None, maxsize=1000, bulk_batch_size=4):
+        self.send = send
+        self.interval = interval
+        self.batch_size = batch_size
+        self.maxsize = maxsize
+        self.bulk_batch_size = bulk_batch_size
+        self.bucket = None if rate is None else TokenBucket(rate, burst)
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.throttled = 0
+        # Maps `topic` (retained messages) or a sequence number (other
+        # messages) to `(topic, payload, qos, retain)`.
+        self._pending = OrderedDict()
+        # Bulk messages, keyed the same way.
+        self._bulk = OrderedDict()
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        # Only one thread sends at a time, so messages are sent in order.
+        self._send_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        with self._lock:
+            return len(self._pending) + len(self._bulk)
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {'pending': len(self._pending) + len(self._bulk),
+                    'bulk_pending': len(self._bulk), 'sent': self.sent,
+                    'coalesced': self.coalesced, 'dropped': self.dropped,
+                    'throttled': self.throttled}
+
+    def put(self, topic, payload=None, qos=0, retain=False, bulk=False):
+        '''
+        Queue message, in the low priority lane if :data:`bulk` is ``True``.
+        '''
+        with self._lock:
+            key = ('retain', topic) if retain else next(self._sequence)
+            pending = self._bulk if bulk else self._pending
+            if key in pending:
+                self.coalesced += 1
+            elif not bulk and len(pending) >= self.maxsize:
+                pending.popitem(last=False)
+                self.dropped += 1
+            pending[key] = (topic, payload, qos, retain)
+            if not bulk and len(pending) >= self.batch_size:
+                self._wake.notify()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='mqtt-plugin-outbox')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        '''
+        Stop the worker thread, then send all pending messages (regardless of
+        the rate limit).
+        '''
+        self._stop_event.set()
+        with self._lock:
+            self._wake.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        self.flush(limit=False)
+
+    def flush(self, limit=True):
+        '''
+        Send pending messages, as allowed by the rate limit and
+        :attr:`bulk_batch_size` (if :data:`limit` is ``True``).
+
+        Returns
+        -------
+        int
+            Number of messages still pending.
+        '''
+        with self._send_lock:
+            with self._lock:
+                count = len(self._pending)
+                bulk_count = len(self._bulk)
+                if limit:
+                    bulk_count = min(bulk_count, self.bulk_batch_size)
+                    if self.bucket is not None and count + bulk_count:
+                        taken = self.bucket.take(count + bulk_count)
+                        if taken < count + bulk_count:
+                            self.throttled += 1
+                        bulk_count = max(0, taken - count)
+                        count = min(count, taken)
+                batch = [self._pending.popitem(last=False)[1]
+                         for i in range(count)]
+                batch += [self._bulk.popitem(last=False)[1]
+                          for i in range(bulk_count)]
+                remaining = len(self._pending) + len(self._bulk)
+            for message in batch:
+                try:
+                    self.send(*message)
+                except Exception:
+                    logger.exception('Error publishing to `%s`.', message[0])
+            with self._lock:
+                self.sent += len(batch)
+        return remaining
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            with self._lock:
+                if len(self._pending) < self.batch_size:
+                    self._wake.wait(self.interval)
+            if self._stop_event.is_set():
+                break
+            if self.flush() and self.bucket is not None:
+                # Wait for the rate limit rather than spinning.
+                self._stop_event.wait(min(self.interval,
+                                          self.bucket.delay()))
@@ -0,0 +1,318 @@
+'''
+Payload codecs for MQTT messages.
+
+JSON is the default codec.  MessagePack and CBOR codecs are available when
+the optional ``msgpack`` and ``cbor2`` packages are installed; both encode
+numeric :mod:`numpy` arrays (and the index/values of :mod:`pandas` series and
+data frames) as raw binary buffers rather than as text.
+'''
+import json
+import sys
+
+from .topics import TopicTrie
+
+#: MessagePack extension type codes.
+EXT_NDARRAY = 1
+EXT_SERIES = 2
+EXT_DATAFRAME = 3
+
+#: CBOR tags: multi-dimensional array (`RFC 8746`_) and typed object
+#: (``[type_name, *arguments]``).
+#:
+#: .. _`RFC 8746`: https://tools.ietf.org/html/rfc8746
+TAG_MULTI_DIM_ARRAY = 40
+TAG_OBJECT = 27
+
+
+def _is_array_like(obj):
+    return type(obj).__module__.split('.')[0] in ('numpy', 'pandas')
+
+
+def _raw_array(array):
+    '''
+    Returns
+    -------
+    tuple or None
+        ``(dtype_str, shape, data)`` for a numeric :class:`numpy.ndarray`,
+        or ``None`` if the array holds Python objects (e.g., strings).
+    '''
+    if array.dtype.kind not in 'biufc':
+        return None
+    import numpy as np
+
+    return (array.dtype.str, list(array.shape),
+            np.ascontiguousarray(array).tobytes())
+
+
+def _array_from_raw(dtype_str, shape, data):
+    import numpy as np
+
+    return np.frombuffer(data, dtype=np.dtype(dtype_str)).reshape(shape)
+
+
+def _frame_parts(obj):
+    '''
+    Returns
+    -------
+    tuple
+        ``(type_name, arguments)`` describing a :mod:`pandas` or
+        :mod:`numpy` object in terms of arrays and plain Python objects, or
+        ``(None, value)`` for a scalar.
+    '''
+    import numpy as np
+    import pandas as pd
+
+    if isinstance(obj, pd.DataFrame):
+        return 'pandas.DataFrame', [np.asarray(obj.index), obj.index.name,
+                                    obj.columns.tolist(),
+                                    [np.asarray(obj[column])
+                                     for column in obj.columns]]
+    elif isinstance(obj, pd.Series):
+        return 'pandas.Series', [np.asarray(obj.index), obj.index.name,
+                                 obj.name, np.asarray(obj)]
+    elif isinstance(obj, pd.Index):
+        return None, obj.tolist()
+    elif isinstance(obj, np.ndarray):
+        return 'numpy.ndarray', obj
+    elif isinstance(obj, np.generic):
+        return None, obj.item()
+    raise TypeError('Cannot encode `%s`' % type(obj))
+
+
+def _frame_from_parts(type_name, arguments):
+    import pandas as pd
+
+    if type_name == 'pandas.DataFrame':
+        index, index_name, columns, values = arguments
+        frame = pd.DataFrame(dict(zip(columns, values)), columns=columns,
+                             index=pd.Index(index, name=index_name))
+        return frame
+    elif type_name == 'pandas.Series':
+        index, index_name, name, values = arguments
+        return pd.Series(values, index=pd.Index(index, name=index_name),
+                         name=name)
+    raise ValueError('Unknown object type: `%s`' % type_name)
+
+
+class JsonCodec(object):
+    '''
+    Parameters
+    ----------
+    encoder_cls : json.JSONEncoder, optional
+        Encoder class, e.g., :class:`zmq_plugin.schema.PandasJsonEncoder`.
+    object_hook : function, optional
+        See :func:`json.loads`, e.g.,
+        :func:`zmq_plugin.schema.pandas_object_hook`.
+    '''
+    name = 'json'
+    content_type = 'application/json'
+
+    def __init__(self, encoder_cls=None, object_hook=None):
+        self.encoder_cls = encoder_cls
+        self.object_hook = object_hook
+
+    def encode(self, obj):
+        return json.dumps(obj, cls=self.encoder_cls)
+
+    def decode(self, payload):
+        if isinstance(payload, bytes) and not isinstance(payload, str):
+            payload = payload.decode('utf8')
+        return json.loads(payload, object_hook=self.object_hook)
+
+
+class MsgpackCodec(object):
+    name = 'msgpack'
+    content_type = 'application/msgpack'
+
+    def __init__(self):
+        import msgpack
+
+        self._msgpack = msgpack
+
+    def _default(self, obj):
+        if not _is_array_like(obj):
+            raise TypeError('Cannot encode `%s`' % type(obj))
+        type_name, arguments = _frame_parts(obj)
+        if type_name is None:
+            return arguments
+        elif type_name == 'numpy.ndarray':
+            raw = _raw_array(arguments)
+            if raw is None:
+                return arguments.tolist()
+            return self._msgpack.ExtType(EXT_NDARRAY, self.encode(list(raw)))
+        code = EXT_SERIES if type_name == 'pandas.Series' else EXT_DATAFRAME
+        return self._msgpack.ExtType(code, self.encode(arguments))
+
+    def _ext_hook(self, code, data):
+        if code == EXT_NDARRAY:
+            return _array_from_raw(*self.decode(data))
+        elif code == EXT_SERIES:
+            return _frame_from_parts('pandas.Series', self.decode(data))
+        elif code == EXT_DATAFRAME:
+            return _frame_from_parts('pandas.DataFrame', self.decode(data))
+        return self._msgpack.ExtType(code, data)
+
+    def encode(self, obj):
+        return self._msgpack.packb(obj, default=self._default,
+                                   use_bin_type=True)
+
+    def decode(self, payload):
+        return self._msgpack.unpackb(payload, ext_hook=self._ext_hook,
+                                     raw=False)
+
+
+class CborCodec(object):
+    name = 'cbor'
+    content_type = 'application/cbor'
+
+    def __init__(self):
+        import cbor2
+
+        self._cbor2 = cbor2
+
+    @staticmethod
+    def _typed_array_tag(dtype_str):
+        '''
+        Returns
+        -------
+        int or None
+            `RFC 8746` typed array tag for a :mod:`numpy` dtype string, e.g.,
+            86 for ``'<f8'``, or ``None`` if there is none (e.g., complex).
+        '''
+        byte_order, kind, size = dtype_str[0], dtype_str[1], \
+            int(dtype_str[2:])
+        if kind not in 'iuf' or size not in (1, 2, 4, 8, 16):
+            return None
+        little_endian = (byte_order == '<' or (byte_order in '=|' and
+                                               sys.byteorder == 'little'))
+        if kind == 'f':
+            length_code = {2: 0, 4: 1, 8: 2, 16: 3}.get(size)
+            if length_code is None:
+                return None
+            return 0x50 | (little_endian << 2) | length_code
+        length_code = {1: 0, 2: 1, 4: 2, 8: 3}.get(size)
+        if length_code is None:
+            return None
+        if size == 1:
+            # Single byte arrays have no byte order.
+            return 0x40 | ((kind == 'i') << 3)
+        return 0x40 | ((kind == 'i') << 3) | (little_endian << 2) | \
+            length_code
+
+    @staticmethod
+    def _dtype_from_tag(tag):
+        if tag & 0x10:
+            size = 2 << (tag & 0x3)
+            kind = 'f'
+        else:
+            size = 1 << (tag & 0x3)
+            kind = 'i' if tag & 0x8 else 'u'
+        byte_order = '|' if size == 1 else ('<' if tag & 0x4 else '>')
+        return '%s%s%d' % (byte_order, kind, size)
+
+    def _default(self, encoder, obj):
+        if not _is_array_like(obj):
+            raise TypeError('Cannot encode `%s`' % type(obj))
+        type_name, arguments = _frame_parts(obj)
+        if type_name is None:
+            encoder.encode(arguments)
+        elif type_name == 'numpy.ndarray':
+            raw = _raw_array(arguments)
+            tag = None if raw is None else self._typed_array_tag(raw[0])
+            if tag is None:
+                encoder.encode(arguments.tolist())
+            else:
+                encoder.encode(self._cbor2.CBORTag(
+                    TAG_MULTI_DIM_ARRAY,
+                    [raw[1], self._cbor2.CBORTag(tag, raw[2])]))
+        else:
+            encoder.encode(self._cbor2.CBORTag(TAG_OBJECT,
+                                               [type_name] + arguments))
+
+    def _tag_hook(self, *args):
+        # Called as `tag_hook(decoder, tag)` by cbor2 < 6 and as
+        # `tag_hook(tag, immutable)` by later versions.
+        tag = [arg for arg in args if isinstance(arg, self._cbor2.CBORTag)][0]
+        if tag.tag == TAG_MULTI_DIM_ARRAY:
+            shape, array = tag.value
+            return array.reshape(shape)
+        elif 0x40 <= tag.tag <= 0x57 and tag.tag != 0x44:
+            return _array_from_raw(self._dtype_from_tag(tag.tag), [-1],
+                                   tag.value)
+        elif tag.tag == TAG_OBJECT:
+            return _frame_from_parts(tag.value[0], tag.value[1:])
+        return tag
+
+    def encode(self, obj):
+        return self._cbor2.dumps(obj, default=self._default)
+
+    def decode(self, payload):
+        return self._cbor2.loads(payload, tag_hook=self._tag_hook)
+
+
+#: Codec classes by name.
+CODECS = {'json': JsonCodec, 'msgpack': MsgpackCodec, 'cbor': CborCodec}
+
+
+class CodecRegistry(object):
+    '''
+    Selects the payload codec for each topic.
+
+    Parameters
+    ----------
+    default : JsonCodec
+        Codec used for topics without an explicit codec.
+    topic_codecs : dict, optional
+        Codec name (see :data:`CODECS`) by topic filter.
+
+    Raises
+    ------
+    ImportError
+        If the package required by a configured codec is not installed.
+    '''
+    def __init__(self, default, topic_codecs=None):
+        self.default = default
+        self._codecs = {default.name: default,
+                        default.content_type: default}
+        self._topics = TopicTrie()
+        for topic_filter, name in (topic_codecs or {}).items():
+            self._topics[topic_filter] = self.get(name)
+
+    def get(self, name):
+        '''
+        Parameters
+        ----------
+        name : str
+            Codec name or content type.
+        '''
+        if name not in self._codecs:
+            for codec_cls in CODECS.values():
+                if name in (codec_cls.name, codec_cls.content_type):
+                    codec = codec_cls()
+                    self._codecs[codec.name] = codec
+                    self._codecs[codec.content_type] = codec
+                    break
+            else:
+                raise KeyError('Unknown codec: `%s`' % name)
+        return self._codecs[name]
+
+    def for_topic(self, topic):
+        codecs = self._topics.match(topic)
+        return codecs[0] if codecs else self.default
+
+    def for_message(self, msg):
+        '''
+        Returns
+        -------
+        object
+            Codec matching the MQTT v5 ``Content Type`` property of
+            :data:`msg`, if any; otherwise, codec of the message topic.
+        '''
+        properties = getattr(msg, 'properties', None)
+        content_type = getattr(properties, 'ContentType', None)
+        if content_type:
+            try:
+                return self.get(content_type)
+            except (KeyError, ImportError):
+                pass
+        return self.for_topic(msg.topic)
@@ -0,0 +1,159 @@
+'''
+On-demand profiling of message handling.
+'''
+import cProfile
+import marshal
+import pstats
+import random
+import threading
+import time
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+
+class HandlerProfiler(object):
+    '''
+    Collects a :mod:`cProfile` profile of a sample of handler calls while
+    active.
+
+    Calls made through :meth:`call` while no capture is active cost one
+    attribute check.
+
+    Attributes
+    ----------
+    sampled : int
+        Number of calls profiled during the current (or last) capture.
+    skipped : int
+        Number of calls not sampled during the current (or last) capture.
+    '''
+    def __init__(self):
+        self.active = False
+        self.sample_rate = 1.
+        self.started = None
+        self.sampled = 0
+        self.skipped = 0
+        self._profile = None
+        self._timer = None
+        self._lock = threading.Lock()
+        self._random = random.Random()
+
+    def start(self, duration=None, sample_rate=1., on_stop=None):
+        '''
+        Start a capture, discarding any capture in progress.
+
+        Parameters
+        ----------
+        duration : float, optional
+            Seconds after which the capture is stopped automatically (see
+            :meth:`stop`).
+        sample_rate : float, optional
+            Fraction of calls to profile.
+        on_stop : function, optional
+            Called as ``on_stop(stats)`` (see :meth:`stop`) once the capture
+            stops automatically after :data:`duration`.
+        '''
+        with self._lock:
+            self._cancel_timer()
+            self._profile = cProfile.Profile()
+            self.sample_rate = sample_rate
+            self.sampled = 0
+            self.skipped = 0
+            self.started = time.time()
+            self.active = True
+            if duration is not None:
+                self._timer = threading.Timer(duration, self._expire,
+                                              args=(on_stop, ))
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _expire(self, on_stop):
+        stats = self.stop()
+        if stats is not None and on_stop is not None:
+            on_stop(stats)
+
+    def stop(self):
+        '''
+        Returns
+        -------
+        dict or None
+            Profile statistics of the capture, in the :mod:`pstats` layout
+            (i.e., as written by :meth:`cProfile.Profile.dump_stats`), or
+            ``None`` if no capture was active.
+        '''
+        with self._lock:
+            self._cancel_timer()
+            if not self.active:
+                return None
+            self.active = False
+            self._profile.create_stats()
+            stats = self._profile.stats
+            self._profile = None
+            return stats
+
+    def call(self, function, *args):
+        '''
+        Call :data:`function`, profiling the call if a capture is active and
+        the call is sampled.
+        '''
+        if not self.active:
+            return function(*args)
+        with self._lock:
+            profile = self._profile
+            if profile is None or self._random.random() >= self.sample_rate:
+                self.skipped += 1
+                profile = None
+            else:
+                self.sampled += 1
+        if profile is None:
+            return function(*args)
+        return profile.runcall(function, *args)
+
+
+def dump_stats(stats):
+    '''
+    Returns
+    -------
+    bytes
+        :data:`stats` serialized as a :mod:`pstats` file (readable by
+        :class:`pstats.Stats` and tools such as ``snakeviz``, ``gprof2dot``
+        or ``flameprof``).
+    '''
+    return marshal.dumps(stats)
+
+
+def summarize(stats, limit=20, sort='cumulative'):
+    '''
+    Returns
+    -------
+    list
+        ``{"function", "calls", "tottime", "cumtime"}`` for the :data:`limit`
+        top functions by :data:`sort` order (see
+        :meth:`pstats.Stats.sort_stats`).
+    '''
+    holder = _StatsHolder(stats)
+    sorted_stats = pstats.Stats(holder, stream=StringIO()).sort_stats(sort)
+    summary = []
+    for function in sorted_stats.fcn_list[:limit]:
+        calls, primitive_calls, tottime, cumtime, callers = \
+            sorted_stats.stats[function]
+        summary.append({'function': pstats.func_std_string(function),
+                        'calls': calls, 'tottime': tottime,
+                        'cumtime': cumtime})
+    return summary
+
+
+class _StatsHolder(object):
+    # Minimal profiler-like object accepted by `pstats.Stats`.
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
@@ -0,0 +1,391 @@
+'''
+Caching of serialized MicroDrop protocols.
+'''
+from collections import OrderedDict
+import hashlib
+import json
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+import threading
+import weakref
+
+
+def step_digest(step):
+    '''
+    Parameters
+    ----------
+    step : microdrop.protocol.Step
+
+    Returns
+    -------
+    bytes or None
+        SHA1 digest of the plugin data of :data:`step`, or ``None`` if the
+        data cannot be serialized.
+
+        .. note::
+            MicroDrop stores plugin step data pickled, so hashing it is much
+            cheaper than encoding the step as JSON.
+    '''
+    digest = hashlib.sha1()
+    for plugin_name, data in sorted(step.plugin_data.items()):
+        if not isinstance(data, bytes):
+            try:
+                data = pickle.dumps(data, -1)
+            except Exception:
+                return None
+        digest.update(plugin_name.encode('utf8'))
+        digest.update(data)
+    return digest.digest()
+
+
+def _combine_digests(name, step_digests):
+    digest = hashlib.sha1(('%s' % name).encode('utf8'))
+    for step_digest_i in step_digests:
+        if step_digest_i is None:
+            return None
+        digest.update(step_digest_i)
+    return digest.hexdigest()
+
+
+def protocol_revision(protocol):
+    '''
+    Parameters
+    ----------
+    protocol : microdrop.protocol.Protocol
+
+    Returns
+    -------
+    str or None
+        Hex digest identifying the contents of :data:`protocol` (name and step
+        data), or ``None`` if any step cannot be hashed.
+    '''
+    return _combine_digests(protocol.name, (step_digest(step)
+                                            for step in protocol.steps))
+
+
+class _StepFragment(object):
+    '''
+    Digest and JSON-encoded field values of a single protocol step.
+    '''
+    def __init__(self, step, encoder_cls):
+        self.digest = step_digest(step)
+        self._step = weakref.ref(step)
+        self._encoder_cls = encoder_cls
+        self._values = self
+        self._row_keys = None
+        self._row = None
+
+    @property
+    def values(self):
+        '''
+        dict or None
+            JSON-encoded value of each ``(plugin_name, step_field)`` of the
+            step, or ``None`` if the plugin data is not a field dictionary.
+        '''
+        if self._values is self:
+            self._values = {}
+            for plugin_name, data in self._step().plugin_data.items():
+                if isinstance(data, bytes):
+                    data = pickle.loads(data)
+                if not isinstance(data, dict):
+                    self._values = None
+                    break
+                for field, value in data.items():
+                    self._values[(plugin_name, field)] = \
+                        json.dumps(value, cls=self._encoder_cls)
+        return self._values
+
+    def row(self, keys):
+        '''
+        Returns
+        -------
+        str
+            JSON list of the step values for the ``(plugin_name,
+            step_field)`` :data:`keys` (``NaN`` for missing fields).
+        '''
+        if keys is not self._row_keys:
+            self._row = '[%s]' % ', '.join([self.values.get(key, 'NaN')
+                                            for key in keys])
+            self._row_keys = keys
+        return self._row
+
+
+class StepFragmentCache(object):
+    '''
+    Cache of step digests and JSON-encoded step values, used to build the
+    protocol revision and JSON document from per-step fragments.
+
+    Fragments are held per :class:`microdrop.protocol.Step` object (by weak
+    reference), so inserted steps and steps of a newly loaded protocol are
+    encoded on first use, and fragments of deleted steps are dropped along
+    with the step.  Steps modified in place must be passed to
+    :meth:`invalidate`.
+
+    Parameters
+    ----------
+    encoder_cls : json.JSONEncoder, optional
+        Encoder for step field values (e.g.,
+        :class:`zmq_plugin.schema.PandasJsonEncoder`).
+
+    Attributes
+    ----------
+    hits : int
+        Number of step lookups served from the cache.
+    misses : int
+        Number of steps hashed (and possibly encoded).
+    '''
+    def __init__(self, encoder_cls=None):
+        self.encoder_cls = encoder_cls
+        self.hits = 0
+        self.misses = 0
+        self._fragments = weakref.WeakKeyDictionary()
+        self._keys = ()
+        self._lock = threading.Lock()
+
+    @property
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._fragments)}
+
+    def invalidate(self, step=None):
+        '''
+        Drop cached fragment of :data:`step` (or of all steps, if ``None``).
+        '''
+        with self._lock:
+            if step is None:
+                self._fragments.clear()
+            else:
+                self._fragments.pop(step, None)
+
+    def refresh(self, protocol):
+        '''
+        Hash the steps of :data:`protocol` again, dropping the cached
+        fragments of steps modified in place since they were cached (e.g.,
+        without :meth:`invalidate` being called).
+
+        Returns
+        -------
+        int
+            Number of fragments dropped.
+        '''
+        dropped = 0
+        with self._lock:
+            for step in protocol.steps:
+                fragment = self._fragments.get(step)
+                if fragment is not None and \
+                        fragment.digest != step_digest(step):
+                    del self._fragments[step]
+                    dropped += 1
+        return dropped
+
+    def _fragment(self, step):
+        fragment = self._fragments.get(step)
+        if fragment is None:
+            self.misses += 1
+            fragment = _StepFragment(step, self.encoder_cls)
+            self._fragments[step] = fragment
+        else:
+            self.hits += 1
+        return fragment
+
+    def protocol_revision(self, protocol):
+        '''
+        Equivalent to :func:`protocol_revision`, hashing only steps without
+        a cached fragment.
+        '''
+        with self._lock:
+            return _combine_digests(protocol.name,
+                                    [self._fragment(step).digest
+                                     for step in protocol.steps])
+
+    def to_json(self, protocol):
+        '''
+        Returns
+        -------
+        str
+            JSON-encoded protocol in the layout of
+            :meth:`microdrop.protocol.Protocol.to_json` (``keys`` and
+            ``values`` members), stitched from cached step rows.  Falls back
+            to :meth:`microdrop.protocol.Protocol.to_json` if any step cannot
+            be split into fields.
+
+            .. note::
+                ``keys`` is encoded before ``values``, so the document can be
+                decoded incrementally (see
+                :func:`protocol_stream.protocol_from_json`).
+        '''
+        with self._lock:
+            fragments = [self._fragment(step) for step in protocol.steps]
+            if any(fragment.values is None for fragment in fragments):
+                return protocol.to_json()
+            keys = set()
+            for fragment in fragments:
+                keys.update(fragment.values)
+            keys = tuple(sorted(keys))
+            if keys == self._keys:
+                # Reuse the same tuple so cached step rows remain valid.
+                keys = self._keys
+            self._keys = keys
+            return '{"keys": %s, "values": [%s]}' % \
+                (json.dumps([list(key) for key in keys]),
+                 ', '.join([fragment.row(keys) for fragment in fragments]))
+
+
+class LoadedProtocolCache(object):
+    '''
+    Cache of recently loaded protocols, keyed by the digest of the payload
+    they were decoded from (see :func:`snapshot_store.json_digest`).
+
+    A protocol is only returned while its :func:`protocol_revision` matches
+    the revision it had when loaded, i.e., as long as it has not been
+    modified since.
+
+    Parameters
+    ----------
+    maxsize : int, optional
+        Maximum number of cached protocols.
+    fragments : StepFragmentCache, optional
+        If set, revisions are computed from cached step fragments.
+
+    Attributes
+    ----------
+    hits : int
+        Number of lookups served from the cache.
+    misses : int
+        Number of lookups of unknown (or modified) protocols.
+    '''
+    def __init__(self, maxsize=8, fragments=None):
+        self.maxsize = maxsize
+        self.fragments = fragments
+        self.hits = 0
+        self.misses = 0
+        # Maps payload digest to `(protocol, revision)`.
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._entries)}
+
+    def _revision(self, protocol):
+        if self.fragments is not None:
+            return self.fragments.protocol_revision(protocol)
+        return protocol_revision(protocol)
+
+    def get(self, digest):
+        '''
+        Returns
+        -------
+        microdrop.protocol.Protocol or None
+            Unmodified protocol decoded from a payload with :data:`digest`, if
+            any.
+        '''
+        with self._lock:
+            entry = self._entries.pop(digest, None)
+            if entry is not None and entry[1] == self._revision(entry[0]):
+                self._entries[digest] = entry
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            return None
+
+    def put(self, digest, protocol):
+        '''
+        Cache :data:`protocol` decoded from a payload with :data:`digest`
+        (unless its revision cannot be computed).
+        '''
+        revision = self._revision(protocol)
+        if revision is None:
+            return
+        with self._lock:
+            self._entries.pop(digest, None)
+            self._entries[digest] = (protocol, revision)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+
+class ProtocolJsonCache(object):
+    '''
+    Cache of :meth:`microdrop.protocol.Protocol.to_json` output, keyed by
+    protocol identity and :func:`protocol_revision`.
+
+    Parameters
+    ----------
+    maxsize : int, optional
+        Maximum number of cached protocols.
+    fragments : StepFragmentCache, optional
+        If set, revisions and JSON documents are built from cached step
+        fragments rather than from scratch.
+    store : snapshot_store.SnapshotStore, optional
+        If set, JSON documents missing from the cache are looked up by
+        revision in (and added to) this on-disk store, so they persist across
+        restarts.
+
+    Attributes
+    ----------
+    hits : int
+        Number of lookups served from the cache.
+    misses : int
+        Number of lookups that required encoding the protocol.
+    '''
+    def __init__(self, maxsize=4, fragments=None, store=None):
+        self.maxsize = maxsize
+        self.fragments = fragments
+        self.store = store
+        self.hits = 0
+        self.misses = 0
+        # Maps `id(protocol)` to `(protocol_ref, revision, protocol_json)`.
+        self._entries = OrderedDict()
+
+    @property
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._entries)}
+
+    def clear(self):
+        self._entries.clear()
+
+    def to_json(self, protocol):
+        '''
+        Parameters
+        ----------
+        protocol : microdrop.protocol.Protocol
+
+        Returns
+        -------
+        tuple
+            ``(revision, protocol_json)``, where ``revision`` is the
+            :func:`protocol_revision` of :data:`protocol` (possibly ``None``).
+        '''
+        if self.fragments is not None:
+            revision = self.fragments.protocol_revision(protocol)
+        else:
+            revision = protocol_revision(protocol)
+        key = id(protocol)
+        entry = self._entries.pop(key, None)
+        if (entry is not None and revision is not None and
+                entry[0]() is protocol and entry[1] == revision):
+            self.hits += 1
+            self._entries[key] = entry
+            return revision, entry[2]
+
+        self.misses += 1
+        protocol_json = None
+        if self.store is not None and revision is not None:
+            protocol_json = self.store.get(revision)
+        if protocol_json is None:
+            if self.fragments is not None:
+                protocol_json = self.fragments.to_json(protocol)
+            else:
+                protocol_json = protocol.to_json()
+            if self.store is not None and revision is not None:
+                self.store.put(revision, protocol_json)
+        if revision is not None:
+            self._entries[key] = (weakref.ref(protocol), revision,
+                                  protocol_json)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return revision, protocol_json
@@ -0,0 +1,134 @@
+'''
+Incremental decoding of JSON-encoded MicroDrop protocols.
+
+A protocol encoded by :meth:`microdrop.protocol.Protocol.to_json` is an
+object with a ``keys`` list (``[plugin_name, step_field]`` pairs) and a
+``values`` list holding one record per step.  Decoding the whole document with
+:func:`json.loads` materializes every step record (and every pandas object
+within them) before :func:`microdrop.protocol.protocol_from_dict` copies them
+into :class:`microdrop.protocol.Step` objects.
+
+:func:`protocol_from_json` instead walks the ``values`` list one record at a
+time and converts records to steps in fixed size batches, so at most one batch
+of decoded records is alive at any time.
+'''
+import json
+import re
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+def _skip(payload, idx):
+    return _WHITESPACE.match(payload, idx).end()
+
+
+def _expect(payload, idx, delimiters):
+    c = payload[idx:idx + 1]
+    if not c or c not in delimiters:
+        raise ValueError('Expecting one of `%s` at char %d' % (delimiters,
+                                                               idx))
+    return c, _skip(payload, idx + 1)
+
+
+def iter_members(payload, array_key='values', object_hook=None):
+    '''
+    Iterate over the members of a JSON object without decoding it as a whole.
+
+    Parameters
+    ----------
+    payload : str
+        JSON-encoded object.
+    array_key : str, optional
+        Key of a list member whose elements are yielded one at a time rather
+        than as a single list.
+    object_hook : function, optional
+        See :func:`json.loads`.
+
+    Yields
+    ------
+    tuple
+        ``(key, value)`` for each member of the object, except for elements
+        of the :data:`array_key` list, which are yielded as ``(None,
+        element)``.
+    '''
+    if isinstance(payload, bytes) and not isinstance(payload, str):
+        payload = payload.decode('utf8')
+    decoder = json.JSONDecoder(object_hook=object_hook)
+
+    c, idx = _expect(payload, _skip(payload, 0), '{')
+    if payload[idx:idx + 1] == '}':
+        return
+    while True:
+        key, idx = decoder.raw_decode(payload, idx)
+        c, idx = _expect(payload, _skip(payload, idx), ':')
+        if key == array_key and payload[idx:idx + 1] == '[':
+            idx = _skip(payload, idx + 1)
+            c = ',' if payload[idx:idx + 1] != ']' else None
+            if c is None:
+                idx = _skip(payload, idx + 1)
+            while c == ',':
+                element, idx = decoder.raw_decode(payload, idx)
+                yield None, element
+                c, idx = _expect(payload, _skip(payload, idx), ',]')
+        else:
+            value, idx = decoder.raw_decode(payload, idx)
+            yield key, value
+        c, idx = _expect(payload, _skip(payload, idx), ',}')
+        if c == '}':
+            break
+
+
+def protocol_from_json(payload, object_hook=None, batch_size=256):
+    '''
+    Decode a JSON-encoded protocol, building steps as records are parsed.
+
+    Parameters
+    ----------
+    payload : str
+        Protocol encoded by :meth:`microdrop.protocol.Protocol.to_json`.
+    object_hook : function, optional
+        See :func:`json.loads`, e.g.,
+        :func:`zmq_plugin.schema.pandas_object_hook`.
+    batch_size : int, optional
+        Number of step records passed to
+        :func:`microdrop.protocol.protocol_from_dict` at a time.
+
+    Returns
+    -------
+    microdrop.protocol.Protocol
+        Decoded protocol.
+
+    Notes
+    -----
+    Step records are only converted once the ``keys`` member has been parsed.
+    If ``keys`` follows ``values`` in :data:`payload`, all records are held
+    until the end of the document, i.e., memory use is no worse than
+    :func:`json.loads`.
+
+    Any member other than ``keys``/``values`` (e.g., ``name``) is passed to
+    every batch; the last batch is decoded once the whole document has been
+    parsed, so the returned protocol carries all top-level members.
+    '''
+    from microdrop.protocol import protocol_from_dict
+
+    header = {}
+    steps = []
+    records = []
+
+    for key, value in iter_members(payload, object_hook=object_hook):
+        if key is not None:
+            header[key] = value
+            continue
+        records.append(value)
+        if 'keys' in header and len(records) > batch_size:
+            # Always hold back the most recent record so the final batch is
+            # decoded with the complete header.
+            batch = protocol_from_dict(dict(header,
+                                            values=records[:batch_size]))
+            steps.extend(batch.steps)
+            del records[:batch_size]
+
+    protocol = protocol_from_dict(dict(header, values=records))
+    if steps:
+        protocol.steps[:0] = steps
+    return protocol
@@ -0,0 +1,279 @@
+'''
+Event loop sharing a single thread between the network loops of several
+MQTT clients.
+
+Each :class:`MqttPlugin` otherwise runs its own network thread (see
+:class:`connection.Connector`).  A :class:`Reactor` instead drives the socket
+I/O of every registered :class:`paho.mqtt.client.Client` with
+:func:`select.select`, using the paho "external loop" API
+(:meth:`~paho.mqtt.client.Client.loop_read`,
+:meth:`~paho.mqtt.client.Client.loop_write` and
+:meth:`~paho.mqtt.client.Client.loop_misc`), and runs timed callbacks (e.g.,
+flushing published messages) on the same thread.
+'''
+import errno
+import heapq
+import itertools
+import logging
+import select
+import socket
+import threading
+import time
+
+from .connection import Backoff
+
+logger = logging.getLogger(__name__)
+
+
+def _socketpair():
+    '''
+    Returns
+    -------
+    tuple
+        Pair of connected sockets (:func:`socket.socketpair` is not available
+        on Windows under Python 2).
+    '''
+    if hasattr(socket, 'socketpair'):
+        return socket.socketpair()
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        writer = socket.create_connection(listener.getsockname())
+        reader = listener.accept()[0]
+    finally:
+        listener.close()
+    return reader, writer
+
+
+class _Connection(object):
+    def __init__(self, client, host, port, keepalive, backoff):
+        self.client = client
+        self.host = host
+        self.port = port
+        self.keepalive = keepalive
+        self.backoff = backoff
+        self.connected = False
+        self.closed = False
+        self.connects = 0
+
+
+class Reactor(object):
+    '''
+    Single thread running the network loops of several MQTT clients, along
+    with timed callbacks.
+
+    Clients are connected (on a short-lived helper thread, since
+    :meth:`paho.mqtt.client.Client.connect` blocks) and reconnected with
+    :class:`connection.Backoff`, as by :class:`connection.Connector`.
+    '''
+    def __init__(self):
+        self._connections = {}
+        self._timers = []
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self._wake_reader, self._wake_writer = _socketpair()
+        self._wake_reader.setblocking(False)
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='mqtt-plugin-reactor')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop_event.set()
+        self.wake()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def wake(self):
+        '''
+        Interrupt :func:`select.select`, e.g., after a message was published
+        from another thread, so it is written without waiting for the next
+        timeout.
+        '''
+        try:
+            self._wake_writer.send(b'\x00')
+        except socket.error:
+            pass
+
+    def call_later(self, delay, function, *args):
+        '''
+        Call :data:`function` on the reactor thread after :data:`delay`
+        seconds (may be called from any thread).
+
+        Returns
+        -------
+        list
+            Timer handle, see :meth:`cancel`.
+        '''
+        timer = [time.time() + delay, next(self._sequence), function, args]
+        with self._lock:
+            heapq.heappush(self._timers, timer)
+        self.wake()
+        return timer
+
+    def cancel(self, timer):
+        # Cancelled timers are discarded when due.
+        timer[2] = None
+
+    def add_client(self, client, host, port, keepalive=60, backoff=None):
+        '''
+        Connect :data:`client` and run its network loop on the reactor
+        thread.
+
+        Parameters
+        ----------
+        backoff : connection.Backoff, optional
+            Delays between connection attempts (reset by the caller once a
+            connection is acknowledged, as for
+            :class:`connection.Connector`).
+        '''
+        connection = _Connection(client, host, port, keepalive,
+                                 backoff or Backoff())
+        with self._lock:
+            self._connections[id(client)] = connection
+        self._start_connect(connection)
+
+    def remove_client(self, client):
+        with self._lock:
+            connection = self._connections.pop(id(client), None)
+        if connection is not None:
+            connection.closed = True
+            if connection.connected:
+                self.call_later(0, self._disconnect, connection)
+
+    def _disconnect(self, connection):
+        try:
+            connection.client.disconnect()
+            connection.client.loop_write()
+        except Exception:
+            pass
+        connection.connected = False
+
+    def _start_connect(self, connection):
+        thread = threading.Thread(target=self._connect, args=(connection, ),
+                                  name='mqtt-plugin-connect')
+        thread.daemon = True
+        thread.start()
+
+    def _connect(self, connection):
+        try:
+            connection.client.connect(connection.host, connection.port,
+                                      connection.keepalive)
+        except (socket.error, OSError) as exception:
+            logger.debug('Could not connect to `%s:%s`: %s', connection.host,
+                         connection.port, exception)
+            self._retry(connection)
+        else:
+            connection.connects += 1
+            self.call_later(0, self._on_socket_open, connection)
+
+    def _on_socket_open(self, connection):
+        connection.connected = not connection.closed
+
+    def _retry(self, connection):
+        if not connection.closed and not self._stop_event.is_set():
+            self.call_later(connection.backoff.next(), self._start_connect,
+                            connection)
+
+    def _lost(self, connection):
+        connection.connected = False
+        self._retry(connection)
+
+    def _run_timers(self):
+        now = time.time()
+        while True:
+            with self._lock:
+                if not self._timers or self._timers[0][0] > now:
+                    return (self._timers[0][0] - now if self._timers
+                            else None)
+                timer = heapq.heappop(self._timers)
+            if timer[2] is not None:
+                try:
+                    timer[2](*timer[3])
+                except Exception:
+                    logger.exception('Error in reactor callback.')
+
+    def _run(self):
+        last_misc = 0
+        while not self._stop_event.is_set():
+            timeout = self._run_timers()
+            timeout = 1. if timeout is None else min(timeout, 1.)
+            with self._lock:
+                connections = [connection for connection in
+                               self._connections.values()
+                               if connection.connected]
+            sockets = {}
+            writers = []
+            for connection in connections:
+                sock = connection.client.socket()
+                if sock is None:
+                    self._lost(connection)
+                    continue
+                sockets[sock] = connection
+                if connection.client.want_write():
+                    writers.append(sock)
+            try:
+                readable, writable, _ = \
+                    select.select([self._wake_reader] + list(sockets),
+                                  writers, [], timeout)
+            except (select.error, socket.error) as exception:
+                if exception.args[0] == errno.EINTR:
+                    continue
+                # A socket was closed under us; re-check connections.
+                readable, writable = [], []
+            if self._wake_reader in readable:
+                try:
+                    while self._wake_reader.recv(1024):
+                        pass
+                except socket.error:
+                    pass
+            for sock in readable:
+                connection = sockets.get(sock)
+                if connection is not None and connection.connected and \
+                        connection.client.loop_read() != 0:
+                    self._lost(connection)
+            for sock in writable:
+                connection = sockets[sock]
+                if connection.connected and \
+                        connection.client.loop_write() != 0:
+                    self._lost(connection)
+            if time.time() - last_misc >= 1.:
+                # Keepalive pings and timeouts.
+                last_misc = time.time()
+                for connection in sockets.values():
+                    if connection.connected and \
+                            connection.client.loop_misc() != 0:
+                        self._lost(connection)
+
+
+_default_reactor = None
+_default_lock = threading.Lock()
+
+
+def default_reactor():
+    '''
+    Returns
+    -------
+    Reactor
+        Process-wide reactor, started on first use.
+    '''
+    global _default_reactor
+
+    with _default_lock:
+        if _default_reactor is None:
+            _default_reactor = Reactor()
+            _default_reactor.start()
+    return _default_reactor
@@ -0,0 +1,183 @@
+'''
+Compact on-disk log of MQTT traffic, for offline reproduction of field
+sessions.
+
+A log starts with :data:`MAGIC`, followed by one record per message: a
+:data:`HEADER` (timestamp, direction, QoS/retain flags, topic and payload
+lengths), the UTF-8 topic and the raw payload.
+'''
+from collections import namedtuple
+import logging
+import os
+import struct
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'MQTTREC1'
+#: Record header: timestamp (seconds since the epoch), direction, flags
+#: (QoS in bits 0-1, retain in bit 2, no payload in bit 3), topic length and
+#: payload length.
+HEADER = struct.Struct('<dBBHI')
+INBOUND = 0
+OUTBOUND = 1
+
+Record = namedtuple('Record', 'timestamp direction topic payload qos retain')
+
+
+def _payload_bytes(payload):
+    if payload is None or isinstance(payload, bytes):
+        return payload
+    if isinstance(payload, (int, float)):
+        payload = '%s' % payload
+    return payload.encode('utf8')
+
+
+class TrafficRecorder(object):
+    '''
+    Append messages to a traffic log.
+
+    Records are written to a buffered file under a lock, so recording costs
+    roughly one copy of each payload; call :meth:`flush` (or :meth:`close`)
+    to make sure records reach the disk.
+
+    Parameters
+    ----------
+    path : str
+        Log file, created if it does not exist (otherwise, appended to).
+    buffer_size : int, optional
+        Size of the file write buffer (in bytes).
+
+    Attributes
+    ----------
+    count : int
+        Number of records written.
+    '''
+    def __init__(self, path, buffer_size=1 << 16):
+        self.path = path
+        new = not os.path.exists(path) or not os.path.getsize(path)
+        self._file = open(path, 'ab', buffer_size)
+        if new:
+            self._file.write(MAGIC)
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def record(self, direction, topic, payload, qos=0, retain=False,
+               timestamp=None):
+        topic = topic.encode('utf8')
+        payload = _payload_bytes(payload)
+        flags = (qos & 0x3) | (0x4 if retain else 0) | \
+            (0x8 if payload is None else 0)
+        header = HEADER.pack(time.time() if timestamp is None else timestamp,
+                             direction, flags, len(topic),
+                             0 if payload is None else len(payload))
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(header)
+            self._file.write(topic)
+            if payload:
+                self._file.write(payload)
+            self.count += 1
+
+    def flush(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def is_traffic_log(path):
+    with open(path, 'rb') as input_:
+        return input_.read(len(MAGIC)) == MAGIC
+
+
+def read_records(path):
+    '''
+    Iterate over the :class:`Record` entries of a traffic log.
+
+    A truncated final record (e.g., if MicroDrop was killed while recording)
+    is ignored.
+
+    Raises
+    ------
+    ValueError
+        If :data:`path` is not a traffic log.
+    '''
+    with open(path, 'rb') as input_:
+        if input_.read(len(MAGIC)) != MAGIC:
+            raise ValueError('`%s` is not a traffic log.' % path)
+        while True:
+            header = input_.read(HEADER.size)
+            if len(header) < HEADER.size:
+                break
+            timestamp, direction, flags, topic_length, payload_length = \
+                HEADER.unpack(header)
+            topic = input_.read(topic_length)
+            payload = input_.read(payload_length)
+            if (len(topic) < topic_length or
+                    len(payload) < payload_length):
+                logger.warning('Truncated record at end of `%s`.', path)
+                break
+            yield Record(timestamp, direction, topic.decode('utf8'),
+                         None if flags & 0x8 else payload, flags & 0x3,
+                         bool(flags & 0x4))
+
+
+class ReplayMessage(object):
+    '''
+    Stand-in for :class:`paho.mqtt.client.MQTTMessage` built from a
+    :class:`Record`.
+    '''
+    def __init__(self, topic, payload, qos=0, retain=False):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+        self.timestamp = time.time()
+        self.properties = None
+
+
+def replay(records, on_message, speed=1., direction=INBOUND):
+    '''
+    Feed recorded messages to an ``on_message(client, userdata, msg)``
+    callback (e.g., :meth:`MqttPlugin.on_message`), preserving the recorded
+    timing.
+
+    Parameters
+    ----------
+    records : iterable
+        :class:`Record` entries, e.g., from :func:`read_records`.
+    speed : float, optional
+        Replay speed relative to the recording (e.g., 10 replays ten times
+        faster); ``None`` or 0 replays as fast as possible.
+    direction : int, optional
+        Direction of the records to replay (others are skipped).
+
+    Returns
+    -------
+    int
+        Number of replayed messages.
+    '''
+    count = 0
+    start = None
+    for record in records:
+        if record.direction != direction:
+            continue
+        if speed:
+            if start is None:
+                start = (time.time(), record.timestamp)
+            delay = (start[0] + (record.timestamp - start[1]) / speed -
+                     time.time())
+            if delay > 0:
+                time.sleep(delay)
+        on_message(None, None, ReplayMessage(record.topic, record.payload,
+                                             record.qos, record.retain))
+        count += 1
+    return count
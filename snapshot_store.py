@@ -0,0 +1,203 @@
+'''
+Content-addressed on-disk cache of serialized protocols.
+
+Each protocol JSON document is stored in a file named after its SHA1 digest
+(``<sha1>.json``); an index (``index.json``) maps protocol revisions (see
+:func:`protocol_cache.protocol_revision`) to digests.  Since revisions only
+depend on the protocol contents, a protocol that was serialized before (e.g.,
+before MicroDrop was restarted) is read back rather than serialized again.
+'''
+import hashlib
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def _replace(source, destination):
+    # `os.rename()` does not overwrite existing files on Windows.
+    if hasattr(os, 'replace'):
+        os.replace(source, destination)
+    else:
+        if os.path.exists(destination):
+            os.remove(destination)
+        os.rename(source, destination)
+
+
+def _to_bytes(data):
+    return data if isinstance(data, bytes) else data.encode('utf8')
+
+
+def json_digest(protocol_json):
+    '''
+    Returns
+    -------
+    str
+        SHA1 hex digest of a JSON document.
+    '''
+    return hashlib.sha1(_to_bytes(protocol_json)).hexdigest()
+
+
+class SnapshotStore(object):
+    '''
+    Parameters
+    ----------
+    directory : str
+        Cache directory (created if it does not exist).
+    max_entries : int, optional
+        Maximum number of stored protocols; the least recently used are
+        removed first.
+
+    Attributes
+    ----------
+    hits : int
+        Number of lookups served from disk.
+    misses : int
+        Number of lookups of revisions not in the cache.
+    '''
+    def __init__(self, directory, max_entries=32):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        try:
+            with open(self._index_path) as input_:
+                self._index = json.load(input_)
+        except (IOError, OSError, ValueError):
+            self._index = {}
+
+    @property
+    def _index_path(self):
+        return os.path.join(self.directory, 'index.json')
+
+    def _path(self, digest):
+        return os.path.join(self.directory, '%s.json' % digest)
+
+    @property
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._index)}
+
+    def digest(self, revision):
+        '''
+        Returns
+        -------
+        str or None
+            SHA1 digest of the stored JSON document of protocol
+            :data:`revision`, if any.
+        '''
+        return self._index.get(revision)
+
+    def get(self, revision):
+        '''
+        Returns
+        -------
+        str or None
+            Stored JSON document of protocol :data:`revision`, if any.
+        '''
+        with self._lock:
+            digest = self._index.get(revision)
+            data = None if digest is None else self._read(digest)
+            if data is None:
+                self._index.pop(revision, None)
+                self.misses += 1
+                return None
+            self.hits += 1
+        return data
+
+    def get_by_digest(self, digest):
+        '''
+        Returns
+        -------
+        str or None
+            Stored JSON document with SHA1 :data:`digest` (e.g., as published
+            on ``<topic>/sha1`` along with protocol snapshots), if any.
+        '''
+        with self._lock:
+            if digest not in set(self._index.values()):
+                self.misses += 1
+                return None
+            data = self._read(digest)
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return data
+
+    def _read(self, digest):
+        '''
+        Returns
+        -------
+        str or None
+            Contents of the file of :data:`digest`, or ``None`` if it cannot
+            be read or does not match :data:`digest` (the file is then
+            removed, so it is written again by :meth:`put`).
+        '''
+        path = self._path(digest)
+        try:
+            with open(path, 'rb') as input_:
+                data = input_.read()
+            if hashlib.sha1(data).hexdigest() != digest:
+                logger.warning('Cached protocol `%s` is corrupt; removing '
+                               'it.', path)
+                os.remove(path)
+                return None
+            # Mark as recently used.
+            os.utime(path, None)
+        except (IOError, OSError):
+            logger.debug('Could not read cached protocol `%s`.', path,
+                         exc_info=True)
+            return None
+        return data if isinstance(data, str) else data.decode('utf8')
+
+    def put(self, revision, protocol_json):
+        '''
+        Store JSON document of protocol :data:`revision`.
+
+        Returns
+        -------
+        str
+            SHA1 digest of :data:`protocol_json`.
+        '''
+        data = _to_bytes(protocol_json)
+        digest = hashlib.sha1(data).hexdigest()
+        with self._lock:
+            path = self._path(digest)
+            try:
+                if not os.path.exists(path):
+                    temporary_path = '%s.%d.tmp' % (path, os.getpid())
+                    with open(temporary_path, 'wb') as output:
+                        output.write(data)
+                    _replace(temporary_path, path)
+                self._index[revision] = digest
+                self._prune()
+                self._write_index()
+            except (IOError, OSError):
+                logger.warning('Could not cache protocol in `%s`.',
+                               self.directory, exc_info=True)
+        return digest
+
+    def _prune(self):
+        digests = set(self._index.values())
+        if len(digests) <= self.max_entries:
+            return
+        by_age = sorted(digests, key=lambda digest:
+                        os.path.getmtime(self._path(digest))
+                        if os.path.exists(self._path(digest)) else 0)
+        for digest in by_age[:len(digests) - self.max_entries]:
+            for revision in [revision for revision, digest_i in
+                             self._index.items() if digest_i == digest]:
+                del self._index[revision]
+            if os.path.exists(self._path(digest)):
+                os.remove(self._path(digest))
+
+    def _write_index(self):
+        temporary_path = '%s.%d.tmp' % (self._index_path, os.getpid())
+        with open(temporary_path, 'w') as output:
+            json.dump(self._index, output)
+        _replace(temporary_path, self._index_path)
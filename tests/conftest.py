@@ -0,0 +1,52 @@
+'''
+Plugin modules are loaded with `benchmarks/_common.load_module`, so modules
+without MicroDrop dependencies (e.g., `topics`) are tested without importing
+the plugin package.
+
+Run from this directory (``cd tests; python -m pytest``): collected from the
+plugin directory, pytest imports the plugin package itself, which requires
+MicroDrop.
+'''
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'benchmarks'))
+
+
+@pytest.fixture
+def loaded_plugin():
+    '''
+    Plugin with MicroDrop signals recorded (by name, in
+    ``plugin.signals``) rather than emitted, and a protocol controller
+    notifying the plugin of protocol swaps.
+
+    Skipped without the MicroDrop runtime packages.
+    '''
+    pytest.importorskip('microdrop')
+    import harness
+
+    mqtt_plugin = harness.load_plugin()
+    app = harness.FakeApp(None)
+    plugin = harness.create_plugin(app, metrics_interval=None)
+    plugin.app = app
+    plugin.signals = []
+
+    def emit_signal(function, args=None):
+        plugin.signals.append(function)
+
+    def activate_protocol(protocol):
+        old_protocol, app.protocol = app.protocol, protocol
+        plugin.signals.append('on_protocol_swapped')
+        plugin.on_protocol_swapped(old_protocol, protocol)
+
+    emit_signal_ = mqtt_plugin.emit_signal
+    mqtt_plugin.emit_signal = emit_signal
+    app.protocol_controller.activate_protocol = activate_protocol
+    try:
+        yield plugin
+    finally:
+        mqtt_plugin.emit_signal = emit_signal_
+        plugin.stop()
@@ -0,0 +1,71 @@
+import pytest
+
+from _common import load_module
+
+batch_edit = load_module('batch_edit')
+
+
+def _apply(steps, operations):
+    counter = iter(range(100, 200))
+    return batch_edit.apply_edits(steps, operations,
+                                  lambda: 'new%d' % next(counter))
+
+
+def test_insert_delete_move():
+    steps = ['a', 'b', 'c', 'd']
+    result, removed = _apply(steps, [
+        {'op': 'insert', 'index': 4, 'count': 2},
+        {'op': 'insert', 'index': 0, 'copy': 1},
+        {'op': 'delete', 'index': 2, 'count': 2},
+        {'op': 'move', 'index': 0, 'to': 3}])
+    assert result == ['a', 'd', 'new100', 'b', 'new101']
+    assert removed == ['b', 'c']
+    assert steps == ['a', 'b', 'c', 'd']
+
+
+def test_copies_are_independent():
+    steps = [{'duration': 100}]
+    result, removed = _apply(steps, [{'op': 'insert', 'index': 1,
+                                      'count': 2, 'copy': 0}])
+    assert result == [{'duration': 100}] * 3
+    result[1]['duration'] = 200
+    assert result[0] is steps[0] and result[2]['duration'] == 100
+
+
+@pytest.mark.parametrize('operations', [
+    {'op': 'insert', 'index': 0},
+    ['insert'],
+    [{'op': 'insert', 'index': 5}],
+    [{'op': 'insert', 'index': -1}],
+    [{'op': 'insert', 'index': True}],
+    [{'op': 'insert', 'index': 0, 'count': 0}],
+    [{'op': 'insert', 'index': 0, 'copy': 4}],
+    [{'op': 'delete', 'index': 4}],
+    [{'op': 'delete', 'index': 3, 'count': 2}],
+    [{'op': 'delete'}],
+    [{'op': 'move', 'index': 0, 'to': 4}],
+    [{'op': 'swap', 'index': 0}]])
+def test_invalid_operations(operations):
+    with pytest.raises(ValueError):
+        _apply(['a', 'b', 'c', 'd'], operations)
+
+
+def test_atomic():
+    steps = ['a', 'b', 'c']
+    # Valid operations are not applied when a later operation is invalid.
+    with pytest.raises(ValueError):
+        _apply(steps, [{'op': 'delete', 'index': 0, 'count': 3},
+                       {'op': 'delete', 'index': 0}])
+    assert steps == ['a', 'b', 'c']
+
+
+def test_bulk_insert_signals(loaded_plugin):
+    import harness
+
+    loaded_plugin.load_protocol(loaded_plugin.decode_protocol(
+        harness.synthetic_protocol_json(10)))
+    del loaded_plugin.signals[:]
+    loaded_plugin.batch_edit([{'op': 'insert', 'index': 5, 'count': 200}])
+    assert len(loaded_plugin.app.protocol.steps) == 210
+    assert loaded_plugin.signals == ['on_steps_inserted', 'on_step_swapped',
+                                     'on_protocol_changed']
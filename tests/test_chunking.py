@@ -0,0 +1,92 @@
+import pytest
+
+from _common import load_module
+
+chunking = load_module('chunking')
+
+TOPIC = 'microdrop/mqtt-plugin/protocol-changed'
+PAYLOAD = bytes(bytearray(range(256))) * 10
+
+
+class _Clock(object):
+    def __init__(self):
+        self.time = 0.
+
+    def __call__(self):
+        return self.time
+
+
+def test_topics():
+    topic = chunking.chunk_topic(TOPIC, 3)
+    assert chunking.parent_topic(topic) == TOPIC
+    assert chunking.parent_topic(TOPIC) is None
+    assert chunking.parent_topic(TOPIC + chunking.SUFFIX + 'x') is None
+
+
+def test_split():
+    chunks = chunking.split(PAYLOAD, 1000)
+    assert len(chunks) == 3
+    assert all(len(chunk) <= chunking.HEADER.size + 1000 for chunk in chunks)
+    assert len(chunking.split(b'', 1000)) == 1
+
+
+def test_out_of_order_and_interleaved():
+    reassembler = chunking.Reassembler()
+    chunks = chunking.split(PAYLOAD, 100)
+    other = chunking.split(b'other', 2)
+    # Duplicate chunks are ignored.
+    results = [reassembler.add(TOPIC, chunks[-1])]
+    for chunk in reversed(chunks):
+        results.append(reassembler.add(TOPIC, chunk))
+        if other:
+            results.append(reassembler.add(TOPIC, other.pop()))
+    assert [result for result in results if result is not None] == \
+        [b'other', PAYLOAD]
+    assert reassembler.stats == {'pending': 0, 'completed': 2, 'failed': 0,
+                                 'expired': 0}
+
+
+def test_corrupt_payload():
+    reassembler = chunking.Reassembler()
+    chunks = chunking.split(PAYLOAD, 1000)
+    chunks[1] = chunks[1][:-1] + b'x'
+    reassembler.add(TOPIC, chunks[0])
+    reassembler.add(TOPIC, chunks[1])
+    with pytest.raises(ValueError):
+        reassembler.add(TOPIC, chunks[2])
+    assert reassembler.failed == 1 and not len(reassembler)
+
+
+@pytest.mark.parametrize('chunk', [b'short',
+                                   chunking.HEADER.pack(b'0' * 16, 3, 3,
+                                                        b'0' * 20),
+                                   chunking.HEADER.pack(b'1' * 16, 0, 2,
+                                                        b'0' * 20)])
+def test_invalid_chunks(chunk):
+    reassembler = chunking.Reassembler()
+    reassembler.add(TOPIC, chunking.HEADER.pack(b'1' * 16, 0, 3, b'0' * 20))
+    with pytest.raises(ValueError):
+        reassembler.add(TOPIC, chunk)
+    assert reassembler.failed == 1
+
+
+def test_expired():
+    clock = _Clock()
+    reassembler = chunking.Reassembler(timeout=30., clock=clock)
+    chunks = chunking.split(PAYLOAD, 1000)
+    reassembler.add(TOPIC, chunks[0])
+    clock.time = 31.
+    reassembler.add(TOPIC, chunks[1])
+    assert reassembler.expired == 1
+    # The transfer restarted from the second chunk, so is still incomplete.
+    assert reassembler.add(TOPIC, chunks[2]) is None
+    assert reassembler.add(TOPIC, chunks[0]) == PAYLOAD
+
+
+def test_oversized():
+    reassembler = chunking.Reassembler(max_size=1500)
+    chunks = chunking.split(PAYLOAD, 1000)
+    reassembler.add(TOPIC, chunks[0])
+    with pytest.raises(ValueError):
+        reassembler.add(TOPIC, chunks[1])
+    assert reassembler.failed == 1 and not len(reassembler)
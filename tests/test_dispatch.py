@@ -0,0 +1,87 @@
+import logging
+
+import pytest
+
+from _common import load_module
+
+dispatch = load_module('dispatch')
+MessageQueue = dispatch.MessageQueue
+
+
+def _drain(queue):
+    items = []
+    while len(queue):
+        items.append(queue.get(timeout=0))
+    return items
+
+
+def test_fifo():
+    queue = MessageQueue(10)
+    for i in range(3):
+        queue.put('a' if i % 2 else 'b', i)
+    assert _drain(queue) == [('b', 0), ('a', 1), ('b', 2)]
+    with pytest.raises(dispatch.Empty):
+        queue.get(timeout=0)
+
+
+def test_coalesce_adjacent_only():
+    queue = MessageQueue(10)
+    queue.put('a', 0, coalesce=True)
+    queue.put('a', 1, coalesce=True)
+    queue.put('b', 2)
+    queue.put('a', 3, coalesce=True)
+    assert _drain(queue) == [('a', 1), ('b', 2), ('a', 3)]
+    assert queue.coalesced_by_key == {'a': 1}
+
+
+@pytest.mark.parametrize('overflow', [MessageQueue.DROP_OLDEST,
+                                      MessageQueue.COALESCE])
+def test_overflow_drops_oldest(overflow, caplog):
+    queue = MessageQueue(2, overflow)
+    with caplog.at_level(logging.WARNING):
+        for i in range(3):
+            queue.put('a', i)
+    assert _drain(queue) == [('a', 1), ('a', 2)]
+    assert queue.dropped == 1
+    assert 'dropped oldest' in caplog.text
+
+
+def test_overflow_coalesces_only_coalesced_items():
+    queue = MessageQueue(2, MessageQueue.COALESCE)
+    queue.put('a', 0, coalesce=True)
+    queue.put('b', 1)
+    queue.put('a', 2, coalesce=True)
+    assert _drain(queue) == [('a', 2), ('b', 1)]
+    queue.put('b', 0)
+    queue.put('c', 1)
+    queue.put('b', 2)
+    assert _drain(queue) == [('c', 1), ('b', 2)]
+
+
+def test_overflow_keeps_undroppable_items(caplog):
+    queue = MessageQueue(2, MessageQueue.COALESCE)
+    queue.put('edit', 0, droppable=False)
+    queue.put('a', 1)
+    queue.put('a', 2)
+    assert _drain(queue) == [('edit', 0), ('a', 2)]
+
+    queue.put('edit', 0, droppable=False)
+    queue.put('edit', 1, droppable=False)
+    with caplog.at_level(logging.WARNING):
+        # New droppable item is dropped instead of a queued edit.
+        queue.put('a', 2)
+        # Undroppable items are queued beyond capacity.
+        queue.put('edit', 3, droppable=False)
+    assert _drain(queue) == [('edit', 0), ('edit', 1), ('edit', 3)]
+    assert queue.dropped == 2
+    assert 'dropped new item `a`' in caplog.text
+    assert 'beyond capacity' in caplog.text
+
+
+def test_held_item_released_by_ready_item():
+    queue = MessageQueue(10)
+    queue.put('a', 0, coalesce=True, delay=60)
+    with pytest.raises(dispatch.Empty):
+        queue.get(timeout=0)
+    queue.put('b', 1)
+    assert _drain(queue) == [('a', 0), ('b', 1)]
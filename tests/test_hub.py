@@ -0,0 +1,48 @@
+import pytest
+
+from _common import load_module
+
+hub = load_module('hub')
+dispatch = load_module('dispatch')
+
+
+class _Client(object):
+    def subscribe(self, topics):
+        pass
+
+    def unsubscribe(self, topics):
+        pass
+
+
+class _Reactor(object):
+    def add_client(self, *args):
+        pass
+
+    def remove_client(self, client):
+        pass
+
+
+@pytest.fixture
+def connection_hub():
+    connection_hub = hub.ConnectionHub(client=_Client(), reactor=_Reactor())
+    yield connection_hub
+    connection_hub.stop()
+
+
+def test_register_does_not_block_by_default(connection_hub):
+    registration = connection_hub.register('a', ['a/#'], lambda msg: None)
+    assert registration.queue.overflow == dispatch.MessageQueue.DROP_OLDEST
+
+
+def test_default_hub_settings(monkeypatch):
+    reactor = _Reactor()
+    monkeypatch.setattr(hub, '_hubs', {('localhost', 1883):
+                                       hub.ConnectionHub(client=_Client(),
+                                                         keepalive=30,
+                                                         reactor=reactor)})
+    connection_hub = hub.default_hub()
+    assert hub.default_hub(keepalive=30, reactor=reactor) is connection_hub
+    with pytest.raises(ValueError):
+        hub.default_hub(keepalive=60)
+    with pytest.raises(ValueError):
+        hub.default_hub(reactor=_Reactor())
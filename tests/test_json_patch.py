@@ -0,0 +1,75 @@
+import json
+
+import pytest
+
+from _common import load_module
+
+json_patch = load_module('json_patch')
+
+
+@pytest.mark.parametrize('old, new', [
+    ({'a': 1, 'b': [1, 2, 3]}, {'a': 2, 'b': [1, 3], 'c': None}),
+    ([1, 2, 3], [0, 1, 2, 3, 4]),
+    ([[1, 2], [3, 4], [5, 6]], [[1, 2], [5, 6]]),
+    ({'a/b': 1, 'c~d': 2}, {'a/b': 3, 'c~d': 4}),
+    ({'steps': [{'x': i} for i in range(5)]},
+     {'steps': [{'x': i} for i in (0, 1, 3)] + [{'x': 2}]}),
+    (1, 'a')])
+def test_roundtrip(old, new):
+    patch = json_patch.make_patch(old, new)
+    assert json_patch.apply_patch(old, patch) == new
+
+
+def test_no_change():
+    document = {'a': [1, {'b': float('nan')}], 'c': 'd'}
+    assert json_patch.make_patch(document, json.loads(json.dumps(
+        document))) == []
+
+
+@pytest.mark.parametrize('old, new', [
+    (0, False), (1, True),
+    ([{'x': 0}], [{'x': False}]), ([{'x': 1}], [{'x': True}]),
+    ({'x': [True]}, {'x': [1]})])
+def test_bool_distinct_from_number(old, new):
+    patch = json_patch.make_patch(old, new)
+    assert patch
+    result = json_patch.apply_patch(old, patch)
+    assert json.dumps(result) == json.dumps(new)
+
+
+def test_nan_equal_to_itself():
+    nan = float('nan')
+    assert json_patch.make_patch([1, nan, [nan]], [1, nan, [nan]]) == []
+    assert json_patch.make_patch([1, nan], [1, 2.]) == \
+        [{'op': 'replace', 'path': '/1', 'value': 2.}]
+
+
+def test_apply_patch_does_not_modify_document():
+    document = {'a': [1, 2]}
+    json_patch.apply_patch(document, [{'op': 'add', 'path': '/a/0',
+                                       'value': 0}])
+    assert document == {'a': [1, 2]}
+
+
+def _document(last):
+    return {'steps': [{'duration': 100, 'voltage': 100}] * 20 + [last]}
+
+
+def test_delta_stream():
+    stream = json_patch.DeltaStream(2)
+    empty = json.loads(stream.snapshot(json.dumps(_document(1))))
+    assert empty['patch'] == []
+    delta = json.loads(stream.delta(json.dumps(_document(2))))
+    assert delta['base'] == empty['base']
+    assert delta['seq'] == empty['seq'] + 1
+    assert json_patch.apply_patch(_document(1), delta['patch']) == \
+        _document(2)
+    assert stream.delta(json.dumps(_document(3))) is not None
+    # Snapshot interval reached.
+    assert stream.delta(json.dumps(_document(4))) is None
+
+
+def test_delta_stream_large_patch():
+    stream = json_patch.DeltaStream(10)
+    stream.snapshot(json.dumps({'steps': list(range(10))}))
+    assert stream.delta(json.dumps({'steps': list(range(10, 20))})) is None
@@ -0,0 +1,32 @@
+'''
+Loading of protocols received on ``microdrop/data-controller/load-protocol``.
+
+Requires the MicroDrop runtime packages (``microdrop``,
+``paho_mqtt_helpers``, ...).
+'''
+import pytest
+
+pytest.importorskip('microdrop')
+
+import harness  # noqa: E402
+
+
+def test_load_same_payload_twice(loaded_plugin):
+    payload = harness.synthetic_protocol_json(10)
+    for i in range(2):
+        loaded_plugin.load_protocol(loaded_plugin.decode_protocol(payload))
+    assert loaded_plugin.signals == ['on_protocol_swapped',
+                                     'on_protocol_changed']
+    assert loaded_plugin._skipped_loads == 1
+
+
+def test_load_protocol_by_hash(loaded_plugin):
+    mqtt_plugin = harness.load_plugin()
+    payload = harness.synthetic_protocol_json(10)
+    protocol = loaded_plugin.decode_protocol(payload)
+    loaded_plugin.load_protocol(protocol)
+    loaded_plugin.load_protocol(loaded_plugin.decode_protocol(
+        harness.synthetic_protocol_json(5)))
+    assert loaded_plugin.load_protocol_by_hash(
+        mqtt_plugin.json_digest(payload))
+    assert loaded_plugin.app.protocol is protocol
@@ -0,0 +1,23 @@
+from _common import load_module
+
+metrics = load_module('metrics')
+
+
+def test_sample():
+    topic_metrics = metrics.TopicMetrics(metrics.MetricsRegistry(), 'a',
+                                         sample_interval=3)
+    assert [topic_metrics.sample() for i in range(7)] == \
+        [True, False, False, True, False, False, True]
+
+
+def test_topic_metrics_share_registry_entries():
+    registry = metrics.MetricsRegistry()
+    for i in range(2):
+        topic_metrics = metrics.TopicMetrics(registry, 'a')
+        topic_metrics.received_messages.increment()
+        topic_metrics.latency('queue').observe(1e-3)
+    assert registry.counter('mqtt_plugin_received_messages_total',
+                            topic='a').value == 2
+    histograms = registry.histograms('mqtt_plugin_latency_seconds')
+    assert [(labels, histogram.count) for labels, histogram in histograms] \
+        == [({'topic': 'a', 'stage': 'queue'}, 2)]
@@ -0,0 +1,79 @@
+from _common import load_module
+
+outbound = load_module('outbound')
+
+
+class _Clock(object):
+    def __init__(self):
+        self.time = 0.
+
+    def __call__(self):
+        return self.time
+
+
+def _outbox(**kwargs):
+    sent = []
+    outbox = outbound.Outbox(lambda *message: sent.append(message[:2]),
+                             **kwargs)
+    return outbox, sent
+
+
+def test_order_and_coalescing():
+    outbox, sent = _outbox()
+    outbox.put('a', '1', retain=True)
+    outbox.put('b', '1')
+    outbox.put('a', '2', retain=True)
+    outbox.put('b', '2')
+    assert outbox.flush() == 0
+    # Retained messages keep the position of the message they replace.
+    assert sent == [('a', '2'), ('b', '1'), ('b', '2')]
+    assert outbox.stats['coalesced'] == 1
+
+
+def test_overflow_drops_oldest():
+    outbox, sent = _outbox(maxsize=2)
+    for i in range(3):
+        outbox.put('a', str(i))
+    outbox.flush()
+    assert sent == [('a', '1'), ('a', '2')]
+    assert outbox.dropped == 1
+
+
+def test_bulk_lane():
+    outbox, sent = _outbox(maxsize=2, bulk_batch_size=2)
+    for i in range(5):
+        outbox.put('bulk', str(i), bulk=True)
+    outbox.put('a', '0')
+    assert outbox.flush() == 3
+    # Other messages go first, and bulk messages are never dropped.
+    assert sent == [('a', '0'), ('bulk', '0'), ('bulk', '1')]
+    outbox.put('a', '1')
+    outbox.stop()
+    assert sent[3:] == [('a', '1'), ('bulk', '2'), ('bulk', '3'),
+                        ('bulk', '4')]
+
+
+def test_rate_limit():
+    clock = _Clock()
+    outbox, sent = _outbox(rate=10, burst=2)
+    outbox.bucket = outbound.TokenBucket(10, 2, clock=clock)
+    for i in range(5):
+        outbox.put('a', str(i))
+    assert outbox.flush() == 3
+    assert outbox.throttled == 1
+    assert outbox.flush() == 3
+    assert outbox.bucket.delay() == .1
+    clock.time = .1
+    assert outbox.flush() == 2
+    assert [payload for topic, payload in sent] == ['0', '1', '2']
+
+
+def test_token_bucket_refill():
+    clock = _Clock()
+    bucket = outbound.TokenBucket(100, clock=clock)
+    assert bucket.take(150) == 100
+    assert bucket.take() == 0
+    clock.time = .5
+    assert bucket.take(100) == 50
+    clock.time = 10
+    assert bucket.take(1000) == 100
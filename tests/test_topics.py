@@ -0,0 +1,67 @@
+import pytest
+
+from _common import load_module
+
+topics = load_module('topics')
+
+
+def test_literal_filter():
+    trie = topics.TopicTrie([('a/b', 1)])
+    assert trie.match('a/b') == (1, )
+    assert trie.match('a/b/c') == ()
+    assert trie.match('a') == ()
+
+
+def test_single_level_wildcard():
+    trie = topics.TopicTrie([('a/+/c', 1), ('+/+', 2)])
+    assert trie.match('a/b/c') == (1, )
+    assert trie.match('a/b') == (2, )
+    assert trie.match('a/b/c/d') == ()
+    # `+` matches an empty level.
+    assert trie.match('a//c') == (1, )
+
+
+def test_multi_level_wildcard():
+    trie = topics.TopicTrie([('a/#', 1), ('#', 2)])
+    assert sorted(trie.match('a/b/c')) == [1, 2]
+    # `a/#` also matches the parent level.
+    assert sorted(trie.match('a')) == [1, 2]
+    assert trie.match('b') == (2, )
+
+
+def test_literal_match_first():
+    trie = topics.TopicTrie([('a/+', 1), ('a/b', 2)])
+    assert trie.match('a/b') == (2, 1)
+
+
+def test_system_topics():
+    trie = topics.TopicTrie([('#', 1), ('+/info', 2), ('$SYS/#', 3),
+                             ('$SYS/info', 4)])
+    # Wildcards in the first level do not match `$` topics.
+    assert trie.match('$SYS/info') == (4, 3)
+    assert trie.match('other/info') == (1, 2)
+
+
+def test_update_and_delete_clear_cache():
+    trie = topics.TopicTrie([('a/+', 1)])
+    assert trie.match('a/b') == (1, )
+    trie['a/b'] = 2
+    assert trie.match('a/b') == (2, 1)
+    del trie['a/+']
+    assert trie.match('a/b') == (2, )
+    del trie['a/b']
+    assert trie.match('a/b') == ()
+    assert len(trie) == 0
+
+
+def test_cache_bounded():
+    trie = topics.TopicTrie([('a/+', 1)])
+    for i in range(2 * trie.cache_size):
+        assert trie.match('a/%d' % i) == (1, )
+    assert len(trie._cache) <= trie.cache_size
+
+
+@pytest.mark.parametrize('topic_filter', ['a/#/b', 'a/b+', 'a#'])
+def test_invalid_filter(topic_filter):
+    with pytest.raises(ValueError):
+        topics.TopicTrie([(topic_filter, 1)])
@@ -0,0 +1,71 @@
+import pytest
+
+from _common import load_module
+
+transaction = load_module('transaction')
+
+
+def test_deduplicate_pending_signals():
+    transaction_ = transaction.Transaction()
+    transaction_.emit_signal('on_protocol_changed')
+    transaction_.emit_signal('on_step_swapped', [0, 1])
+    transaction_.emit_signal('on_protocol_changed')
+    transaction_.emit_signal('on_step_swapped', [0, 2])
+    assert transaction_.signals == [('on_protocol_changed', None),
+                                    ('on_step_swapped', [0, 1]),
+                                    ('on_step_swapped', [0, 2])]
+    assert transaction_.deduplicated_signals == 1
+
+
+def test_dispatched_signals_are_not_deduplicated():
+    transaction_ = transaction.Transaction()
+    transaction_.emit_signal('on_protocol_changed')
+    assert transaction_.pop_signal() == ('on_protocol_changed', None)
+    transaction_.emit_signal('on_protocol_changed')
+    assert transaction_.pop_signal() == ('on_protocol_changed', None)
+    assert transaction_.pop_signal() is None
+    assert transaction_.deduplicated_signals == 0
+
+
+def test_coalesce_retained_publishes():
+    transaction_ = transaction.Transaction()
+    transaction_.publish('a', '1', retain=True)
+    transaction_.publish('b', '1')
+    transaction_.publish('a', '2', retain=True)
+    transaction_.publish('b', '2')
+    assert list(transaction_.publishes.values()) == [
+        ('a', '2', 0, True, True), ('b', '1', 0, False, True),
+        ('b', '2', 0, False, True)]
+    assert transaction_.coalesced_publishes == 1
+
+
+def test_commit_defers_signals_of_handlers(loaded_plugin, monkeypatch):
+    import harness
+
+    mqtt_plugin = harness.load_plugin()
+    emitted = []
+
+    def emit_signal(function, args=None):
+        emitted.append(function)
+        if function == 'on_step_created':
+            # Handlers emitting signals within the commit are deferred.
+            loaded_plugin._emit_signal('on_protocol_changed')
+            loaded_plugin._emit_signal('on_protocol_changed')
+
+    monkeypatch.setattr(mqtt_plugin, 'emit_signal', emit_signal)
+    with loaded_plugin.transaction():
+        loaded_plugin._emit_signal('on_step_created', [0])
+        loaded_plugin._emit_signal('on_step_created', [0])
+        assert emitted == []
+    assert emitted == ['on_step_created', 'on_protocol_changed']
+    assert getattr(loaded_plugin._transactions, 'current') is None
+
+
+def test_failed_transaction_is_discarded(loaded_plugin):
+    with pytest.raises(RuntimeError):
+        with loaded_plugin.transaction():
+            loaded_plugin._emit_signal('on_protocol_changed')
+            raise RuntimeError()
+    assert loaded_plugin.signals == []
+    loaded_plugin._emit_signal('on_protocol_changed')
+    assert loaded_plugin.signals == ['on_protocol_changed']
@@ -0,0 +1,171 @@
+'''
+MQTT topic filter matching.
+'''
+from collections import OrderedDict
+
+
+class _Node(object):
+    __slots__ = ('children', 'values')
+
+    def __init__(self):
+        self.children = {}
+        self.values = []
+
+
+class _MatchCache(dict):
+    '''
+    Memoized topic matches, computed by :data:`match` on first lookup of a
+    topic (and dropped all at once when :data:`maxsize` is reached).
+    '''
+    def __init__(self, match, maxsize):
+        super(_MatchCache, self).__init__()
+        self._match = match
+        self._maxsize = maxsize
+
+    def __missing__(self, topic):
+        matches = self._match(topic)
+        if len(self) >= self._maxsize:
+            self.clear()
+        self[topic] = matches
+        return matches
+
+
+class TopicTrie(object):
+    '''
+    Mapping from MQTT topic filters to values, supporting the ``+`` (single
+    level) and ``#`` (multi-level) wildcards.
+
+    Filters without wildcards are kept in a flat dictionary, so a topic that
+    matches a literal filter is resolved with a single lookup.  Wildcard
+    filters are stored in a trie keyed by topic level, which is only walked
+    when at least one wildcard filter is registered.  Match results are
+    memoized per topic name, since brokers deliver the same handful of topics
+    over and over: :meth:`match` is then a single (C level) dictionary
+    lookup, whatever the number of filters.
+
+    Parameters
+    ----------
+    items : list, optional
+        Iterable of ``(topic_filter, value)`` pairs.
+    '''
+    #: Maximum number of memoized topic matches.
+    cache_size = 1024
+
+    def __init__(self, items=None):
+        self._filters = OrderedDict()
+        self._cache = _MatchCache(self._match_topic, self.cache_size)
+        # Bound `dict.__getitem__` of the cache, shadowing the documented
+        # `match()` method below.
+        self.match = self._cache.__getitem__
+        self._exact = {}
+        self._root = _Node()
+        self._wildcard_count = 0
+        for topic_filter, value in (items or []):
+            self[topic_filter] = value
+
+    @staticmethod
+    def is_wildcard(topic_filter):
+        levels = topic_filter.split('/')
+        for i, level in enumerate(levels):
+            if level == '#' and i == len(levels) - 1:
+                return True
+            elif level == '+':
+                return True
+            elif '#' in level or '+' in level:
+                raise ValueError('Invalid topic filter: `%s`' % topic_filter)
+        return False
+
+    def __setitem__(self, topic_filter, value):
+        if topic_filter in self._filters:
+            del self[topic_filter]
+        self._cache.clear()
+        if self.is_wildcard(topic_filter):
+            node = self._root
+            for level in topic_filter.split('/'):
+                node = node.children.setdefault(level, _Node())
+            node.values.append(value)
+            self._wildcard_count += 1
+        else:
+            self._exact[topic_filter] = value
+        self._filters[topic_filter] = value
+
+    def __getitem__(self, topic_filter):
+        return self._filters[topic_filter]
+
+    def __delitem__(self, topic_filter):
+        value = self._filters.pop(topic_filter)
+        self._cache.clear()
+        if topic_filter in self._exact:
+            del self._exact[topic_filter]
+            return
+        nodes = [self._root]
+        levels = topic_filter.split('/')
+        for level in levels:
+            nodes.append(nodes[-1].children[level])
+        nodes[-1].values.remove(value)
+        self._wildcard_count -= 1
+        # Prune branches that no longer lead to any filter.
+        for level, parent, node in reversed(list(zip(levels, nodes[:-1],
+                                                     nodes[1:]))):
+            if node.values or node.children:
+                break
+            del parent.children[level]
+
+    def __contains__(self, topic_filter):
+        return topic_filter in self._filters
+
+    def __iter__(self):
+        return iter(self._filters)
+
+    def __len__(self):
+        return len(self._filters)
+
+    def items(self):
+        return list(self._filters.items())
+
+    def match(self, topic):
+        '''
+        Parameters
+        ----------
+        topic : str
+            Topic name of a received message (no wildcards).
+
+        Returns
+        -------
+        tuple
+            Values of all filters matching :data:`topic`, literal filter
+            first.
+        '''
+        return self._cache[topic]
+
+    def _match_topic(self, topic):
+        matches = []
+        value = self._exact.get(topic, self)
+        if value is not self:
+            matches.append(value)
+        if self._wildcard_count:
+            levels = topic.split('/')
+            # Wildcards must not match topics starting with `$` (see MQTT
+            # v3.1.1, section 4.7.2).
+            self._match(self._root, levels, 0, matches,
+                        levels[0].startswith('$'))
+        return tuple(matches)
+
+    def _match(self, node, levels, i, matches, system_topic=False):
+        if i == len(levels):
+            matches.extend(node.values)
+            # `a/#` also matches the parent level `a`.
+            child = node.children.get('#')
+            if child is not None:
+                matches.extend(child.values)
+            return
+        if not (system_topic and i == 0):
+            child = node.children.get('#')
+            if child is not None:
+                matches.extend(child.values)
+            child = node.children.get('+')
+            if child is not None:
+                self._match(child, levels, i + 1, matches)
+        child = node.children.get(levels[i])
+        if child is not None:
+            self._match(child, levels, i + 1, matches)
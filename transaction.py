@@ -0,0 +1,59 @@
+'''
+Deferred signals and publishes, committed together at the end of a series of
+protocol edits.
+'''
+from collections import OrderedDict
+import itertools
+
+
+class Transaction(object):
+    '''
+    Signals and messages deferred until a transaction is committed.
+
+    Signals are deduplicated: a signal emitted with the same arguments as a
+    pending (i.e., not yet dispatched, see :meth:`pop_signal`) signal is
+    dropped.  Retained messages are coalesced per topic, as
+    in :class:`outbound.Outbox`; other messages are kept in order.
+
+    Attributes
+    ----------
+    signals : list
+        Pending ``(function, args)`` signals, in order of first emission.
+    publishes : collections.OrderedDict
+        Pending ``(topic, payload, qos, retain, envelope)`` messages.
+    deduplicated_signals : int
+        Number of signals dropped as duplicates of a pending signal.
+    coalesced_publishes : int
+        Number of retained messages replaced by a more recent message on the
+        same topic.
+    '''
+    def __init__(self):
+        self.signals = []
+        self.publishes = OrderedDict()
+        self.deduplicated_signals = 0
+        self.coalesced_publishes = 0
+        self._sequence = itertools.count()
+
+    def emit_signal(self, function, args=None):
+        for function_i, args_i in self.signals:
+            if function_i == function and args_i == args:
+                self.deduplicated_signals += 1
+                return
+        self.signals.append((function, args))
+
+    def pop_signal(self):
+        '''
+        Returns
+        -------
+        tuple or None
+            Oldest pending ``(function, args)`` signal (removed from
+            :attr:`signals`), or ``None`` if there is none.
+        '''
+        return self.signals.pop(0) if self.signals else None
+
+    def publish(self, topic, payload=None, qos=0, retain=False,
+                envelope=True):
+        key = ('retain', topic) if retain else next(self._sequence)
+        if key in self.publishes:
+            self.coalesced_publishes += 1
+        self.publishes[key] = (topic, payload, qos, retain, envelope)